@@ -0,0 +1,242 @@
+import argparse
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import psycopg
+from streamlit.testing.v1 import AppTest
+
+from utils.fetch import conninfo
+from utils.synthetic import generate_workbook
+
+# Load test: drive N concurrent simulated sessions through Steps 1 to 5 headlessly with Streamlit's AppTest, each in
+# its own process (AppTest installs a process-wide Streamlit runtime, and tears it down when a session ends), against
+# the PostgreSQL of DATABASE_URL. Every session uploads its own synthetic workbook (see utils/synthetic.py), and clicks
+# the button starting the aggregation in Step 4. For each level of concurrency, reports the latency percentiles of
+# every step, the session throughput, the peak RSS of the session processes and the peak number of connections to
+# the database.
+#
+#   python loadtest.py --sessions 1,2,4,8 --users 200 --days 7
+#
+# The schemas of the simulated runs are dropped afterwards, unless --keep-runs.
+
+PAGES = {
+    "step1": "pages/2Step 1 - Upload data.py",
+    "step2": "pages/3Step 2 - Validate input data.py",
+    "step3": "pages/4Step 3 - Insert data into PSQL.py",
+    "step4": "pages/5Step 4 - Aggregate data with SQL.py",
+    "step5": "pages/6Step 5 - Validate table output.py",
+}
+# Timeout of a single run of a page
+PAGE_TIMEOUT_SECONDS = float(os.environ.get("LOADTEST_PAGE_TIMEOUT_SECONDS", "600"))
+# How often RSS and database connections are sampled
+SAMPLE_SECONDS = 0.1
+PERCENTILES = [0.5, 0.9, 0.95, 0.99]
+
+CONNECTIONS_QUERY = """
+    SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid();
+"""
+
+
+def rss_bytes(pid: str = "self") -> int:
+    """
+    The resident set size of a process (0 if it's gone).
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except FileNotFoundError:
+        return 0
+
+
+def child_pids() -> list[str]:
+    """
+    The processes started by this one, i.e. the processes running the sessions.
+    """
+    pids = []
+    for task in os.listdir("/proc/self/task"):
+        try:
+            with open(f"/proc/self/task/{task}/children") as children:
+                pids += children.read().split()
+        except FileNotFoundError:
+            continue
+    return pids
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the total RSS of the session processes and the connections to the database every SAMPLE_SECONDS,
+    keeping the peaks.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.connection = psycopg.connect(conninfo(), autocommit=True)
+        self.stopped = threading.Event()
+        self.peak_rss_bytes = 0
+        self.peak_connections = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss = sum(rss_bytes(pid) for pid in child_pids())
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+            connections = self.connection.execute(CONNECTIONS_QUERY).fetchone()[0]
+            self.peak_connections = max(self.peak_connections, connections)
+            self.stopped.wait(SAMPLE_SECONDS)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.connection.close()
+
+
+def run_session(session: int, workbook: bytes) -> tuple[list[dict], str | None]:
+    """
+    Go through the steps of the app like a user uploading `workbook`. Returns the latency of every step,
+    and the run id of the session (None if it didn't get one).
+    """
+    at = AppTest.from_file("Home.py", default_timeout=PAGE_TIMEOUT_SECONDS).run()
+    upload = io.BytesIO(workbook)
+    upload.name = f"loadtest_{session}.xlsx"
+    at.session_state.uploaded_file_from_storage = upload
+    latencies = []
+    for step, page in PAGES.items():
+        started = time.perf_counter()
+        try:
+            at.switch_page(page).run()
+            if step == "step4":
+                aggregate = [b for b in at.button if b.label == "Aggregate"]
+                if aggregate:
+                    aggregate[0].click().run()
+            errors = [e.value for e in at.exception] + [e.value for e in at.error]
+        except Exception as e:
+            errors = [repr(e)]
+        latencies.append(
+            {
+                "session": session,
+                "step": step,
+                "seconds": time.perf_counter() - started,
+                "ok": not errors,
+                "error": str(errors[0])[:200] if errors else None,
+            }
+        )
+        if errors:
+            break
+    run_id = at.session_state["run_id"] if "run_id" in at.session_state else None
+    return latencies, run_id
+
+
+def run_level(sessions: int, workbooks: list[bytes]):
+    """
+    Run `sessions` sessions concurrently, each in a fresh process. Returns their latencies, run ids and the
+    sampled peaks.
+    """
+    sampler = Sampler()
+    sampler.start()
+    started = time.perf_counter()
+    # Spawned, not forked: this process has threads (the sampler) and an open connection
+    with ProcessPoolExecutor(
+        max_workers=sessions,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        results = list(executor.map(run_session, range(sessions), workbooks[:sessions]))
+    wall_seconds = time.perf_counter() - started
+    sampler.stop()
+    latencies = pd.DataFrame([row for rows, _ in results for row in rows])
+    run_ids = [run_id for _, run_id in results if run_id is not None]
+    return latencies, run_ids, wall_seconds, sampler
+
+
+def summarize(
+    sessions: int, latencies: pd.DataFrame, wall_seconds: float, sampler: Sampler
+):
+    """
+    One row per step: latency percentiles (in seconds) and failures, plus the level's throughput and peaks.
+    """
+    steps = latencies.groupby("step", sort=False)
+    summary = steps["seconds"].quantile(PERCENTILES).unstack()
+    summary.columns = [f"p{round(q * 100)}" for q in PERCENTILES]
+    summary["max"] = steps["seconds"].max()
+    summary["failed"] = steps["ok"].apply(lambda ok: int((~ok).sum()))
+    completed = latencies[latencies["step"] == "step5"]["ok"].sum()
+    return summary.reset_index().assign(
+        sessions=sessions,
+        sessions_per_minute=60 * completed / wall_seconds,
+        peak_rss_mb=sampler.peak_rss_bytes / 2**20,
+        peak_db_connections=sampler.peak_connections,
+    )
+
+
+def drop_runs(run_ids: list[str]):
+    with psycopg.connect(conninfo(), autocommit=True) as connection:
+        for run_id in run_ids:
+            connection.execute(f"DROP SCHEMA IF EXISTS run_{run_id} CASCADE;")
+            connection.execute(
+                "UPDATE runs SET status = 'dropped' WHERE id = %s;", (run_id,)
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive concurrent simulated sessions through Steps 1 to 5."
+    )
+    parser.add_argument(
+        "--sessions",
+        default="1,2,4,8",
+        help="Comma-separated levels of concurrency (default: 1,2,4,8)",
+    )
+    parser.add_argument("--users", type=int, default=100, help="Users per workbook")
+    parser.add_argument("--days", type=int, default=3, help="Days per workbook")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--same-upload",
+        action="store_true",
+        help="Every session uploads the same workbook",
+    )
+    parser.add_argument("--output", help="Also write the report to this CSV file")
+    parser.add_argument("--keep-runs", action="store_true")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.sessions.split(",")]
+
+    # The pages read files relative to the root of the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    workbooks = []
+    for session in range(max(levels)):
+        workbook = io.BytesIO()
+        generate_workbook(
+            workbook,
+            users=args.users,
+            days=args.days,
+            seed=args.seed if args.same_upload else args.seed + session,
+        )
+        workbooks.append(workbook.getvalue())
+    print(
+        f"Generated {len(workbooks)} workbooks of {args.users} users over {args.days} days"
+    )
+
+    reports = []
+    for sessions in levels:
+        latencies, run_ids, wall_seconds, sampler = run_level(sessions, workbooks)
+        report = summarize(sessions, latencies, wall_seconds, sampler)
+        reports.append(report)
+        print(f"\n{sessions} concurrent sessions ({wall_seconds:.1f}s):")
+        print(
+            report.drop(columns="sessions").to_string(index=False, float_format="%.2f")
+        )
+        for error in latencies["error"].dropna().unique():
+            print(f"  error: {error}")
+        if not args.keep_runs:
+            drop_runs(run_ids)
+
+    if args.output:
+        pd.concat(reports).to_csv(args.output, index=False)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
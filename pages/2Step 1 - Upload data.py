@@ -1,5 +1,17 @@
+import os
+import uuid
 import streamlit as st
 import pandas as pd
+from utils.fingerprint import fingerprint_file
+from utils.instrumentation import track_stage, render_metrics_sidebar
+from utils.runs import get_run_id
+from utils.streaming import (
+    STREAM_INPUT_DIR,
+    SpillStore,
+    input_path,
+    spill_path,
+    spill_workbook,
+)
 
 
 def main():
@@ -29,18 +41,98 @@ def main():
         else None
     )
 
-    if uploaded_file is not None:
+    # In streaming mode, the file is read, validated and deduplicated chunk by chunk into a spill file on disk,
+    # so files larger than memory can be processed. Only a preview of each table is kept in st.session_state.
+    streaming = st.toggle(
+        "Streaming mode",
+        value="spill" in st.session_state,
+        help="For files larger than memory: Steps 1 to 3 process the data in fixed-size chunks.",
+    )
+    if streaming:
+        server_file = st.text_input(
+            f"...or the name of an XLSX file in `{STREAM_INPUT_DIR}` on the server (for files too large to upload)"
+        )
+        if server_file:
+            server_path = input_path(server_file)
+            if server_path is None:
+                st.error(f"There is no file `{server_file}` in `{STREAM_INPUT_DIR}`.")
+            else:
+                uploaded_file = server_path
+    elif st.session_state.pop("spill", None) is not None:
+        # Only previews were kept in streaming mode: Step 2 has to validate the whole file again
+        for key in ["spins_hourly_validated", "purchases_validated"]:
+            st.session_state.pop(key, None)
+
+    if uploaded_file is not None and streaming:
+        source = (
+            (uploaded_file, os.path.getmtime(uploaded_file))
+            if isinstance(uploaded_file, str)
+            else (uploaded_file.name, uploaded_file.size)
+        )
+        spill = st.session_state.get("spill")
+        if spill is None or spill["source"] != source:
+            progress_text = st.empty()
+            store = spill_workbook(
+                uploaded_file,
+                spill_path(get_run_id()),
+                on_chunk=lambda sheet_name, rows: progress_text.caption(
+                    f"Streaming `{sheet_name}`: {rows} rows read"
+                ),
+            )
+            spill = {"source": source, "path": store.path, "version": uuid.uuid4().hex}
+            st.session_state.spill = spill
+            # Recognizes the workbook if it was already ingested (see Step 3)
+            st.session_state.content_hash = fingerprint_file(uploaded_file)
+            st.session_state.file_name = source[0]
+        else:
+            store = SpillStore(spill["path"])
+        # The in-memory tables of the non-streaming mode are not used anymore
+        for key in ["spins_hourly", "purchases"]:
+            st.session_state.pop(key, None)
+        st.session_state.spins_hourly_validated = store.preview("spins_hourly")
+        st.session_state.purchases_validated = store.preview("purchases")
+
+        st.success(
+            f"""
+            Streamed, validated and deduplicated {store.count("spins_hourly")} `Spins Hourly` rows and
+            {store.count("purchases")} `Purchases` rows into `{store.path}`. {store.count("rejected")} rows
+            failed the validation: they are quarantined in Step 3.
+            """
+        )
+        store.close()
+        st.caption("Table: Spins Hourly (preview)")
+        st.write(st.session_state.spins_hourly_validated)
+        st.caption("Table: Purchases (preview)")
+        st.write(st.session_state.purchases_validated)
+        st.write("Let's move on to Step 3 when you're ready.")
+
+    elif uploaded_file is not None:
         # Save the uploaded file to st.session_state to prevent reuploading on leaving page
         st.session_state.uploaded_file_from_storage = uploaded_file
+        # Recognizes the workbook if it was already ingested (see Step 3)
+        st.session_state.content_hash = fingerprint_file(uploaded_file)
+        st.session_state.file_name = getattr(uploaded_file, "name", str(uploaded_file))
 
         # Read the XLSX file into DataFrames and save to st.session_state
-        spins_hourly = pd.read_excel(
-            uploaded_file, sheet_name="Spins Hourly", usecols="A:D", dtype=str
-        ).sort_values(by=["date", "userId"], ignore_index=True)
+        # `source_row` is the row of every record in its sheet (the header is row 1), to trace
+        # the rows rejected in Step 2 back to the file
+        with track_stage("step1.read_excel.spins_hourly") as stage:
+            spins_hourly = (
+                pd.read_excel(
+                    uploaded_file, sheet_name="Spins Hourly", usecols="A:D", dtype=str
+                )
+                .pipe(lambda df: df.assign(source_row=df.index + 2))
+                .sort_values(by=["date", "userId"], ignore_index=True)
+            )
+            stage.rows = spins_hourly.shape[0]
         st.session_state.spins_hourly = spins_hourly
-        purchases = pd.read_excel(
-            uploaded_file, sheet_name="Purchases", dtype=str
-        ).sort_values(by=["date", "userId"], ignore_index=True)
+        with track_stage("step1.read_excel.purchases") as stage:
+            purchases = (
+                pd.read_excel(uploaded_file, sheet_name="Purchases", dtype=str)
+                .pipe(lambda df: df.assign(source_row=df.index + 2))
+                .sort_values(by=["date", "userId"], ignore_index=True)
+            )
+            stage.rows = purchases.shape[0]
         st.session_state.purchases = purchases
 
         # Table 1: Spins Hourly
@@ -81,6 +173,8 @@ def main():
             """
         )
 
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,44 @@
+import asyncio
+import os
 import streamlit as st
 import pandas as pd
+from prisma import Prisma
 from price_parser.parser import Price
+from utils.cache import LRUCache, memoize
+from utils.instrumentation import track_stage, render_metrics_sidebar
+from utils.fx import add_revenue_usd, lookup_rates
+from utils.quarantine import (
+    MISSING_FX_RATE,
+    UNPARSEABLE_DATE,
+    UNPARSEABLE_REVENUE,
+    UNPARSEABLE_TOTAL_SPINS,
+    parse_failures,
+    split_rejected,
+    with_records,
+)
+
+
+PIPELINE_CACHE_ENTRIES = int(os.environ.get("PIPELINE_CACHE_ENTRIES", "64"))
+PIPELINE_CACHE_MAX_BYTES = int(
+    os.environ.get("PIPELINE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+)
+PIPELINE_CACHE_TTL_SECONDS = float(os.environ.get("PIPELINE_CACHE_TTL_SECONDS", "3600"))
+
+
+@st.cache_resource
+def get_pipeline_cache() -> LRUCache:
+    """
+    The process-wide cache of the results of the helper functions below, shared by all sessions.
+    """
+    return LRUCache(
+        PIPELINE_CACHE_ENTRIES, PIPELINE_CACHE_TTL_SECONDS, PIPELINE_CACHE_MAX_BYTES
+    )
 
 
 ##############################
 # Helper functions
 ##############################
-@st.cache_data
+@memoize(get_pipeline_cache)
 def parse_datetime(column: pd.Series):
     """
     Firstly, try to parse the datetime column with the format `YYYY-MM-DD HH:MM:SS`.
@@ -26,29 +58,34 @@ def parse_datetime(column: pd.Series):
     return column
 
 
-@st.cache_data
-def parse_currency(revenue_str: str):
-    return Price.fromstring(revenue_str).currency
-
-
-@st.cache_data
-def parse_revenue(revenue_str: str):
-    return Price.fromstring(revenue_str).amount_float
+@memoize(get_pipeline_cache)
+def parse_prices(column: pd.Series):
+    """
+    The `currency` and `amount` of every revenue string of the column. Each distinct string is only parsed once.
+    """
+    prices = {s: Price.fromstring(s) for s in column.dropna().unique()}
+    return pd.DataFrame(
+        {
+            "currency": column.map(lambda s: prices[s].currency, na_action="ignore"),
+            "amount": column.map(lambda s: prices[s].amount_float, na_action="ignore"),
+        }
+    )
 
 
-@st.cache_data
+@memoize(get_pipeline_cache)
 def strip_whitespace(df: pd.DataFrame):
     """
     Only strip whitespaces for columns that are of type `object` and not the `date` column,
-    i.e. the column contains string values.
+    i.e. the column contains string values. Returns a stripped copy of `df`.
     """
+    df = df.copy()
     for column in df.columns:
         if column != "date" and df[column].dtype == "object":
             df[column] = df[column].str.strip()
     return df
 
 
-def main():
+async def main():
     ##############################
     # Page config
     ##############################
@@ -66,6 +103,16 @@ def main():
     ##############################
     st.header("Step 2: Validate and clean input data")
 
+    if "spill" in st.session_state:
+        st.info(
+            """
+            Streaming mode is on: the data was already validated and deduplicated chunk by chunk in Step 1,
+            with the same rules as below. Let's move on to Step 3 when you're ready.
+            """
+        )
+        render_metrics_sidebar()
+        st.stop()
+
     if "spins_hourly" and "purchases" not in st.session_state:
         st.error(
             """
@@ -74,10 +121,21 @@ def main():
         )
         st.stop()
 
+    prisma = Prisma()
+    await prisma.connect()
+
+    # The inputs of the cached helpers above only depend on the upload: they are keyed by its content hash,
+    # computed once in Step 1, instead of being fingerprinted on every run of the page
+    content_hash = st.session_state.get("content_hash")
+
+    def upload_key(name: str):
+        return None if content_hash is None else (content_hash, name)
+
     st.write("Here we have the tables containing the raw data we uploaded in Step 1:")
 
-    spins_hourly_df: pd.DataFrame = st.session_state.spins_hourly
-    purchases_df: pd.DataFrame = st.session_state.purchases
+    # Copies: the rows as uploaded are kept, to quarantine the rows failing validation with their raw values
+    spins_hourly_df: pd.DataFrame = st.session_state.spins_hourly.copy()
+    purchases_df: pd.DataFrame = st.session_state.purchases.copy()
 
     with st.expander("See raw data"):
         # Table 1: Spins Hourly
@@ -95,11 +153,25 @@ def main():
     st.write("First, we need to deduplicate the data on both tables:")
     with st.expander("""See tables after deduplication"""):
         # Deduplicate the data
-        spins_hourly_df["total_spins"] = spins_hourly_df["total_spins"].astype(float)
-        spins_hourly_df = spins_hourly_df.groupby(
-            ["date", "userId", "country"], as_index=False
-        ).sum()
-        purchases_df.drop_duplicates("transaction_id", inplace=True)
+        with track_stage("step2.dedup.spins_hourly") as stage:
+            total_spins = pd.to_numeric(spins_hourly_df["total_spins"], errors="coerce")
+            # Rows with missing keys or unparseable spins are kept, to be quarantined below
+            spins_hourly_df = (
+                spins_hourly_df.assign(
+                    total_spins=total_spins, unparseable_spins=total_spins.isna()
+                )
+                .groupby(["date", "userId", "country"], as_index=False, dropna=False)
+                .agg(
+                    total_spins=("total_spins", "sum"),
+                    unparseable_spins=("unparseable_spins", "max"),
+                    source_row=("source_row", "min"),
+                )
+            )
+            unparseable_spins = spins_hourly_df.pop("unparseable_spins")
+            stage.rows = spins_hourly_df.shape[0]
+        with track_stage("step2.dedup.purchases") as stage:
+            purchases_df.drop_duplicates("transaction_id", inplace=True)
+            stage.rows = purchases_df.shape[0]
 
         # Table 1: Spins Hourly
         st.caption("Table: Spins Hourly")
@@ -129,8 +201,18 @@ def main():
     )
     with st.expander("""See `date` columns after parsing"""):
         # Parse the date column
-        spins_hourly_df["date"] = parse_datetime(spins_hourly_df["date"])
-        purchases_df["date"] = parse_datetime(purchases_df["date"])
+        with track_stage("step2.parse_datetime.spins_hourly") as stage:
+            spins_hourly_raw_dates = spins_hourly_df["date"]
+            spins_hourly_df["date"] = parse_datetime(
+                spins_hourly_df["date"], key=upload_key("spins_hourly.date")
+            )
+            stage.rows = spins_hourly_df.shape[0]
+        with track_stage("step2.parse_datetime.purchases") as stage:
+            purchases_raw_dates = purchases_df["date"]
+            purchases_df["date"] = parse_datetime(
+                purchases_df["date"], key=upload_key("purchases.date")
+            )
+            stage.rows = purchases_df.shape[0]
 
         # Table 1: Spins Hourly
         st.caption("Table: Spins Hourly")
@@ -154,9 +236,11 @@ def main():
     )
     with st.expander("""See `total_spins` column after validating"""):
         # Round the total_spins column
-        spins_hourly_df["total_spins"] = (
-            spins_hourly_df["total_spins"].astype(float).round(0).astype(int)
-        )
+        with track_stage("step2.cast_total_spins") as stage:
+            spins_hourly_df["total_spins"] = (
+                spins_hourly_df["total_spins"].astype(float).round(0).astype("Int64")
+            )
+            stage.rows = spins_hourly_df.shape[0]
 
         # Table 1: Spins Hourly
         st.caption("Table: Spins Hourly")
@@ -175,12 +259,16 @@ def main():
     )
     with st.expander("""See `revenue` column after validating"""):
         # Extract the price and currency
-        purchases_df["currency"] = purchases_df.apply(
-            lambda row: parse_currency(row["revenue"]), axis=1
-        )
-        purchases_df["amount"] = purchases_df.apply(
-            lambda row: parse_revenue(row["revenue"]), axis=1
-        )
+        with track_stage("step2.extract_revenue") as stage:
+            prices = parse_prices(
+                purchases_df["revenue"], key=upload_key("purchases.revenue")
+            )
+            purchases_df["currency"] = prices["currency"]
+            purchases_df["amount"] = prices["amount"]
+            unparseable_revenue = parse_failures(
+                purchases_df["revenue"], purchases_df["amount"]
+            ) | parse_failures(purchases_df["revenue"], purchases_df["currency"])
+            stage.rows = purchases_df.shape[0]
 
         # Table 2: Purchases
         st.caption("Table: Purchases")
@@ -200,8 +288,14 @@ def main():
     )
     with st.expander("""See column names after validating"""):
         # Strip whitespaces
-        spins_hourly_df = strip_whitespace(spins_hourly_df)
-        purchases_df = strip_whitespace(purchases_df)
+        with track_stage("step2.strip_whitespace") as stage:
+            spins_hourly_df = strip_whitespace(
+                spins_hourly_df, key=upload_key("spins_hourly.strip")
+            )
+            purchases_df = strip_whitespace(
+                purchases_df, key=upload_key("purchases.strip")
+            )
+            stage.rows = spins_hourly_df.shape[0] + purchases_df.shape[0]
 
         # Rename the columns
         spins_hourly_df.rename(
@@ -226,6 +320,101 @@ def main():
         """
         )
 
+    st.subheader("6. Normalize revenue to USD")
+    st.write(
+        """
+        Purchases can be made in other currencies than USD, so we convert every `revenue` to USD into
+        a `revenue_usd` column, at the latest rate of the `fx_rates` table on or before the day of the purchase:
+        """
+    )
+    with st.expander("""See `revenue_usd` column after normalizing"""):
+        with track_stage("step2.normalize_revenue") as stage:
+            # Rates are looked up once per distinct (currency, day), then joined in a single merge
+            pairs = (
+                pd.DataFrame(
+                    {
+                        "currency": purchases_df["currency"],
+                        "day": purchases_df["date"].dt.floor("D"),
+                    }
+                )
+                .dropna()
+                .drop_duplicates()
+            )
+            rates = await lookup_rates(prisma, pairs)
+            purchases_df = add_revenue_usd(purchases_df, rates)
+            stage.rows = purchases_df.shape[0]
+
+        # Table 2: Purchases
+        st.caption("Table: Purchases")
+        st.write(purchases_df)
+
+    st.subheader("7. Quarantine the invalid rows")
+    st.write(
+        """
+        Finally, we check both tables against the constraints of their PSQL tables (required columns,
+        `VARCHAR` lengths, UUIDs, integer ranges, primary keys and `CHECK` constraints), compiled from
+        `prisma/schema.prisma` and the migrations, one vectorized operation per constraint.
+
+        The rows violating a constraint, or whose values couldn't be parsed above, are set aside with their
+        reasons and their row in the XLSX file, instead of failing the whole insert in Step 3. They are saved
+        to the `rejected_rows` table in Step 3, where they can be fixed and replayed on their own.
+        """
+    )
+    with track_stage("step2.quarantine") as stage:
+        spins_hourly_checked_df = spins_hourly_df
+        spins_hourly_df, rejected_spins_hourly = split_rejected(
+            spins_hourly_checked_df,
+            "spins_hourly",
+            {
+                UNPARSEABLE_DATE: parse_failures(
+                    spins_hourly_raw_dates, spins_hourly_df["date"]
+                ),
+                UNPARSEABLE_TOTAL_SPINS: unparseable_spins,
+            },
+        )
+        spins_hourly_df = spins_hourly_df.astype({"total_spins": int})
+        purchases_checked_df = purchases_df
+        purchases_df, rejected_purchases = split_rejected(
+            purchases_checked_df,
+            "purchases",
+            {
+                UNPARSEABLE_DATE: parse_failures(
+                    purchases_raw_dates, purchases_df["date"]
+                ),
+                UNPARSEABLE_REVENUE: unparseable_revenue,
+                MISSING_FX_RATE: purchases_df["revenue_usd"].isna()
+                & purchases_df[["date", "currency", "revenue"]].notna().all(axis=1),
+            },
+        )
+        rejected = pd.concat(
+            [
+                # Duplicated spins were summed: their record gets the total of the group
+                with_records(
+                    rejected_spins_hourly,
+                    st.session_state.spins_hourly,
+                    spins_hourly_checked_df.loc[
+                        rejected_spins_hourly.index, ["total_spins"]
+                    ],
+                ),
+                with_records(rejected_purchases, st.session_state.purchases),
+            ],
+            ignore_index=True,
+        )
+        stage.rows = spins_hourly_checked_df.shape[0] + purchases_checked_df.shape[0]
+    if rejected.empty:
+        st.success("All rows are valid.")
+    else:
+        st.warning(
+            f"""
+            {rejected.shape[0]} rows were quarantined, the other rows will be loaded in Step 3.
+            """
+        )
+        st.write(
+            rejected["reason"].str.split(", ").explode().value_counts().rename("rows")
+        )
+        with st.expander("See quarantined rows"):
+            st.write(rejected)
+
     st.write(
         "Before concluding this step, we need to save the validated data to st.session_state:"
     )
@@ -238,6 +427,7 @@ def main():
         )
     # Save purchases_df
     st.session_state.purchases_validated = purchases_df
+    st.session_state.rejected = rejected
     # Compare the two DataFrames to ensure they are the same
     if st.session_state.purchases_validated.compare(purchases_df).empty:
         st.success(
@@ -252,6 +442,21 @@ def main():
         """
     )
 
+    with st.expander("See the cache of the helper functions"):
+        cache = get_pipeline_cache()
+        hits, misses, hit_rate, entries, size = st.columns(5)
+        hits.metric("Hits", cache.stats.hits)
+        misses.metric("Misses", cache.stats.misses)
+        hit_rate.metric("Hit rate", f"{cache.stats.hit_rate:.0%}")
+        entries.metric("Entries", f"{len(cache)}/{cache.max_entries}")
+        size.metric("Size", f"{cache.bytes / 2**20:.1f} MiB")
+        st.caption(
+            f"At most {cache.max_bytes / 2**20:.0f} MiB. Entries expire after {cache.ttl_seconds:g}s "
+            f"({cache.stats.expirations} expired, {cache.stats.evictions} evicted so far)."
+        )
+
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
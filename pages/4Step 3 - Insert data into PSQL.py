@@ -1,7 +1,16 @@
 import streamlit as st
 import pandas as pd
 import asyncio
+import uuid
 from prisma import Prisma
+from utils.instrumentation import track_stage, render_metrics_sidebar
+from utils.fingerprint import fingerprint_frames
+from utils.jobs import get_job_runner, wait_for_job
+from utils.fetch import fetch_frame
+from utils.streaming import STREAM_PREVIEW_ROWS
+from utils.runs import get_run_id, ensure_run, drop_stale_runs
+from utils.quarantine import RAW_COLUMNS, replay
+from utils.ingest import find_ingest, ingest_job
 
 
 @st.cache_data
@@ -56,34 +65,142 @@ async def main():
         st.caption("Table: Purchases")
         st.write(purchases_validated_df)
 
+    # Every session loads into the tables of its own run (a `run_<run_id>` schema), so concurrent
+    # sessions don't overwrite each other's data. The run is promoted to the shared tables in Step 5.
+    await drop_stale_runs(prisma)
+    schema = await ensure_run(prisma, get_run_id())
+    st.info(
+        f"""
+        This session works on its own copy of the tables, in the schema `{schema}`. Once validated, 
+        you can promote them to the shared tables at the end of Step 5.
+        """
+    )
+
+    # Insert the data in a background job. Reruns of this page attach to the job already running
+    # for the same data, instead of starting over.
+    #
+    # Every workbook ingested into the run is recorded in the `ingest_log` table by the hash of its content:
+    # a workbook already ingested is skipped with a single lookup, and a workbook overlapping the ones before
+    # only adds the rows outside the time ranges they covered.
+    runner = get_job_runner()
+    spill = st.session_state.get("spill")
+    content_hash = st.session_state.get("content_hash") or fingerprint_frames(
+        spins_hourly_validated_df, purchases_validated_df
+    )
+    ingest = await find_ingest(prisma, schema, content_hash)
+    if ingest is not None and ingest.status == "done":
+        st.info(
+            f"""
+            This workbook was already ingested into `{schema}` at {ingest.created_at:%Y-%m-%d %H:%M:%S}
+            (in {ingest.load_seconds:.1f} s), so it isn't loaded again.
+            """
+        )
+        inserted = None
+    else:
+        # In streaming mode, the file spilled in Step 1 is loaded chunk by chunk. The rows quarantined
+        # in Step 2 are saved to the `rejected_rows` table with the load.
+        job = await runner.submit(
+            prisma,
+            "load",
+            f"{schema}:{content_hash}",
+            ingest_job,
+            schema,
+            content_hash,
+            st.session_state.get("file_name"),
+            spins_hourly_validated_df,
+            purchases_validated_df,
+            st.session_state.get("rejected") if spill is None else None,
+            spill["path"] if spill is not None else None,
+        )
+        job = await wait_for_job(prisma, job, "Inserting data")
+        inserted = runner.result(job.id)
+        if inserted is None:
+            # The result of a job is only kept in memory for a while: read the counts back from the log
+            ingest = await find_ingest(prisma, schema, content_hash)
+    if inserted is None:
+        inserted = {
+            "spins_hourly": ingest.spins_loaded,
+            "purchases": ingest.purchases_loaded,
+        }
+    with st.expander("See the workbooks ingested into this run"):
+        st.write(
+            pd.DataFrame(
+                await prisma.query_raw(
+                    "SELECT * FROM ingest_log WHERE schema_name = $1 ORDER BY created_at;",
+                    schema,
+                )
+            )
+        )
+
     st.subheader("1. Insert data into spins_hourly table")
     st.write("Firstly, we insert data into table `spins_hourly`:")
-    # Insert data into spins_hourly table
-    await prisma.spins_hourly.delete_many()
-    res1 = await prisma.spins_hourly.create_many(
-        spins_hourly_validated_df.to_dict("records")
-    )
-    st.success(f"Inserted {res1} rows into `spins_hourly` table.")
+    st.success(f"Inserted {inserted['spins_hourly']} rows into `spins_hourly` table.")
 
     st.subheader("2. Insert data into purchases table")
     st.write("Next, we insert data into table `purchases`:")
-    # Insert data into purchases table
-    await prisma.purchases.delete_many()
-    res2 = await prisma.purchases.create_many(purchases_validated_df.to_dict("records"))
-    st.success(f"Inserted {res2} rows into `purchases` table.")
+    st.success(f"Inserted {inserted['purchases']} rows into `purchases` table.")
 
-    st.subheader("3. Verify if data is inserted successfully via SQL")
-    spins_hourly_get_all_sql = """SELECT * FROM spins_hourly;"""
+    st.subheader("3. Fix and replay the quarantined rows")
+    quarantined = await prisma.rejected_rows.find_many(
+        where={"schema_name": schema, "status": "rejected"}, order={"id": "asc"}
+    )
+    if not quarantined:
+        st.success("No rows are quarantined.")
+    for table, columns in RAW_COLUMNS.items():
+        rows = [row for row in quarantined if row.table_name == table]
+        if not rows:
+            continue
+        st.write(
+            f"""
+            {len(rows)} rows of `{table}` were quarantined in Step 2. Fix their values below (as they would
+            be in the XLSX file), then replay them: the rows passing the validation of Step 2 are inserted
+            into `{table}`, the others stay quarantined with their new reasons.
+            """
+        )
+        fixed_df = st.data_editor(
+            pd.DataFrame(
+                [
+                    {
+                        "id": row.id,
+                        "source_row": row.source_row,
+                        "reason": row.reason,
+                        **{column: row.record.get(column) for column in columns},
+                    }
+                    for row in rows
+                ]
+            ),
+            disabled=["id", "source_row", "reason"],
+            hide_index=True,
+            key=f"quarantined_{table}",
+        )
+        if st.button(f"Replay the `{table}` rows", key=f"replay_{table}"):
+            with track_stage(f"step3.replay.{table}") as stage:
+                replayed, still_rejected = await replay(
+                    prisma, schema, table, fixed_df.drop(columns="reason")
+                )
+                stage.rows = replayed
+            if replayed and spill is not None:
+                # The tables changed: a new version of the data, for Step 4 to aggregate again
+                spill["version"] = uuid.uuid4().hex
+            st.success(f"Replayed {replayed} rows into `{table}`.")
+            if still_rejected:
+                st.warning(f"{still_rejected} rows are still invalid.")
+
+    st.subheader("4. Verify if data is inserted successfully via SQL")
+    # In streaming mode, only a preview of the tables is pulled into memory
+    limit = f" LIMIT {STREAM_PREVIEW_ROWS}" if spill is not None else ""
+    spins_hourly_get_all_sql = f"""SELECT * FROM {schema}.spins_hourly{limit};"""
     st.code(spins_hourly_get_all_sql)
     with st.expander("See spins_hourly table from DB"):
-        spins_hourly_from_db_df = await prisma.query_raw(spins_hourly_get_all_sql)
-        spins_hourly_from_db_df = pd.DataFrame(spins_hourly_from_db_df)
+        # Streamed from a server-side cursor into typed columns (e.g. `date` as datetime64)
+        spins_hourly_from_db_df = await fetch_frame(
+            spins_hourly_get_all_sql, categorical=["country"]
+        )
         st.write(spins_hourly_from_db_df)
-    purchases_get_all_sql = """SELECT * FROM purchases;"""
+    purchases_get_all_sql = f"""SELECT * FROM {schema}.purchases{limit};"""
     st.code(purchases_get_all_sql)
     with st.expander("See purchases table from DB"):
-        purchases_from_db_df = await prisma.query_raw(purchases_get_all_sql)
-        purchases_from_db_df = pd.DataFrame(purchases_from_db_df)
+        purchases_from_db_df = await fetch_frame(purchases_get_all_sql)
         st.write(purchases_from_db_df)
 
     st.write(
@@ -98,6 +215,13 @@ async def main():
         )
     # Save purchases_df
     st.session_state.purchases_from_db = purchases_from_db_df
+    # The version of the data in the run's tables, which Step 4 aggregates. It changes with every load
+    # or replay changing the tables (in streaming mode, only a preview is pulled, so the spill is used).
+    st.session_state.data_version = (
+        spill["version"]
+        if spill is not None
+        else fingerprint_frames(spins_hourly_from_db_df, purchases_from_db_df)
+    )
     # Compare the two DataFrames to ensure they are the same
     if st.session_state.purchases_from_db.compare(purchases_from_db_df).empty:
         st.success(
@@ -113,6 +237,8 @@ async def main():
         """
     )
 
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -2,6 +2,29 @@ import streamlit as st
 import pandas as pd
 import asyncio
 from prisma import Prisma
+from utils.instrumentation import track_stage, render_metrics_sidebar
+from utils.explain import PlanCapture
+from utils.jobs import ACTIVE_STATUSES, get_job_runner, wait_for_job
+from utils.aggregation import (
+    CTE_PURCHASES_QUERY,
+    JOIN_QUERY,
+    CTE_UNION_SPINS_PURCHASES_QUERY,
+    CTE_JOINED_QUERY,
+    CTE_TOTAL_DAILY_REVENUE_QUERY,
+    CTE_AGGREGATED_QUERY,
+    INSERT_INTO_AGGREGATED_QUERY,
+    aggregate_job,
+    aggregation_script,
+    latest_aggregation,
+    read_previews,
+)
+from utils.shadow import LOAD_MODE
+from utils.runs import get_run_id, run_schema
+from utils.rollups import ROLLUPS
+from utils.sketches import HLL_STANDARD_ERROR, REFRESH_USER_SKETCHES_QUERY
+from utils.engine import aggregate_frames, diff_aggregated
+from utils.streaming import STREAM_PREVIEW_ROWS
+from utils.fetch import fetch_frame
 
 
 @st.cache_data
@@ -43,6 +66,14 @@ async def main():
     with st.expander("See Prisma ORM schema"):
         st.code(read_prisma_schema())
 
+    # Optionally capture the execution plan of every query below
+    capture_plans = st.toggle(
+        "Capture query plans with `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)`",
+        help="Plans are stored in the `query_plans` table and compared with the previous run of the same query "
+        "in this session. "
+        "Applies to the next run of the aggregation.",
+    )
+
     st.write("Here we have the tables containing the data pulled from PSQL in Step 3:")
 
     spins_hourly_from_db_df: pd.DataFrame = st.session_state.spins_hourly_from_db
@@ -56,32 +87,77 @@ async def main():
         st.caption("Table: Purchases")
         st.write(purchases_from_db_df)
 
+    # Run all the queries below on the tables of this session's run, in a background job. Queries that
+    # don't depend on each other (e.g. `cte_total_daily_revenue` and `cte_joined`) run concurrently.
+    #
+    # The aggregation is tied to the version of the data loaded in Step 3, and only runs when asked to:
+    # reruns of this page (widgets, refreshes, coming back to it) attach to the job running for that version,
+    # or serve its result. Browsing the page never writes to the database.
+    schema = run_schema(get_run_id())
+    st.info(
+        f"The queries below run on this session's own copy of the tables, in the schema `{schema}`."
+    )
+    # In streaming mode, only a preview of each table is pulled into memory
+    spill = st.session_state.get("spill")
+    preview_limit = STREAM_PREVIEW_ROWS if spill is not None else None
+    job_key = f"{schema}:{st.session_state.data_version}"
+    runner = get_job_runner()
+    job = await latest_aggregation(prisma, schema)
+    if job is not None and (
+        job.job_key != job_key
+        # Left behind by a previous process of the app, it will never finish
+        or (job.status in ACTIVE_STATUSES and not runner.is_running(job.id))
+    ):
+        job = None
+    if job is None or job.status == "failed":
+        st.warning(
+            "The data loaded in Step 3 hasn't been aggregated yet."
+            if job is None
+            else "The last aggregation of the data loaded in Step 3 failed."
+        )
+    if st.button(
+        "Aggregate" if job is None else "Aggregate again",
+        type="primary",
+        disabled=job is not None and job.status in ACTIVE_STATUSES,
+    ):
+        job = await runner.submit(
+            prisma,
+            "aggregate",
+            job_key,
+            aggregate_job,
+            schema,
+            capture_plans,
+            preview_limit,
+            force=True,
+        )
+    if job is None:
+        st.stop()
+    job = await wait_for_job(prisma, job, "Aggregating data")
+    result = runner.result(job.id)
+    if result is None:
+        # Aggregated by a previous process, or dropped from memory since: read the tables it left behind
+        result = {
+            "previews": await read_previews(prisma, schema, preview_limit),
+            "plans": PlanCapture(prisma, False, schema),
+        }
+    previews, plans = result["previews"], result["plans"]
+
     st.write(
         """
     To calculate Total Daily Revenue per user, we need to find the hour of the day
     when the user made the purchase. For example, with the following purchase timestamp:
     `2022-04-01 10:16:26`, we need to transform it to `2022-04-01 10:00:00`, in order to join
-    this purchase with the spins_hourly table. We can do this with the following SQL query:
+    this purchase with the spins_hourly table.
+
+    This is already done in Step 3, which maintains the `purchases_hourly` table: one row per user and hour,
+    with the revenue summed and the purchases counted. A user with several purchases in an hour still
+    joins a single spins row, so the spins aren't counted once per purchase. We read it with the following SQL query:
     """
     )
-    await prisma.query_raw("DROP TABLE IF EXISTS cte_purchases;")
-    cte_purchases_query = """
-        -- Truncate `date` column by "hour" to transform `2022-04-01 0:10:39` to `2022-04-01 00:00:00`
-        -- Truncate `date` column by "day" to transform `2022-04-01 07:19:01` to `2022-04-01 00:00:00`
-        SELECT * INTO TEMP TABLE cte_purchases FROM (
-            SELECT 
-                DATE_TRUNC('hour', date) AS date_trunc,
-                DATE_TRUNC('day', date) AS day_trunc,
-                p.user_id,
-                p.revenue
-            FROM purchases p
-        );
-    """
-    st.code(cte_purchases_query, "sql")
-    await prisma.query_raw(cte_purchases_query)
-    cte_purchases = await prisma.query_raw("SELECT * FROM cte_purchases;")
+    st.code(CTE_PURCHASES_QUERY, "sql")
+    plans.render("cte_purchases")
     st.caption("Table: cte_purchases")
-    st.write(pd.DataFrame(cte_purchases))
+    st.write(pd.DataFrame(previews["cte_purchases"]))
 
     st.write(
         """
@@ -90,16 +166,10 @@ async def main():
     this problem in the following query:
     """
     )
-    join_query = """
-        SELECT *
-        FROM spins_hourly sh
-        FULL JOIN cte_purchases p
-        ON sh.date = p.date_trunc AND sh.user_id = p.user_id;
-    """
-    st.code(join_query, "sql")
-    join_df = await prisma.query_raw(join_query)
+    st.code(JOIN_QUERY, "sql")
+    plans.render("join_query")
     st.caption("Table: spins_hourly FULL JOIN cte_purchases")
-    st.write(pd.DataFrame(join_df))
+    st.write(pd.DataFrame(previews["join_query"]))
     st.write(
         """
     This problem also means we cannot insert data into `aggregated` table, since its primary keys are `[date, user_id]`, meaning
@@ -114,27 +184,10 @@ async def main():
     can do this with the following query:
     """
     )
-    await prisma.query_raw("DROP TABLE IF EXISTS cte_union_spins_purchases;")
-    cte_union_spins_purchases_query = """
-        SELECT * INTO TEMP TABLE cte_union_spins_purchases FROM (
-            SELECT
-                sh.date,
-                sh.user_id
-            FROM spins_hourly sh
-            UNION
-            SELECT
-                p.date_trunc,
-                p.user_id
-            FROM cte_purchases p
-        );
-    """
-    st.code(cte_union_spins_purchases_query, "sql")
-    await prisma.query_raw(cte_union_spins_purchases_query)
-    cte_union_spins_purchases = await prisma.query_raw(
-        "SELECT * FROM cte_union_spins_purchases;"
-    )
+    st.code(CTE_UNION_SPINS_PURCHASES_QUERY, "sql")
+    plans.render("cte_union_spins_purchases")
     st.caption("Table: cte_union_spins_purchases")
-    st.write(pd.DataFrame(cte_union_spins_purchases))
+    st.write(pd.DataFrame(previews["cte_union_spins_purchases"]))
 
     st.write(
         """
@@ -142,27 +195,10 @@ async def main():
     `cte_union_spins_purchases` with `spins_hourly` and `cte_purchases` tables. We can do this with the following query:
     """
     )
-    await prisma.query_raw("DROP TABLE IF EXISTS cte_joined;")
-    cte_joined_query = """
-        SELECT * INTO TEMP TABLE cte_joined FROM (
-            SELECT
-                u.date,
-                u.user_id,
-                sh.country,
-                sh.total_spins,
-                p.revenue
-            FROM cte_union_spins_purchases u
-            LEFT JOIN spins_hourly sh
-            ON u.date = sh.date AND u.user_id = sh.user_id
-            LEFT JOIN cte_purchases p
-            ON u.date = p.date_trunc AND u.user_id = p.user_id
-        );
-    """
-    st.code(cte_joined_query, "sql")
-    await prisma.query_raw(cte_joined_query)
-    cte_joined = await prisma.query_raw("SELECT * FROM cte_joined;")
+    st.code(CTE_JOINED_QUERY, "sql")
+    plans.render("cte_joined")
     st.caption("Table: cte_joined")
-    st.write(pd.DataFrame(cte_joined))
+    st.write(pd.DataFrame(previews["cte_joined"]))
 
     st.write(
         """
@@ -170,103 +206,47 @@ async def main():
     later. We can do this with the following query:
     """
     )
-    await prisma.query_raw("DROP TABLE IF EXISTS cte_total_daily_revenue;")
-    cte_total_daily_revenue_query = """
-        SELECT * INTO TEMP TABLE cte_total_daily_revenue FROM (
-            SELECT 
-                p.day_trunc,
-                p.user_id,
-                SUM(p.revenue) AS total_daily_revenue
-            FROM cte_purchases p
-            GROUP BY
-                p.day_trunc,
-                p.user_id
-        );
-    """
-    st.code(cte_total_daily_revenue_query, "sql")
-    await prisma.query_raw(cte_total_daily_revenue_query)
-    cte_total_daily_revenue = await prisma.query_raw(
-        """
-        SELECT * FROM cte_total_daily_revenue
-        ORDER BY user_id ASC, day_trunc ASC;
-        """
-    )
+    st.code(CTE_TOTAL_DAILY_REVENUE_QUERY, "sql")
+    plans.render("cte_total_daily_revenue")
     st.caption("Table: cte_total_daily_revenue")
-    st.write(pd.DataFrame(cte_total_daily_revenue))
+    st.write(pd.DataFrame(previews["cte_total_daily_revenue"]))
 
     st.write(
         """
     With everything in place, we can finally aggregate to get to our final table. We can do this with the following query:
     """
     )
-    await prisma.query_raw("DROP TABLE IF EXISTS cte_aggregated;")
-    cte_aggregated_query = """
-        SELECT * INTO TEMP TABLE cte_aggregated FROM (
-            SELECT
-                cte_joined.date,
-                cte_joined.user_id,
-                cte_joined.country AS country,
-                COALESCE(SUM(cte_joined.total_spins), 0) AS total_spins,
-                COALESCE(SUM(cte_joined.revenue), 0) AS total_revenue,
-                COUNT(cte_joined.revenue) AS total_purchases,
-                COALESCE(SUM(cte_joined.revenue) / COUNT(cte_joined.revenue), 0) AS avg_revenue_per_purchase,
-                cte_total_daily_revenue.total_daily_revenue
-            FROM cte_joined
-            LEFT JOIN cte_total_daily_revenue
-            ON DATE_TRUNC('day', cte_joined.date) = cte_total_daily_revenue.day_trunc 
-            AND cte_joined.user_id = cte_total_daily_revenue.user_id
-            GROUP BY
-                cte_joined.date,
-                cte_joined.user_id,
-                cte_joined.country,
-                cte_total_daily_revenue.total_daily_revenue
-            ORDER BY cte_joined.user_id ASC
-        );
-    """
-    st.code(cte_aggregated_query, "sql")
-    await prisma.query_raw(cte_aggregated_query)
-    cte_aggregated = await prisma.query_raw("SELECT * FROM cte_aggregated;")
+    st.code(CTE_AGGREGATED_QUERY, "sql")
+    plans.render("cte_aggregated")
     st.caption("Table: cte_aggregated")
-    st.write(pd.DataFrame(cte_aggregated))
+    st.write(pd.DataFrame(previews["cte_aggregated"]))
 
     st.write(
         """
     As you can see, we have successfully aggregated the data. We can now insert this data into the `aggregated` table:
     """
     )
-    await prisma.query_raw("DELETE FROM aggregated WHERE true;")
-    insert_intro_aggregated_query = """
-        INSERT INTO aggregated
-        (
-            date,
-            user_id,
-            country,
-            total_spins,
-            total_revenue,
-            total_purchases,
-            avg_revenue_per_purchase,
-            total_daily_revenue
+    st.code(INSERT_INTO_AGGREGATED_QUERY, "sql")
+    if LOAD_MODE == "shadow":
+        st.info(
+            """
+            The rows are inserted into a fresh `aggregated_shadow` table, which is then indexed and swapped in place
+            of `aggregated` with renames inside a short transaction. Readers never see a half-loaded `aggregated`
+            table, and no dead tuples are left behind for autovacuum.
+            """
         )
-        SELECT
-            date,
-            user_id,
-            country,
-            total_spins,
-            total_revenue,
-            total_purchases,
-            avg_revenue_per_purchase,
-            total_daily_revenue
-        FROM cte_aggregated;
-    """
-    st.code(insert_intro_aggregated_query, "sql")
-    await prisma.query_raw(insert_intro_aggregated_query)
-    aggregated = await prisma.query_raw("SELECT * FROM aggregated;")
+    plans.render("insert_aggregated")
+    aggregated = previews["insert_aggregated"]
     st.caption("Table: aggregated")
-    aggregated_df = pd.DataFrame(aggregated)
+    # Streamed from a server-side cursor into typed columns, so `date` is already a datetime64 column
+    # instead of an ISO 8601 string. The raw rows are kept to demonstrate the date format test failure in Step 5.
+    aggregated_df = await fetch_frame(
+        f"SELECT * FROM {schema}.aggregated"
+        + (f" LIMIT {STREAM_PREVIEW_ROWS}" if spill is not None else "")
+        + ";",
+        categorical=["country"],
+    )
     aggregated_expect_failure_df = pd.DataFrame(aggregated)
-    aggregated_df["date"] = pd.to_datetime(
-        aggregated_df["date"], format="ISO8601", utc=True
-    ).dt.strftime("%Y-%m-%d %H:%M:%S")
     st.write(aggregated_df)
 
     st.write(
@@ -276,6 +256,61 @@ async def main():
     """
     )
 
+    # Optionally recompute `aggregated` in-process and diff it against the SQL result (not in streaming
+    # mode, where neither the data nor `aggregated` is in memory). It starts from the rows pulled from the
+    # run's tables in Step 3, i.e. the data the SQL aggregated, including appended workbooks and replayed rows.
+    if spill is None and st.toggle(
+        "Cross-check against the in-process pandas engine",
+        help="Recomputes `aggregated` from the tables pulled from PSQL in Step 3 with vectorized merges and groupbys.",
+    ):
+        with track_stage("step4.pandas_engine") as stage:
+            aggregated_pandas_df = aggregate_frames(
+                spins_hourly_from_db_df, purchases_from_db_df
+            )
+            stage.rows = aggregated_pandas_df.shape[0]
+        st.caption(
+            f"Table: aggregated (pandas engine, {stage.wall_seconds * 1000:.0f} ms)"
+        )
+        st.write(aggregated_pandas_df)
+        diff_df = diff_aggregated(pd.DataFrame(aggregated), aggregated_pandas_df)
+        if diff_df.empty:
+            st.success(
+                "The pandas engine and the SQL produce the same `aggregated` rows."
+            )
+        else:
+            st.error(
+                f"The pandas engine and the SQL disagree on {diff_df.shape[0]} rows:"
+            )
+            st.write(diff_df)
+
+    st.write(
+        """
+    Finally, `aggregated` is rolled up into smaller tables (day × country, week × country and day × user),
+    so dashboard queries don't have to scan the hourly table. The rollups are refreshed concurrently:
+    """
+    )
+    for rollup in ROLLUPS:
+        if rollup.refresh_query is None:
+            continue
+        st.code(rollup.refresh_query, "sql")
+        plans.render(rollup.table)
+        st.caption(f"Table: {rollup.table}")
+        st.write(pd.DataFrame(previews[rollup.table]))
+
+    st.write(
+        f"""
+    Distinct users can't be summed across days or countries, so `spins_hourly` and `purchases` are also
+    summarized into a HyperLogLog sketch of the users of every day, country and kind (spinners and payers),
+    in `user_sketches`. Sketches merge into the sketch of any week, month or set of countries, which answers
+    "how many distinct users" in constant time, within ±{HLL_STANDARD_ERROR:.1%} (one standard error):
+    """
+    )
+    st.code(REFRESH_USER_SKETCHES_QUERY, "sql")
+    plans.render("user_sketches")
+    st.caption("Table: user_sketches (non-empty registers per sketch)")
+    st.write(pd.DataFrame(previews["user_sketches"]))
+    plans.render_summary()
+
     st.write(
         "Before concluding this step, we need to save the aggregated to st.session_state:"
     )
@@ -288,120 +323,14 @@ async def main():
     if st.session_state.aggregated.compare(aggregated_df).empty:
         st.success("Saved `aggregated_df` to st.session_state.aggregated successfully!")
 
-    with st.expander("See all of the above queries in one single SQL query"):
-        st.code(
-            """
-        -- Truncate `date` column by "hour" to transform `2022-04-01 0:10:39` to `2022-04-01 00:00:00`
-        -- Truncate `date` column by "day" to transform `2022-04-01 07:19:01` to `2022-04-01 00:00:00`
-        DROP TABLE IF EXISTS cte_purchases;
-        SELECT * INTO TEMP TABLE cte_purchases FROM (
-            SELECT 
-                DATE_TRUNC('hour', date) AS date_trunc,
-                DATE_TRUNC('day', date) AS day_trunc,
-                p.user_id,
-                p.revenue
-            FROM purchases p
-        );
-
-        -- Union (distinct) the values of `spins_hourly` table with `cte_purchases` to get
-        -- the list of all possible values of the 2 tables, ready for LEFT JOIN.
-        DROP TABLE IF EXISTS cte_union_spins_purchases;
-        SELECT * INTO TEMP TABLE cte_union_spins_purchases FROM (
-            SELECT
-                sh.date,
-                sh.user_id
-            FROM spins_hourly sh
-            UNION
-            SELECT
-                p.date_trunc,
-                p.user_id
-            FROM cte_purchases p
-        );
-
-        -- Left join the unioned table above with `spins_hourly` and `cte_purchases` tables
-        -- to get spins and revenue data.
-        DROP TABLE IF EXISTS cte_joined;
-        SELECT * INTO TEMP TABLE cte_joined FROM (
-            SELECT
-                u.date,
-                u.user_id,
-                sh.country,
-                sh.total_spins,
-                p.revenue
-            FROM cte_union_spins_purchases u
-            LEFT JOIN spins_hourly sh
-            ON u.date = sh.date AND u.user_id = sh.user_id
-            LEFT JOIN cte_purchases p
-            ON u.date = p.date_trunc AND u.user_id = p.user_id
-        );
-
-        -- Calculate Total Daily Revenue per user from cte_purchases
-        DROP TABLE IF EXISTS cte_total_daily_revenue;
-        SELECT * INTO TEMP TABLE cte_total_daily_revenue FROM (
-            SELECT 
-                p.day_trunc,
-                p.user_id,
-                SUM(p.revenue) AS total_daily_revenue
-            FROM cte_purchases p
-            GROUP BY
-                p.day_trunc,
-                p.user_id
-        );
-
-        -- Aggregate
-        DROP TABLE IF EXISTS cte_aggregated;
-        SELECT * INTO TEMP TABLE cte_aggregated FROM (
-            SELECT
-                cte_joined.date,
-                cte_joined.user_id,
-                cte_joined.country AS country,
-                SUM(cte_joined.total_spins) AS total_spins,
-                SUM(cte_joined.revenue) AS total_revenue,
-                COUNT(cte_joined.revenue) AS total_purchases,
-                SUM(cte_joined.revenue) / COUNT(cte_joined.revenue) AS avg_revenue_per_purchase,
-                cte_total_daily_revenue.total_daily_revenue
-            FROM cte_joined
-            LEFT JOIN cte_total_daily_revenue
-            ON DATE_TRUNC('day', cte_joined.date) = cte_total_daily_revenue.day_trunc AND cte_joined.user_id = cte_total_daily_revenue.user_id
-            GROUP BY
-                cte_joined.date,
-                cte_joined.user_id,
-                cte_joined.country,
-                cte_total_daily_revenue.total_daily_revenue
-            ORDER BY cte_joined.user_id ASC
-        );
-
-        -- Insert into table `aggregated`
-        DELETE FROM aggregated WHERE true;
-        INSERT INTO aggregated
-        (
-            date,
-            user_id,
-            country,
-            total_spins,
-            total_revenue,
-            total_purchases,
-            avg_revenue_per_purchase,
-            total_daily_revenue
-        )
-        SELECT
-            date,
-            user_id,
-            country,
-            total_spins,
-            total_revenue,
-            total_purchases,
-            avg_revenue_per_purchase,
-            total_daily_revenue
-        FROM cte_aggregated;
-
-        SELECT * FROM aggregated;
-        """,
-            "sql",
-        )
+    with st.expander("See all of the above queries in one single SQL script"):
+        # Generated from the stages, so it's exactly what the job runs (sequentially here)
+        st.code(aggregation_script(), "sql")
 
     st.write("""Let's move on to Step 5 when you're ready.""")
 
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
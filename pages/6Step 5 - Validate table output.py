@@ -7,6 +7,11 @@ import pandas as pd
 import sys
 import inspect
 from unittest import IsolatedAsyncioTestCase
+from utils.instrumentation import track_stage, render_metrics_sidebar
+from utils.runs import run_schema, promote_run
+from utils.lookup import get_lookup_cache
+from utils.export import render_export
+from utils.partitions import test_hash, validate_partitions
 
 sys.tracebacklimit = 0
 
@@ -25,9 +30,14 @@ class TestDataValidation(unittest.TestCase):
     A collection of unit tests for validating the data in the aggregated table.
     """
 
+    # When set, the tests run on this frame (e.g. a single day partition) instead of the whole table
+    frame: pd.DataFrame | None = None
+
     def setUp(self):
         # Load the aggregated table from Step 4
-        self.df: pd.DataFrame = st.session_state.aggregated
+        self.df: pd.DataFrame = (
+            st.session_state.aggregated if self.frame is None else self.frame
+        )
         self.df_expect_failure: pd.DataFrame = (
             st.session_state.aggregated_expect_failure
         )
@@ -116,13 +126,14 @@ class TestDataValidation(unittest.TestCase):
         """
         # Load purchases_from_db_df from st.session_state from Step 3
         purchases_from_db_df: pd.DataFrame = st.session_state.purchases_from_db
-        purchases_from_db_df["day"] = pd.to_datetime(
-            purchases_from_db_df["date"]
-        ).dt.date
+        # `total_daily_revenue` is in USD: sum the normalized `revenue_usd`, not the native `revenue`
         agg_purchases_from_db_df = (
-            purchases_from_db_df.groupby(["day", "user_id"], as_index=False)
-            .sum()[["day", "user_id", "revenue"]]
-            .rename(columns={"revenue": "total_daily_revenue"})
+            purchases_from_db_df.assign(
+                day=pd.to_datetime(purchases_from_db_df["date"]).dt.date
+            )
+            .groupby(["day", "user_id"], as_index=False)["revenue_usd"]
+            .sum()
+            .rename(columns={"revenue_usd": "total_daily_revenue"})
         )
 
         # Get distinct values of "date" and "user_id" and "total_daily_revenue" from aggregated table
@@ -153,7 +164,9 @@ class TestDataValidation(unittest.TestCase):
 def run_single_test(test_name: str):
     singletest = unittest.TestSuite()
     singletest.addTest(TestDataValidation(test_name))
-    run = unittest.TextTestRunner().run(singletest)
+    with track_stage(f"step5.{test_name}") as stage:
+        run = unittest.TextTestRunner().run(singletest)
+        stage.rows = st.session_state.aggregated.shape[0]
     # Return test result
     return {
         "successful": run.wasSuccessful(),
@@ -162,6 +175,39 @@ def run_single_test(test_name: str):
     }
 
 
+# The tests only looking at one row at a time, whose verdict on a table is the verdicts on its day partitions
+PARTITIONED_TESTS = [
+    "test_date_formats",
+    "test_non_null_values_in_required_columns",
+    "test_positive_values_for_numeric_columns",
+    "test_string_field_lengths",
+    "test_revenue_purchase_relationship",
+]
+
+
+def run_partition_test(test_name: str, partition: pd.DataFrame):
+    test = TestDataValidation(test_name)
+    test.frame = partition
+    result = unittest.TestResult()
+    test.run(result)
+    details = "\n".join(trace for _, trace in result.errors + result.failures)
+    return result.wasSuccessful(), details
+
+
+def partition_verdict(partition_results: pd.DataFrame, test_name: str) -> dict:
+    """
+    The verdict of a test on the whole table, from its verdicts on the day partitions.
+    """
+    results = partition_results[partition_results["test_name"] == test_name]
+    return {
+        "successful": bool(results["successful"].all()),
+        "partitions": results.shape[0],
+        "validated": int((~results["cached"]).sum()),
+        "reused": int(results["cached"].sum()),
+        "failures": results.loc[~results["successful"], "details"].tolist(),
+    }
+
+
 async def main():
     ##############################
     # Page config
@@ -206,6 +252,35 @@ async def main():
         st.caption("Table: aggregated")
         st.write(aggregated_df)
 
+    # Tests 1 to 5 run day partition by day partition, and only on the partitions that changed (see the
+    # "Incremental validation by day partition" section below). In streaming mode, only a sample of
+    # `aggregated` is in memory, so there are no partitions to validate: the sample is tested as a whole.
+    streaming = "spill" in st.session_state
+    revalidate = st.button(
+        "Revalidate everything",
+        help="Runs every test on every day partition again, instead of reusing the verdicts of the partitions "
+        "that didn't change.",
+    )
+    partition_results = None
+    if not streaming:
+        with track_stage("step5.incremental") as stage:
+            partition_results = await validate_partitions(
+                prisma,
+                aggregated_df,
+                {
+                    name: test_hash(getattr(TestDataValidation, name))
+                    for name in PARTITIONED_TESTS
+                },
+                run_partition_test,
+                force=revalidate,
+            )
+            stage.rows = int((~partition_results["cached"]).sum())
+
+    def verdict(test_name: str) -> dict:
+        if partition_results is None:
+            return run_single_test(test_name)
+        return partition_verdict(partition_results, test_name)
+
     st.subheader("List of possible output data validation tests:")
     with st.expander("See the whole unittest suite"):
         st.code(
@@ -221,8 +296,8 @@ async def main():
         inspect.getsource(TestDataValidation.test_date_formats),
         "python",
     )
-    st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_date_formats"))
+    st.write("Result of this test on the day partitions of `aggregated_df`:")
+    st.write(verdict("test_date_formats"))
 
     st.checkbox(
         "Test 2: Testing if the primary keys `[date, user_id]` have `null` values",
@@ -232,8 +307,8 @@ async def main():
         inspect.getsource(TestDataValidation.test_non_null_values_in_required_columns),
         "python",
     )
-    st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_non_null_values_in_required_columns"))
+    st.write("Result of this test on the day partitions of `aggregated_df`:")
+    st.write(verdict("test_non_null_values_in_required_columns"))
 
     st.checkbox(
         "Test 3: Testing positive values for numeric fields `[total_spins, revenue]`",
@@ -252,8 +327,8 @@ async def main():
         inspect.getsource(TestDataValidation.test_positive_values_for_numeric_columns),
         "python",
     )
-    st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_positive_values_for_numeric_columns"))
+    st.write("Result of this test on the day partitions of `aggregated_df`:")
+    st.write(verdict("test_positive_values_for_numeric_columns"))
 
     st.checkbox(
         "Test 4: Testing values in string fields `[user_id, country]` are within expected limits",
@@ -271,8 +346,8 @@ async def main():
         inspect.getsource(TestDataValidation.test_string_field_lengths),
         "python",
     )
-    st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_string_field_lengths"))
+    st.write("Result of this test on the day partitions of `aggregated_df`:")
+    st.write(verdict("test_string_field_lengths"))
 
     st.checkbox(
         "Test 5: Testing relationship between `total_revenue` and `total_purchases`",
@@ -282,8 +357,8 @@ async def main():
         inspect.getsource(TestDataValidation.test_revenue_purchase_relationship),
         "python",
     )
-    st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_revenue_purchase_relationship"))
+    st.write("Result of this test on the day partitions of `aggregated_df`:")
+    st.write(verdict("test_revenue_purchase_relationship"))
 
     st.checkbox(
         "Test 6: Test if the sum of `total_revenue` for each `user_id` each day is equal to `total_daily_revenue`",
@@ -296,7 +371,21 @@ async def main():
         "python",
     )
     st.write("Example of this test running on `aggregated_df`:")
-    st.write(run_single_test("test_consistency_total_daily_revenue_by_user_id"))
+    # It compares `aggregated` with `purchases`, so it isn't partitioned: it runs on the whole table once per
+    # version of the data (or when revalidating), and its verdict is kept for the reruns of the page
+    consistency = st.session_state.get("consistency_verdict")
+    if (
+        revalidate
+        or streaming
+        or consistency is None
+        or consistency[0] != st.session_state.get("data_version")
+    ):
+        consistency = (
+            st.session_state.get("data_version"),
+            run_single_test("test_consistency_total_daily_revenue_by_user_id"),
+        )
+        st.session_state.consistency_verdict = consistency
+    st.write(consistency[1])
 
     st.write(
         """
@@ -381,7 +470,8 @@ async def main():
     )
     st.info(
         """
-        You can actually see this fix in action in the `Step 4 - Aggregate data.py` file, line `267-269`.
+        In `Step 4 - Aggregate data.py`, the `aggregated` table is fetched with typed columns instead
+        (see `utils/fetch.py`), so the `date` column is already a datetime column and never needs parsing.
         """,
     )
     st.write(
@@ -389,7 +479,71 @@ async def main():
         After fixing the problem, we can see that the test passes:
         """,
     )
-    st.write(run_single_test("test_date_formats"))
+    st.write(verdict("test_date_formats"))
+
+    st.subheader("Incremental validation by day partition")
+    st.write(
+        """
+        Tests 1 to 5 only look at one row at a time, so they run day partition by day partition: every
+        partition has a content checksum, and its verdicts are kept in the `validation_results` table. Only
+        the partitions whose checksum (or the test code) changed since they were last validated are tested
+        again, the verdicts of the others are reused. `Revalidate everything` at the top tests them all again.
+        """
+    )
+    if partition_results is None:
+        st.info(
+            "Streaming mode is on: only a sample of `aggregated` is in memory, so it was tested as a whole."
+        )
+    else:
+        summary = partition_results.groupby("test_name", sort=False).agg(
+            partitions=("day", "size"),
+            validated=("cached", lambda cached: int((~cached).sum())),
+            reused=("cached", "sum"),
+            failed=("successful", lambda successful: int((~successful).sum())),
+        )
+        st.write(summary)
+        failed = partition_results[~partition_results["successful"]]
+        if failed.empty:
+            st.success("All day partitions passed.")
+        else:
+            st.error(f"{failed['day'].nunique()} day partitions failed:")
+            st.write(failed[["test_name", "day", "details"]])
+
+    st.subheader("Export the aggregated table")
+    st.write(
+        """
+        The validated `aggregated` table can be exported to a Parquet or gzipped CSV file, streamed from
+        PostgreSQL with `COPY ... TO STDOUT`, optionally filtered by date range and countries:
+        """
+    )
+    if "run_id" in st.session_state:
+        await render_export(
+            f"{run_schema(st.session_state.run_id)}.aggregated", "export_run"
+        )
+    else:
+        await render_export("public.aggregated", "export_run")
+
+    st.subheader("Promote this run to the shared tables")
+    st.write(
+        """
+        So far, this session has only been working on its own copy of the `spins_hourly`, `purchases` and
+        `aggregated` tables. Once the tests pass, we can promote them to the shared tables: in a single
+        transaction, the rows of the days and users of this run replace theirs in the shared tables, and the
+        rollups of those days are recomputed. The rows other sessions promoted for other days or users are kept.
+        """
+    )
+    if "run_id" in st.session_state:
+        run_id = st.session_state.run_id
+        if st.button(f"Promote `{run_schema(run_id)}` to the shared tables"):
+            await promote_run(prisma, run_id)
+            # The cached lookups read rows that were just replaced
+            get_lookup_cache().clear()
+            # The run is over: the next load in Step 3 starts a new one
+            for key in ["spins_hourly_from_db", "purchases_from_db"]:
+                st.session_state.pop(key, None)
+            st.success(f"Promoted `{run_schema(run_id)}` to the shared tables.")
+    else:
+        st.info("This session's run has already been promoted.")
 
     st.write(
         """
@@ -404,6 +558,8 @@ async def main():
     # conclusion after finishing all the steps above.
     st.session_state.conclusion_ready = True
 
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
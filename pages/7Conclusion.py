@@ -1,5 +1,13 @@
 import asyncio
+import datetime
 import streamlit as st
+import pandas as pd
+from prisma import Prisma
+from utils.instrumentation import render_metrics_sidebar
+from utils.rollups import query_metrics
+from utils.sketches import HLL_STANDARD_ERROR, SKETCH_KINDS, distinct_users
+from utils.export import render_export
+from utils.archive import ARCHIVE_HORIZON_DAYS, render_archive
 
 
 async def main():
@@ -58,6 +66,106 @@ async def main():
         """
     )
 
+    ##############################
+    # Explore the metrics
+    ##############################
+    st.subheader("Explore the metrics")
+    st.write(
+        """
+        Query the promoted tables. Each query is answered by the coarsest table that can answer it:
+        the week × country or day × country rollups, the day × user rollup, or the hourly `aggregated` table.
+        """
+    )
+    grain = st.selectbox("Grain", ["day", "week", "month", "hour"])
+    group_by = st.multiselect("Group by", ["country", "user_id"])
+    dates = st.date_input(
+        "Date range",
+        (datetime.date.today() - datetime.timedelta(days=30), datetime.date.today()),
+    )
+    # Only the start date is set while the range is being picked
+    if len(dates) != 2:
+        st.stop()
+    start, end = dates
+    countries = st.text_input("Countries (comma-separated, optional)")
+    user_ids = st.text_input("User IDs (comma-separated, optional)")
+
+    prisma = Prisma()
+    await prisma.connect()
+    table, rows = await query_metrics(
+        prisma,
+        grain,
+        group_by,
+        start=datetime.datetime.combine(start, datetime.time()),
+        end=datetime.datetime.combine(
+            end + datetime.timedelta(days=1), datetime.time()
+        ),
+        countries=[c.strip() for c in countries.split(",") if c.strip()],
+        user_ids=[u.strip() for u in user_ids.split(",") if u.strip()],
+    )
+    st.caption(f"Answered from: `{table}`")
+    st.write(pd.DataFrame(rows))
+
+    ##############################
+    # Distinct users
+    ##############################
+    st.subheader("Count the distinct users")
+    st.write(
+        f"""
+        Daily, weekly or monthly active users over the same date range and countries, estimated by merging
+        the HyperLogLog sketches of `user_sketches`, within ±{2 * HLL_STANDARD_ERROR:.1%} 95% of the time
+        (`margin`):
+        """
+    )
+    users_grain = st.selectbox("Per", ["day", "week", "month"])
+    by_country = st.checkbox("By country")
+    kinds = st.multiselect("Users who", SKETCH_KINDS, default=SKETCH_KINDS)
+    st.write(
+        await distinct_users(
+            prisma,
+            users_grain,
+            by_country,
+            start=datetime.datetime.combine(start, datetime.time()),
+            end=datetime.datetime.combine(
+                end + datetime.timedelta(days=1), datetime.time()
+            ),
+            countries=[c.strip() for c in countries.split(",") if c.strip()],
+            kinds=kinds,
+        )
+    )
+
+    ##############################
+    # Archive
+    ##############################
+    st.subheader("Archive the old raw data")
+    st.write(
+        f"""
+        `spins_hourly` and `purchases` only grow, while only recent days are aggregated again. The rows of the days
+        more than {ARCHIVE_HORIZON_DAYS} days (`ARCHIVE_HORIZON_DAYS`) before the newest one can be moved to
+        day-partitioned Parquet files on the server (or from a shell: `python -m utils.archive --help`), so the
+        tables and their indexes stay small. `aggregated` can still be recomputed over the date range above,
+        in-process, from the archived and the remaining rows:
+        """
+    )
+    await render_archive(
+        "archive_conclusion",
+        datetime.datetime.combine(start, datetime.time()),
+        datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()),
+    )
+
+    ##############################
+    # Export
+    ##############################
+    st.subheader("Export the metrics")
+    st.write(
+        """
+        Export the promoted `aggregated` table to a Parquet or gzipped CSV file on the server
+        (or from a shell: `python -m utils.export --help`):
+        """
+    )
+    await render_export("public.aggregated", "export_conclusion")
+
+    render_metrics_sidebar()
+
 
 if __name__ == "__main__":
     asyncio.run(main())
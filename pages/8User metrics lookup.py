@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+import time
+import streamlit as st
+import pandas as pd
+from prisma import Prisma
+from utils.instrumentation import render_metrics_sidebar
+from utils.lookup import get_lookup_cache, user_metrics
+
+
+async def main():
+    ##############################
+    # Page config
+    ##############################
+    title = "User metrics lookup | PlayStudios - DE Home Assignment - Daniel Nguyen"
+    st.set_page_config(
+        page_title=title,
+        page_icon="🎲",
+    )
+    st.sidebar.info(title)
+
+    ##############################
+    # Main content
+    ##############################
+    st.header("User metrics lookup")
+    st.write(
+        """
+        Fetch the hourly or daily metrics of one user over a date range from the shared `aggregated` table
+        (i.e. the last promoted run). The lookups are parameterized range scans of the `(user_id, date)` index,
+        and their results are cached in-process for a short while.
+        """
+    )
+
+    user_id = st.text_input("User ID", placeholder="e.g. 1000001")
+    grain = st.radio("Grain", ["hourly", "daily"], horizontal=True)
+    dates = st.date_input(
+        "Date range",
+        (datetime.date.today() - datetime.timedelta(days=7), datetime.date.today()),
+    )
+    # Only the start date is set while the range is being picked
+    if not user_id or len(dates) != 2:
+        st.stop()
+    start, end = dates
+
+    prisma = Prisma()
+    await prisma.connect()
+    started = time.perf_counter()
+    rows = await user_metrics(
+        prisma,
+        user_id.strip(),
+        grain,
+        datetime.datetime.combine(start, datetime.time()),
+        datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()),
+    )
+    latency_ms = (time.perf_counter() - started) * 1000
+
+    st.caption(f"{len(rows)} rows in {latency_ms:.1f} ms")
+    st.write(pd.DataFrame(rows))
+
+    ##############################
+    # Cache metrics
+    ##############################
+    cache = get_lookup_cache()
+    st.subheader("Cache")
+    hits, misses, hit_rate, entries = st.columns(4)
+    hits.metric("Hits", cache.stats.hits)
+    misses.metric("Misses", cache.stats.misses)
+    hit_rate.metric("Hit rate", f"{cache.stats.hit_rate:.0%}")
+    entries.metric("Entries", f"{len(cache)}/{cache.max_entries}")
+    st.caption(
+        f"Entries expire after {cache.ttl_seconds:g}s "
+        f"({cache.stats.expirations} expired, {cache.stats.evictions} evicted so far)."
+    )
+
+    render_metrics_sidebar()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,15 @@
+-- CreateTable
+CREATE TABLE "query_plans" (
+    "id" SERIAL NOT NULL,
+    "run_id" UUID NOT NULL,
+    "query_name" VARCHAR(64) NOT NULL,
+    "plan_hash" VARCHAR(40) NOT NULL,
+    "execution_ms" DOUBLE PRECISION NOT NULL,
+    "plan" JSONB NOT NULL,
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "query_plans_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "query_plans_query_name_created_at_idx" ON "query_plans"("query_name", "created_at");
@@ -0,0 +1,17 @@
+-- CreateTable
+CREATE TABLE "jobs" (
+    "id" UUID NOT NULL,
+    "kind" VARCHAR(32) NOT NULL,
+    "job_key" VARCHAR(128) NOT NULL,
+    "status" VARCHAR(16) NOT NULL DEFAULT 'queued',
+    "progress" DOUBLE PRECISION NOT NULL DEFAULT 0,
+    "message" TEXT,
+    "error" TEXT,
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" TIMESTAMP(6) NOT NULL,
+
+    CONSTRAINT "jobs_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "jobs_kind_job_key_created_at_idx" ON "jobs"("kind", "job_key", "created_at");
@@ -0,0 +1,14 @@
+-- CreateTable
+CREATE TABLE "load_progress" (
+    "load_id" VARCHAR(40) NOT NULL,
+    "table_name" VARCHAR(64) NOT NULL,
+    "status" VARCHAR(16) NOT NULL DEFAULT 'running',
+    "batches_done" INTEGER NOT NULL DEFAULT 0,
+    "rows_done" INTEGER NOT NULL DEFAULT 0,
+    "rows_total" INTEGER NOT NULL,
+    "max_batch_bytes" INTEGER NOT NULL,
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updated_at" TIMESTAMP(6) NOT NULL,
+
+    CONSTRAINT "load_progress_pkey" PRIMARY KEY ("load_id","table_name")
+);
@@ -0,0 +1,10 @@
+-- CreateTable
+CREATE TABLE "runs" (
+    "id" VARCHAR(12) NOT NULL,
+    "schema_name" VARCHAR(63) NOT NULL,
+    "status" VARCHAR(16) NOT NULL DEFAULT 'active',
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "promoted_at" TIMESTAMP(6),
+
+    CONSTRAINT "runs_pkey" PRIMARY KEY ("id")
+);
@@ -0,0 +1,33 @@
+-- CreateTable
+CREATE TABLE "aggregated_weekly_country" (
+    "week" TIMESTAMP(6) NOT NULL,
+    "country" VARCHAR(2) NOT NULL,
+    "total_spins" BIGINT NOT NULL,
+    "total_revenue" DOUBLE PRECISION NOT NULL,
+    "total_purchases" BIGINT NOT NULL,
+
+    CONSTRAINT "aggregated_weekly_country_pkey" PRIMARY KEY ("week","country")
+);
+
+-- CreateTable
+CREATE TABLE "aggregated_daily_country" (
+    "day" TIMESTAMP(6) NOT NULL,
+    "country" VARCHAR(2) NOT NULL,
+    "total_spins" BIGINT NOT NULL,
+    "total_revenue" DOUBLE PRECISION NOT NULL,
+    "total_purchases" BIGINT NOT NULL,
+
+    CONSTRAINT "aggregated_daily_country_pkey" PRIMARY KEY ("day","country")
+);
+
+-- CreateTable
+CREATE TABLE "aggregated_daily_user" (
+    "day" TIMESTAMP(6) NOT NULL,
+    "user_id" VARCHAR(7) NOT NULL,
+    "country" VARCHAR(2) NOT NULL,
+    "total_spins" BIGINT NOT NULL,
+    "total_revenue" DOUBLE PRECISION NOT NULL,
+    "total_purchases" BIGINT NOT NULL,
+
+    CONSTRAINT "aggregated_daily_user_pkey" PRIMARY KEY ("day","user_id","country")
+);
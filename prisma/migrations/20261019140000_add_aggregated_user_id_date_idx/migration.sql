@@ -0,0 +1,2 @@
+-- CreateIndex
+CREATE INDEX "aggregated_user_id_date_idx" ON "aggregated"("user_id", "date");
@@ -0,0 +1,13 @@
+-- CreateTable
+CREATE TABLE "fx_rates" (
+    "currency" VARCHAR(3) NOT NULL,
+    "day" DATE NOT NULL,
+    "rate_to_usd" DOUBLE PRECISION NOT NULL,
+
+    CONSTRAINT "fx_rates_pkey" PRIMARY KEY ("currency","day")
+);
+ALTER TABLE "fx_rates" ADD CONSTRAINT "rate_to_usd" CHECK ("rate_to_usd" > 0);
+
+-- AlterTable
+ALTER TABLE "purchases" ADD COLUMN "revenue_usd" DOUBLE PRECISION;
+UPDATE "purchases" SET "revenue_usd" = "revenue" WHERE "currency" = 'USD';
@@ -0,0 +1,12 @@
+-- CreateTable
+CREATE TABLE "validation_results" (
+    "test_name" VARCHAR(128) NOT NULL,
+    "test_hash" VARCHAR(40) NOT NULL,
+    "day" DATE NOT NULL,
+    "checksum" VARCHAR(24) NOT NULL,
+    "successful" BOOLEAN NOT NULL,
+    "details" TEXT NOT NULL,
+    "validated_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "validation_results_pkey" PRIMARY KEY ("test_name","test_hash","day","checksum")
+);
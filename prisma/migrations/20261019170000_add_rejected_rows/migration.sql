@@ -0,0 +1,16 @@
+-- CreateTable
+CREATE TABLE "rejected_rows" (
+    "id" SERIAL NOT NULL,
+    "schema_name" VARCHAR(63) NOT NULL,
+    "table_name" VARCHAR(64) NOT NULL,
+    "source_row" INTEGER NOT NULL,
+    "reason" TEXT NOT NULL,
+    "record" JSONB NOT NULL,
+    "status" VARCHAR(16) NOT NULL DEFAULT 'rejected',
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "rejected_rows_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "rejected_rows_schema_name_status_idx" ON "rejected_rows"("schema_name", "status");
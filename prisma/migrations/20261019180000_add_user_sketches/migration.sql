@@ -0,0 +1,10 @@
+-- CreateTable
+CREATE TABLE "user_sketches" (
+    "day" TIMESTAMP(6) NOT NULL,
+    "country" VARCHAR(2) NOT NULL,
+    "kind" VARCHAR(16) NOT NULL,
+    "bucket" SMALLINT NOT NULL,
+    "rank" SMALLINT NOT NULL,
+
+    CONSTRAINT "user_sketches_pkey" PRIMARY KEY ("day","country","kind","bucket")
+);
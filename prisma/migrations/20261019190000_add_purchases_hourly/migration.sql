@@ -0,0 +1,15 @@
+-- CreateTable
+CREATE TABLE "purchases_hourly" (
+    "date" TIMESTAMP(6) NOT NULL,
+    "user_id" VARCHAR(7) NOT NULL,
+    "revenue" DOUBLE PRECISION,
+    "purchases" INTEGER NOT NULL,
+
+    CONSTRAINT "purchases_hourly_pkey" PRIMARY KEY ("date","user_id")
+);
+
+-- Backfill
+INSERT INTO "purchases_hourly" ("date", "user_id", "revenue", "purchases")
+SELECT DATE_TRUNC('hour', "date"), "user_id", SUM("revenue_usd"), COUNT(*)
+FROM "purchases"
+GROUP BY 1, 2;
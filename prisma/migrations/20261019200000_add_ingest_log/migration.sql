@@ -0,0 +1,19 @@
+-- CreateTable
+CREATE TABLE "ingest_log" (
+    "schema_name" VARCHAR(63) NOT NULL,
+    "content_hash" VARCHAR(64) NOT NULL,
+    "file_name" TEXT,
+    "status" VARCHAR(16) NOT NULL DEFAULT 'loading',
+    "spins_rows" INTEGER NOT NULL,
+    "purchases_rows" INTEGER NOT NULL,
+    "spins_loaded" INTEGER,
+    "purchases_loaded" INTEGER,
+    "spins_start" TIMESTAMP(6),
+    "spins_end" TIMESTAMP(6),
+    "purchases_start" TIMESTAMP(6),
+    "purchases_end" TIMESTAMP(6),
+    "load_seconds" DOUBLE PRECISION,
+    "created_at" TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "ingest_log_pkey" PRIMARY KEY ("schema_name","content_hash")
+);
@@ -0,0 +1,2 @@
+-- At most one active job per kind and key (Prisma can't express partial indexes, so it isn't in schema.prisma)
+CREATE UNIQUE INDEX "jobs_active_key" ON "jobs"("kind", "job_key") WHERE "status" IN ('queued', 'running');
@@ -0,0 +1,10 @@
+-- Seed: reference rates (USD value of one unit) as of the start of the period of ORIGINAL_DATASET.xlsx, so
+-- purchases in these currencies are converted out of the box. Newer rates are added as new days, and the
+-- as-of lookup picks the latest one on or before each purchase.
+INSERT INTO "fx_rates" ("currency", "day", "rate_to_usd") VALUES
+    ('EUR', '2022-04-01', 1.1045),
+    ('GBP', '2022-04-01', 1.3117),
+    ('CAD', '2022-04-01', 0.8003),
+    ('AUD', '2022-04-01', 0.7487),
+    ('JPY', '2022-04-01', 0.008174)
+ON CONFLICT ("currency", "day") DO NOTHING;
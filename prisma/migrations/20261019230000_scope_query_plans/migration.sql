@@ -0,0 +1,9 @@
+-- AlterTable
+ALTER TABLE "query_plans" ADD COLUMN "schema_name" VARCHAR(63) NOT NULL DEFAULT 'public',
+ADD COLUMN "query_hash" VARCHAR(40) NOT NULL DEFAULT '';
+
+-- DropIndex
+DROP INDEX "query_plans_query_name_created_at_idx";
+
+-- CreateIndex
+CREATE INDEX "query_plans_schema_name_query_name_query_hash_created_at_idx" ON "query_plans"("schema_name", "query_name", "query_hash", "created_at");
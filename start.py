@@ -0,0 +1,83 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from prisma import Prisma
+
+# Container entrypoint: apply the pending migrations (if any), then start Streamlit and report the cold-start time,
+# from this script's start to Streamlit answering its health check, against COLD_START_BUDGET_SECONDS.
+#
+# The Prisma client is generated when the image is built (see Dockerfile), and existing data is kept:
+# `prisma migrate deploy` only applies the migrations missing from the database, and is only run if some are.
+
+STARTED_AT = time.monotonic()
+SCHEMA = "prisma/schema.prisma"
+MIGRATIONS_DIR = "prisma/migrations"
+COLD_START_BUDGET_SECONDS = float(os.environ.get("COLD_START_BUDGET_SECONDS", "15"))
+HEALTH_URL = "http://localhost:8501/_stcore/health"
+
+
+async def pending_migrations() -> list[str]:
+    """
+    The migrations of MIGRATIONS_DIR that haven't been applied to the database yet.
+    """
+    prisma = Prisma()
+    await prisma.connect()
+    try:
+        exists = await prisma.query_raw(
+            "SELECT to_regclass('_prisma_migrations') IS NOT NULL AS e;"
+        )
+        applied = set()
+        if exists[0]["e"]:
+            rows = await prisma.query_raw(
+                """
+                SELECT migration_name FROM _prisma_migrations
+                WHERE finished_at IS NOT NULL AND rolled_back_at IS NULL;
+                """
+            )
+            applied = {row["migration_name"] for row in rows}
+    finally:
+        await prisma.disconnect()
+    return [
+        name
+        for name in sorted(os.listdir(MIGRATIONS_DIR))
+        if os.path.isdir(os.path.join(MIGRATIONS_DIR, name)) and name not in applied
+    ]
+
+
+def main():
+    pending = asyncio.run(pending_migrations())
+    if pending:
+        print(f"Applying {len(pending)} pending migrations: {', '.join(pending)}")
+        subprocess.run(
+            ["prisma", "migrate", "deploy", f"--schema={SCHEMA}"], check=True
+        )
+    print(f"Database ready in {time.monotonic() - STARTED_AT:.2f}s")
+
+    streamlit = subprocess.Popen(["streamlit", "run", "Home.py", *sys.argv[1:]])
+    # Let `docker stop` stop Streamlit gracefully
+    signal.signal(signal.SIGTERM, lambda *_: streamlit.terminate())
+    while streamlit.poll() is None:
+        try:
+            with urllib.request.urlopen(HEALTH_URL, timeout=1):
+                break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        sys.exit(streamlit.returncode)
+
+    cold_start = time.monotonic() - STARTED_AT
+    message = f"Cold start: {cold_start:.2f}s (budget: {COLD_START_BUDGET_SECONDS:g}s)"
+    if cold_start > COLD_START_BUDGET_SECONDS:
+        print(f"WARNING: {message}", file=sys.stderr)
+    else:
+        print(message)
+    sys.exit(streamlit.wait())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import asyncio
+
+import pandas as pd
+
+from utils import cache as cache_module
+from utils.cache import LRUCache, memoize
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+
+
+def test_put_replaces_entry():
+    cache = LRUCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", 1)
+    cache.put("a", 2)
+
+    assert cache.get("a") == 2
+    assert len(cache) == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache_module.time, "monotonic", clock)
+    cache = LRUCache(max_entries=2, ttl_seconds=10)
+    cache.put("a", 1)
+
+    clock.now = 10
+    assert cache.get("a") == 1
+    clock.now = 10.5
+    assert cache.get("a") is None
+    assert cache.stats.expirations == 1
+    assert len(cache) == 0
+
+
+def test_max_bytes_evicts_and_rejects_oversized_values():
+    frame = pd.DataFrame({"x": range(1000)})
+    size = cache_module.sizeof(frame)
+    cache = LRUCache(max_entries=10, ttl_seconds=60, max_bytes=2 * size)
+    cache.put("a", frame)
+    cache.put("b", frame)
+    cache.put("c", frame)
+
+    assert cache.get("a") is None
+    assert cache.bytes == 2 * size
+
+    cache.put("huge", pd.concat([frame] * 3))
+    assert cache.get("huge") is None
+    assert cache.bytes == 2 * size
+
+
+def test_stats_hit_rate():
+    cache = LRUCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("missing")
+
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert cache.stats.hit_rate == 0.5
+
+
+def test_get_or_load_loads_once():
+    cache = LRUCache(max_entries=2, ttl_seconds=60)
+    loads = []
+
+    async def load():
+        loads.append(1)
+        return "value"
+
+    async def twice():
+        return [await cache.get_or_load("a", load) for _ in range(2)]
+
+    assert asyncio.run(twice()) == ["value", "value"]
+    assert len(loads) == 1
+
+
+def test_clear():
+    cache = LRUCache(max_entries=2, ttl_seconds=60, max_bytes=10**6)
+    cache.put("a", "value")
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.bytes == 0
+
+
+def test_memoize_caches_by_content():
+    cache = LRUCache(max_entries=8, ttl_seconds=60)
+    calls = []
+
+    @memoize(lambda: cache)
+    def double(df):
+        calls.append(1)
+        return df * 2
+
+    assert double(pd.DataFrame({"x": [1, 2]}))["x"].tolist() == [2, 4]
+    assert double(pd.DataFrame({"x": [1, 2]}))["x"].tolist() == [2, 4]
+    assert double(pd.DataFrame({"x": [1, 3]}))["x"].tolist() == [2, 6]
+    assert len(calls) == 2
+
+
+def test_memoize_isolates_the_cache_from_callers():
+    cache = LRUCache(max_entries=8, ttl_seconds=60)
+
+    @memoize(lambda: cache)
+    def increment(df):
+        df["x"] += 1
+        return df
+
+    first = increment(pd.DataFrame({"x": [1]}))
+    first["x"] = 100
+
+    assert increment(pd.DataFrame({"x": [1]}))["x"].tolist() == [2]
+
+
+def test_memoize_explicit_key_skips_fingerprinting():
+    cache = LRUCache(max_entries=8, ttl_seconds=60)
+
+    @memoize(lambda: cache)
+    def identity(df):
+        return df
+
+    identity(pd.DataFrame({"x": [1]}), key="upload")
+
+    assert identity(pd.DataFrame({"x": [2]}), key="upload")["x"].tolist() == [1]
+    assert identity(pd.DataFrame({"x": [2]}))["x"].tolist() == [2]
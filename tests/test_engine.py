@@ -0,0 +1,151 @@
+import pandas as pd
+
+from utils.engine import AGGREGATED_COLUMNS, aggregate_frames, diff_aggregated
+
+
+def spins_hourly(*rows):
+    return pd.DataFrame(
+        rows, columns=["date", "user_id", "country", "total_spins"]
+    ).astype({"date": "datetime64[us]"})
+
+
+def purchases(*rows):
+    return pd.DataFrame(rows, columns=["date", "user_id", "revenue_usd"]).astype(
+        {"date": "datetime64[us]", "revenue_usd": float}
+    )
+
+
+def row(aggregated, date, user_id):
+    rows = aggregated[
+        (aggregated["date"] == pd.Timestamp(date)) & (aggregated["user_id"] == user_id)
+    ]
+    assert rows.shape[0] == 1
+    return rows.iloc[0]
+
+
+def test_a_row_per_hour_and_user_with_spins_or_purchases():
+    aggregated = aggregate_frames(
+        spins_hourly(
+            ("2022-04-01 10:00", "AA01LKF", "US", 5),
+            ("2022-04-01 11:00", "AA01LKF", "US", 3),
+        ),
+        purchases(
+            ("2022-04-01 10:15", "AA01LKF", 1.99),
+            ("2022-04-01 12:30", "AA01LKF", 4.99),
+        ),
+    )
+
+    assert list(aggregated.columns) == AGGREGATED_COLUMNS
+    assert aggregated["date"].tolist() == list(
+        pd.to_datetime(["2022-04-01 10:00", "2022-04-01 11:00", "2022-04-01 12:00"])
+    )
+    # Purchases without spins in that hour have no country
+    assert pd.isna(row(aggregated, "2022-04-01 12:00", "AA01LKF")["country"])
+    assert row(aggregated, "2022-04-01 12:00", "AA01LKF")["total_spins"] == 0
+
+
+def test_purchases_are_pre_aggregated_per_hour():
+    aggregated = aggregate_frames(
+        spins_hourly(("2022-04-01 10:00", "AA01LKF", "US", 5)),
+        purchases(
+            ("2022-04-01 10:05", "AA01LKF", 1.0),
+            ("2022-04-01 10:10", "AA01LKF", 2.0),
+            ("2022-04-01 10:55", "AA01LKF", 3.0),
+        ),
+    )
+
+    hour = row(aggregated, "2022-04-01 10:00", "AA01LKF")
+    # Not 3 × 5: the spins of the hour join its purchases one-to-one
+    assert hour["total_spins"] == 5
+    assert hour["total_purchases"] == 3
+    assert hour["total_revenue"] == 6.0
+    assert hour["avg_revenue_per_purchase"] == 2.0
+
+
+def test_purchases_without_revenue_usd_are_counted():
+    aggregated = aggregate_frames(
+        spins_hourly(("2022-04-01 10:00", "AA01LKF", "US", 5)),
+        purchases(
+            ("2022-04-01 10:05", "AA01LKF", 2.0),
+            ("2022-04-01 10:10", "AA01LKF", None),
+        ),
+    )
+
+    hour = row(aggregated, "2022-04-01 10:00", "AA01LKF")
+    assert hour["total_purchases"] == 2
+    assert hour["total_revenue"] == 2.0
+    assert hour["avg_revenue_per_purchase"] == 1.0
+
+
+def test_hours_without_purchases():
+    aggregated = aggregate_frames(
+        spins_hourly(
+            ("2022-04-01 10:00", "AA01LKF", "US", 5),
+            ("2022-04-02 10:00", "AA01LKF", "US", 1),
+        ),
+        purchases(("2022-04-01 11:00", "AA01LKF", 9.99)),
+    )
+
+    hour = row(aggregated, "2022-04-01 10:00", "AA01LKF")
+    assert hour["total_revenue"] == 0
+    assert hour["total_purchases"] == 0
+    assert hour["avg_revenue_per_purchase"] == 0
+    # ... but with purchases later that day
+    assert hour["total_daily_revenue"] == 9.99
+    # 0 without purchases that day, like COALESCE()
+    assert row(aggregated, "2022-04-02 10:00", "AA01LKF")["total_daily_revenue"] == 0
+
+
+def test_total_daily_revenue_is_per_user_and_day():
+    aggregated = aggregate_frames(
+        spins_hourly(
+            ("2022-04-01 10:00", "AA01LKF", "US", 5),
+            ("2022-04-01 10:00", "BB02LKF", "CA", 5),
+        ),
+        purchases(
+            ("2022-04-01 10:05", "AA01LKF", 1.0),
+            ("2022-04-01 23:59", "AA01LKF", 2.0),
+            ("2022-04-02 00:00", "AA01LKF", 4.0),
+            ("2022-04-01 10:05", "BB02LKF", 8.0),
+        ),
+    )
+
+    assert row(aggregated, "2022-04-01 10:00", "AA01LKF")["total_daily_revenue"] == 3.0
+    assert row(aggregated, "2022-04-01 23:00", "AA01LKF")["total_daily_revenue"] == 3.0
+    assert row(aggregated, "2022-04-02 00:00", "AA01LKF")["total_daily_revenue"] == 4.0
+    assert row(aggregated, "2022-04-01 10:00", "BB02LKF")["total_daily_revenue"] == 8.0
+
+
+def test_diff_aggregated():
+    expected = aggregate_frames(
+        spins_hourly(("2022-04-01 10:00", "AA01LKF", "US", 5)),
+        purchases(("2022-04-01 11:00", "AA01LKF", 1.99)),
+    )
+    # Like the rows pulled from PSQL
+    actual = expected.assign(
+        date=expected["date"].dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    )
+
+    assert diff_aggregated(expected, actual).empty
+
+    actual.loc[0, "total_spins"] = 6
+    differs = diff_aggregated(expected, actual.iloc[[0]])
+    assert differs["_merge"].tolist() == ["both", "left_only"]
+
+
+def test_categorical_columns_only_keep_the_observed_groups():
+    # Like the frames pulled from PSQL with `fetch_frame(..., categorical=...)`
+    spins = spins_hourly(
+        ("2022-04-01 10:00", "AA01LKF", "US", 5),
+        ("2022-04-01 10:00", "BB02LKF", "CA", 3),
+    )
+    bought = purchases(("2022-04-01 10:05", "AA01LKF", 1.99))
+    expected = aggregate_frames(spins, bought)
+
+    aggregated = aggregate_frames(
+        spins.astype({"user_id": "category", "country": "category"}),
+        bought.astype({"user_id": "category"}),
+    )
+
+    assert aggregated.shape[0] == 2
+    assert diff_aggregated(expected, aggregated).empty
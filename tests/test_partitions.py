@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+try:
+    from utils.partitions import partition_checksums
+except RuntimeError:
+    pytest.skip(
+        "the Prisma client isn't generated (run `prisma generate`)",
+        allow_module_level=True,
+    )
+
+
+@pytest.fixture
+def aggregated():
+    return pd.DataFrame(
+        {
+            "date": pd.to_datetime(
+                ["2022-04-01 10:00", "2022-04-01 11:00", "2022-04-02 10:00"]
+            ),
+            "user_id": ["AA01LKF", "AA01LKF", "AA01LKF"],
+            "total_spins": [5, 3, 1],
+        }
+    )
+
+
+def test_a_checksum_per_day(aggregated):
+    checksums = partition_checksums(aggregated)
+
+    assert list(checksums.index) == list(pd.to_datetime(["2022-04-01", "2022-04-02"]))
+    assert checksums.iloc[0] != checksums.iloc[1]
+
+
+def test_checksums_do_not_depend_on_row_order(aggregated):
+    shuffled = aggregated.iloc[[2, 1, 0]].reset_index(drop=True)
+
+    assert partition_checksums(shuffled).equals(partition_checksums(aggregated))
+
+
+def test_checksums_only_change_for_the_changed_day(aggregated):
+    changed = aggregated.copy()
+    changed.loc[0, "total_spins"] = 6
+    before, after = partition_checksums(aggregated), partition_checksums(changed)
+
+    assert before.iloc[0] != after.iloc[0]
+    assert before.iloc[1] == after.iloc[1]
+
+
+def test_checksums_change_with_the_number_of_rows(aggregated):
+    duplicated = pd.concat([aggregated, aggregated.iloc[[2]]])
+
+    assert (
+        partition_checksums(duplicated).iloc[1]
+        != partition_checksums(aggregated).iloc[1]
+    )
@@ -0,0 +1,57 @@
+import datetime
+
+import pytest
+
+try:
+    from utils.rollups import aligned, route
+except RuntimeError:
+    pytest.skip(
+        "the Prisma client isn't generated (run `prisma generate`)",
+        allow_module_level=True,
+    )
+
+# A Monday
+MONDAY = datetime.datetime(2022, 4, 4)
+
+
+def test_aligned():
+    assert aligned(None, "week")
+    assert aligned(MONDAY, "week")
+    assert not aligned(MONDAY + datetime.timedelta(days=1), "week")
+    assert aligned(MONDAY + datetime.timedelta(days=1), "day")
+    assert not aligned(MONDAY + datetime.timedelta(hours=1), "day")
+    assert aligned(MONDAY + datetime.timedelta(hours=1), "hour")
+    assert not aligned(MONDAY + datetime.timedelta(minutes=30), "hour")
+
+
+def test_route_picks_the_coarsest_rollup():
+    week = datetime.timedelta(days=7)
+    assert (
+        route("week", ["country"], MONDAY, MONDAY + week).table
+        == "aggregated_weekly_country"
+    )
+    assert route("week", [], None, None).table == "aggregated_weekly_country"
+    assert (
+        route("day", ["country"], MONDAY, MONDAY + week).table
+        == "aggregated_daily_country"
+    )
+    assert route("month", [], MONDAY, MONDAY + week).table == "aggregated_daily_country"
+    assert route("day", ["user_id"]).table == "aggregated_daily_user"
+    assert route("hour", ["country"]).table == "aggregated"
+
+
+def test_route_only_answers_aligned_ranges_from_rollups():
+    tuesday = MONDAY + datetime.timedelta(days=1)
+    assert route("week", ["country"], tuesday, None).table == "aggregated_daily_country"
+    assert route("week", ["user_id"], tuesday, None).table == "aggregated_daily_user"
+    assert (
+        route("day", ["country"], MONDAY + datetime.timedelta(hours=6), None).table
+        == "aggregated"
+    )
+
+
+def test_route_without_a_table():
+    with pytest.raises(ValueError):
+        route("day", ["platform"])
+    with pytest.raises(ValueError):
+        route("hour", [], MONDAY + datetime.timedelta(minutes=30))
@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    from utils import streaming
+    from utils.quarantine import (
+        MISSING_FX_RATE,
+        UNPARSEABLE_DATE,
+        UNPARSEABLE_REVENUE,
+        UNPARSEABLE_TOTAL_SPINS,
+        split_rejected,
+    )
+    from utils.streaming import (
+        SpillStore,
+        clean_purchases_chunk,
+        clean_spins_chunk,
+        input_path,
+        load_table_streaming,
+        quarantine_missing_rates,
+        split_chunk,
+    )
+except RuntimeError:
+    pytest.skip(
+        "the Prisma client isn't generated (run `prisma generate`)",
+        allow_module_level=True,
+    )
+
+
+TRANSACTION_IDS = [
+    "0f2c3d4e-1111-4222-8333-444455556666",
+    "0f2c3d4e-1111-4222-8333-444455556667",
+    "0f2c3d4e-1111-4222-8333-444455556668",
+]
+
+
+def raw_spins(*rows):
+    df = pd.DataFrame(rows, columns=["date", "userId", "country", "total_spins"])
+    return df.assign(source_row=df.index + 2)
+
+
+def raw_purchases(*rows):
+    df = pd.DataFrame(rows, columns=["date", "userId", "revenue", "transaction_id"])
+    return df.assign(source_row=df.index + 2)
+
+
+def test_clean_spins_chunk():
+    cleaned = clean_spins_chunk(
+        raw_spins(
+            ("2022-04-01 10:00:00", " AA01LKF ", "US ", "5.0"),
+            ("2022/04/01 11:00:00", "AA01LKF", "US", "abc"),
+            ("April 1st", "AA01LKF", "US", "1"),
+        )
+    )
+
+    assert cleaned["date"].tolist()[:2] == [
+        "2022-04-01 10:00:00",
+        "2022-04-01 11:00:00",
+    ]
+    assert pd.isna(cleaned["date"].iloc[2])
+    assert cleaned["user_id"].iloc[0] == "AA01LKF"
+    assert cleaned["country"].iloc[0] == "US"
+    assert cleaned["total_spins"].iloc[0] == 5.0
+    assert np.isnan(cleaned["total_spins"].iloc[1])
+
+
+def test_clean_purchases_chunk_only_normalizes_usd():
+    cleaned = clean_purchases_chunk(
+        raw_purchases(
+            ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", "t1"),
+            ("2022-04-01 10:00:00", "AA01LKF", "€4.99", "t2"),
+            ("2022-04-01 10:00:00", "AA01LKF", "n/a", "t3"),
+        )
+    )
+
+    assert cleaned["currency"].tolist()[:2] == ["USD", "€"]
+    assert cleaned["revenue"].tolist()[:2] == [1.99, 4.99]
+    assert cleaned["revenue_usd"].iloc[0] == 1.99
+    # Converted once loaded
+    assert np.isnan(cleaned["revenue_usd"].iloc[1])
+    assert pd.isna(cleaned["revenue"].iloc[2])
+
+
+def test_split_chunk_rejects_unparseable_spins():
+    raw = raw_spins(
+        ("2022-04-01 10:00:00", "AA01LKF", "US", "5"),
+        ("2022-04-01 11:00:00", "AA01LKF", "US", "abc"),
+        ("April 1st", "AA01LKF", "US", "abc"),
+    )
+    accepted, rejected = split_chunk("spins_hourly", raw, clean_spins_chunk(raw))
+
+    assert accepted.index.tolist() == [0]
+    assert rejected["source_row"].tolist() == [3, 4]
+    assert rejected["reason"].tolist() == [
+        f"{UNPARSEABLE_TOTAL_SPINS}, total_spins NOT NULL",
+        f"{UNPARSEABLE_DATE}, {UNPARSEABLE_TOTAL_SPINS}, date NOT NULL, total_spins NOT NULL",
+    ]
+    assert rejected["record"].iloc[0]["total_spins"] == "abc"
+
+
+def test_split_chunk_rejects_unparseable_revenue():
+    raw = raw_purchases(
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", TRANSACTION_IDS[0]),
+        ("2022-04-01 10:00:00", "AA01LKF", "n/a", TRANSACTION_IDS[1]),
+    )
+    accepted, rejected = split_chunk("purchases", raw, clean_purchases_chunk(raw))
+
+    assert accepted["transaction_id"].tolist() == [TRANSACTION_IDS[0]]
+    assert rejected["reason"].tolist() == [
+        f"{UNPARSEABLE_REVENUE}, currency NOT NULL, revenue NOT NULL"
+    ]
+    assert rejected["record"].iloc[0]["transaction_id"] == TRANSACTION_IDS[1]
+
+
+def test_split_chunk_checks_the_constraints():
+    raw = raw_purchases(
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", TRANSACTION_IDS[0]),
+        ("2022-04-01 10:00:00", "AA01LKFX", "PriceInUSD=1.99", TRANSACTION_IDS[1]),
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", "t3"),
+        # Duplicates are merged into the spill instead
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", TRANSACTION_IDS[0]),
+    )
+    accepted, rejected = split_chunk("purchases", raw, clean_purchases_chunk(raw))
+
+    assert accepted.index.tolist() == [0, 3]
+    assert rejected["reason"].tolist() == ["user_id VARCHAR(7)", "transaction_id UUID"]
+
+    raw = raw_spins(
+        ("2022-04-01 10:00:00", "AA01LKF", "USA", "5"),
+        ("2022-04-01 10:00:00", "AA01LKF", "US", "-5"),
+    )
+    accepted, rejected = split_chunk("spins_hourly", raw, clean_spins_chunk(raw))
+
+    assert accepted.empty
+    assert rejected["reason"].tolist() == [
+        "country VARCHAR(2)",
+        "CHECK (total_spins >= 0)",
+    ]
+
+
+def test_duplicated_primary_keys_keep_the_first_row():
+    raw = raw_purchases(
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", TRANSACTION_IDS[0]),
+        ("2022-04-01 11:00:00", "AA01LKF", "PriceInUSD=2.99", TRANSACTION_IDS[1]),
+        ("2022-04-01 12:00:00", "AA01LKF", "PriceInUSD=3.99", TRANSACTION_IDS[0]),
+    )
+    cleaned = clean_purchases_chunk(raw).assign(source_row=raw["source_row"])
+    accepted, rejected = split_rejected(cleaned, "purchases", {})
+
+    assert accepted["revenue"].tolist() == [1.99, 2.99]
+    assert rejected["source_row"].tolist() == [raw["source_row"].iloc[2]]
+    assert rejected["reason"].tolist() == ["PRIMARY KEY (transaction_id)"]
+
+
+def test_split_chunk_without_rejects():
+    raw = raw_spins(("2022-04-01 10:00:00", "AA01LKF", "US", "5"))
+    accepted, rejected = split_chunk("spins_hourly", raw, clean_spins_chunk(raw))
+
+    assert accepted.shape[0] == 1
+    assert rejected.empty
+
+
+class FakePrisma:
+    def __init__(self, returned=()):
+        self.queries = []
+        self.returned = list(returned)
+
+    async def execute_raw(self, query, *args):
+        self.queries.append((query, args))
+
+    async def query_raw(self, query, *args):
+        self.queries.append((query, args))
+        return self.returned
+
+    @contextlib.asynccontextmanager
+    async def tx(self, timeout=None):
+        yield self
+
+
+def strict_loads(payload):
+    def reject(constant):
+        raise ValueError(f"{constant} isn't JSON")
+
+    return json.loads(payload, parse_constant=reject)
+
+
+def test_load_a_mixed_currency_chunk(monkeypatch):
+    monkeypatch.setattr(streaming, "LOAD_MODE", "in_place")
+    chunk = clean_purchases_chunk(
+        raw_purchases(
+            ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", "t1"),
+            ("2022-04-01 10:00:00", "AA01LKF", "€4.99", "t2"),
+        )
+    )
+    prisma = FakePrisma()
+
+    async def on_batch(rows_done):
+        pass
+
+    rows = asyncio.run(load_table_streaming(prisma, "purchases", [chunk], on_batch))
+
+    assert rows == 2
+    (payload,) = [args[0] for query, args in prisma.queries if args]
+    records = strict_loads(payload)
+    assert [r["revenue_usd"] for r in records] == [1.99, None]
+
+
+def test_quarantine_missing_rates(tmp_path):
+    raw = raw_purchases(
+        ("2022-04-01 10:00:00", "AA01LKF", "PriceInUSD=1.99", "T1"),
+        (
+            "2022-04-01 10:00:00",
+            "AA01LKF",
+            "€4.99",
+            "{0F2C3D4E-1111-4222-8333-444455556666}",
+        ),
+    )
+    store = SpillStore(str(tmp_path / "spill.sqlite"))
+    store.add_purchases(clean_purchases_chunk(raw), raw)
+    # Like PostgreSQL returns the deleted purchases
+    prisma = FakePrisma([{"transaction_id": "0f2c3d4e-1111-4222-8333-444455556666"}])
+
+    rejected = asyncio.run(quarantine_missing_rates(prisma, "run_1", store))
+    store.close()
+
+    assert rejected["source_row"].tolist() == [3]
+    assert rejected["reason"].tolist() == [MISSING_FX_RATE]
+    assert rejected["record"].iloc[0]["revenue"] == "€4.99"
+    assert [query.split()[0] for query, _ in prisma.queries] == ["UPDATE", "DELETE"]
+
+
+def test_input_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_INPUT_DIR", str(tmp_path / "input"))
+    (tmp_path / "input").mkdir()
+    (tmp_path / "input" / "big.xlsx").touch()
+    (tmp_path / "secret").touch()
+
+    assert input_path("big.xlsx") == str((tmp_path / "input" / "big.xlsx").resolve())
+    assert input_path("missing.xlsx") is None
+    assert input_path("../secret") is None
+    assert input_path(str(tmp_path / "secret")) is None
@@ -0,0 +1,6 @@
+"""
+Shared helpers used by the Streamlit pages.
+
+Import the submodules directly (e.g. `from utils.instrumentation import track_stage`),
+so a page only pays for the modules it actually uses.
+"""
@@ -0,0 +1,380 @@
+import asyncio
+import textwrap
+from dataclasses import dataclass, field
+
+from prisma import Prisma
+
+from utils.db import scoped_tx
+from utils.explain import PlanCapture
+from utils.instrumentation import track_stage
+from utils.jobs import JobContext
+from utils.rollups import ROLLUPS
+from utils.shadow import LOAD_MODE, create_shadow, shadow_name, swap_in_shadow
+from utils.sketches import REFRESH_USER_SKETCHES_QUERY
+
+##############################
+# Step 4 queries
+##############################
+CTE_PURCHASES_QUERY = """
+    -- `purchases_hourly` (maintained in Step 3) has one row per user and hour: the revenue normalized to USD
+    -- summed and the purchases counted, so every join below is one-to-one
+    -- Truncate `date` column by "day" to transform `2022-04-01 07:00:00` to `2022-04-01 00:00:00`
+    SELECT * INTO UNLOGGED TABLE cte_purchases FROM (
+        SELECT
+            p.date AS date_trunc,
+            DATE_TRUNC('day', p.date) AS day_trunc,
+            p.user_id,
+            p.revenue,
+            p.purchases
+        FROM purchases_hourly p
+    );
+"""
+
+JOIN_QUERY = """
+    SELECT *
+    FROM spins_hourly sh
+    FULL JOIN cte_purchases p
+    ON sh.date = p.date_trunc AND sh.user_id = p.user_id;
+"""
+
+CTE_UNION_SPINS_PURCHASES_QUERY = """
+    SELECT * INTO UNLOGGED TABLE cte_union_spins_purchases FROM (
+        SELECT
+            sh.date,
+            sh.user_id
+        FROM spins_hourly sh
+        UNION
+        SELECT
+            p.date_trunc,
+            p.user_id
+        FROM cte_purchases p
+    );
+"""
+
+CTE_JOINED_QUERY = """
+    SELECT * INTO UNLOGGED TABLE cte_joined FROM (
+        SELECT
+            u.date,
+            u.user_id,
+            sh.country,
+            sh.total_spins,
+            p.revenue,
+            p.purchases
+        FROM cte_union_spins_purchases u
+        LEFT JOIN spins_hourly sh
+        ON u.date = sh.date AND u.user_id = sh.user_id
+        LEFT JOIN cte_purchases p
+        ON u.date = p.date_trunc AND u.user_id = p.user_id
+    );
+"""
+
+CTE_TOTAL_DAILY_REVENUE_QUERY = """
+    SELECT * INTO UNLOGGED TABLE cte_total_daily_revenue FROM (
+        SELECT
+            p.day_trunc,
+            p.user_id,
+            SUM(p.revenue) AS total_daily_revenue
+        FROM cte_purchases p
+        GROUP BY
+            p.day_trunc,
+            p.user_id
+    );
+"""
+
+CTE_AGGREGATED_QUERY = """
+    SELECT * INTO UNLOGGED TABLE cte_aggregated FROM (
+        SELECT
+            cte_joined.date,
+            cte_joined.user_id,
+            cte_joined.country AS country,
+            COALESCE(SUM(cte_joined.total_spins), 0) AS total_spins,
+            COALESCE(SUM(cte_joined.revenue), 0) AS total_revenue,
+            COALESCE(SUM(cte_joined.purchases), 0) AS total_purchases,
+            COALESCE(SUM(cte_joined.revenue) / NULLIF(SUM(cte_joined.purchases), 0), 0) AS avg_revenue_per_purchase,
+            -- 0 for the days the user made no purchase (`total_daily_revenue` is NOT NULL)
+            COALESCE(cte_total_daily_revenue.total_daily_revenue, 0) AS total_daily_revenue
+        FROM cte_joined
+        LEFT JOIN cte_total_daily_revenue
+        ON DATE_TRUNC('day', cte_joined.date) = cte_total_daily_revenue.day_trunc
+        AND cte_joined.user_id = cte_total_daily_revenue.user_id
+        GROUP BY
+            cte_joined.date,
+            cte_joined.user_id,
+            cte_joined.country,
+            cte_total_daily_revenue.total_daily_revenue
+        ORDER BY cte_joined.user_id ASC
+    );
+"""
+
+# In the "shadow" LOAD_MODE, `aggregated` is rebuilt in a shadow table which is then swapped in atomically
+AGGREGATED_TARGET = shadow_name("aggregated") if LOAD_MODE == "shadow" else "aggregated"
+
+INSERT_INTO_AGGREGATED_QUERY = f"""
+    INSERT INTO {AGGREGATED_TARGET}
+    (
+        date,
+        user_id,
+        country,
+        total_spins,
+        total_revenue,
+        total_purchases,
+        avg_revenue_per_purchase,
+        total_daily_revenue
+    )
+    SELECT
+        date,
+        user_id,
+        country,
+        total_spins,
+        total_revenue,
+        total_purchases,
+        avg_revenue_per_purchase,
+        total_daily_revenue
+    FROM cte_aggregated;
+"""
+
+
+##############################
+# Stage graph
+##############################
+@dataclass
+class Stage:
+    """
+    A Step 4 query, the query previewing its result (None if the query returns rows itself),
+    the stages whose tables it reads, and the table it refills (TRUNCATEd in the same transaction), if any.
+    """
+
+    name: str
+    query: str
+    preview_query: str | None
+    depends_on: list[str] = field(default_factory=list)
+    replaces: str | None = None
+
+
+# In execution order. Stages named after an intermediate table create that table, and drop it first.
+#
+# The intermediate tables are UNLOGGED instead of TEMP tables: independent stages run concurrently on
+# separate pooled connections, and a TEMP table only exists on the connection that created it. They are
+# dropped at the end of the job instead.
+STAGES = [
+    Stage("cte_purchases", CTE_PURCHASES_QUERY, "SELECT * FROM cte_purchases;"),
+    Stage("join_query", JOIN_QUERY, None, ["cte_purchases"]),
+    Stage(
+        "cte_union_spins_purchases",
+        CTE_UNION_SPINS_PURCHASES_QUERY,
+        "SELECT * FROM cte_union_spins_purchases;",
+        ["cte_purchases"],
+    ),
+    Stage(
+        "cte_joined",
+        CTE_JOINED_QUERY,
+        "SELECT * FROM cte_joined;",
+        ["cte_union_spins_purchases"],
+    ),
+    Stage(
+        "cte_total_daily_revenue",
+        CTE_TOTAL_DAILY_REVENUE_QUERY,
+        """
+        SELECT * FROM cte_total_daily_revenue
+        ORDER BY user_id ASC, day_trunc ASC;
+        """,
+        ["cte_purchases"],
+    ),
+    Stage(
+        "cte_aggregated",
+        CTE_AGGREGATED_QUERY,
+        "SELECT * FROM cte_aggregated;",
+        ["cte_joined", "cte_total_daily_revenue"],
+    ),
+    Stage(
+        "insert_aggregated",
+        INSERT_INTO_AGGREGATED_QUERY,
+        "SELECT * FROM aggregated;",
+        ["cte_aggregated"],
+    ),
+    # The rollups are refreshed from `aggregated` concurrently, once it's complete (see utils/rollups.py)
+    *(
+        Stage(
+            rollup.table,
+            rollup.refresh_query,
+            f"SELECT * FROM {rollup.table} ORDER BY 1, 2;",
+            ["insert_aggregated"],
+            replaces=rollup.table,
+        )
+        for rollup in ROLLUPS
+        if rollup.refresh_query is not None
+    ),
+    # Only reads the loaded tables, so it runs concurrently with the whole aggregation (see utils/sketches.py)
+    Stage(
+        "user_sketches",
+        REFRESH_USER_SKETCHES_QUERY,
+        """
+        SELECT day, country, kind, COUNT(*) AS registers_set
+        FROM user_sketches
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3;
+        """,
+        replaces="user_sketches",
+    ),
+]
+
+
+INTERMEDIATE_TABLES = [stage.name for stage in STAGES if stage.name.startswith("cte_")]
+
+
+def aggregation_script() -> str:
+    """
+    The queries of the Step 4 stages as a single SQL script, generated from STAGES in their (topological)
+    order: the tables each stage empties first, its query, and the intermediate tables dropped at the end.
+    The stages only returning rows (e.g. `join_query`) are left out.
+    """
+    statements = []
+    for stage in STAGES:
+        if stage.preview_query is None:
+            continue
+        statements.append(f"-- {stage.name}")
+        if stage.name in INTERMEDIATE_TABLES:
+            statements.append(f"DROP TABLE IF EXISTS {stage.name};")
+        if stage.name == "insert_aggregated":
+            if LOAD_MODE == "shadow":
+                statements.append(
+                    f"DROP TABLE IF EXISTS {AGGREGATED_TARGET};\n"
+                    f"CREATE TABLE {AGGREGATED_TARGET} (LIKE aggregated INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+                )
+            else:
+                statements.append("DELETE FROM aggregated;")
+        if stage.replaces is not None:
+            statements.append(f"TRUNCATE {stage.replaces};")
+        statements.append(textwrap.dedent(stage.query).strip())
+        if stage.name == "insert_aggregated" and LOAD_MODE == "shadow":
+            statements.append(
+                f"-- Then {AGGREGATED_TARGET} is indexed and swapped in place of aggregated (see utils/shadow.py)"
+            )
+        statements.append("")
+    statements.append(f"DROP TABLE IF EXISTS {', '.join(INTERMEDIATE_TABLES)};")
+    return "\n".join(statements)
+
+
+async def run_stage_graph(stages: list[Stage], run_stage):
+    """
+    Run `run_stage(stage)` for every stage as soon as all the stages it depends on have finished,
+    so independent stages run concurrently and the wall time is that of the critical path.
+    `stages` must be in a topological order.
+    """
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def run(stage: Stage):
+        await asyncio.gather(*(tasks[name] for name in stage.depends_on))
+        await run_stage(stage)
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.ensure_future(run(stage))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        # If a stage failed, don't leave the stages depending on it waiting forever
+        for task in tasks.values():
+            task.cancel()
+
+
+##############################
+# Aggregation job
+##############################
+def _limited(query: str, limit: int | None) -> str:
+    if limit is None:
+        return query
+    return f"SELECT * FROM ({query.strip().rstrip(';')}) q LIMIT {limit};"
+
+
+async def aggregate_job(
+    ctx: JobContext, schema: str, capture_plans: bool, preview_limit: int | None = None
+):
+    """
+    Run all the Step 4 stages on the tables of the run's `schema` in a background job, independent stages
+    concurrently.
+
+    Every stage runs in a transaction scoped to the run's schema, so the (unqualified) queries read the run's
+    tables and create the intermediate tables in the run's schema.
+
+    Returns the rows of every stage (so the page can show the intermediate tables), at most `preview_limit`
+    of them if set (e.g. in streaming mode), and the captured query plans.
+    """
+    plans = PlanCapture(ctx.prisma, capture_plans, schema)
+    previews = {}
+
+    async def run_stage(stage: Stage):
+        with track_stage(f"step4.{stage.name}") as metrics:
+            # Emptying the stage's table and refilling it happen in one transaction
+            async with scoped_tx(ctx.prisma, schema) as tx:
+                if stage.name in INTERMEDIATE_TABLES:
+                    await tx.execute_raw(f"DROP TABLE IF EXISTS {schema}.{stage.name};")
+                if stage.name == "insert_aggregated":
+                    if LOAD_MODE == "shadow":
+                        await create_shadow(tx, f"{schema}.aggregated")
+                    else:
+                        await tx.execute_raw(f"DELETE FROM {schema}.aggregated;")
+                if stage.replaces is not None:
+                    # TRUNCATE leaves no dead tuples, and readers wait for the refill instead of seeing an empty table
+                    await tx.execute_raw(f"TRUNCATE {stage.replaces};")
+                rows = await plans.run(
+                    stage.name,
+                    (
+                        stage.query
+                        if stage.preview_query is not None
+                        else _limited(stage.query, preview_limit)
+                    ),
+                    returns_rows=stage.preview_query is None,
+                    client=tx,
+                )
+            if stage.name == "insert_aggregated" and LOAD_MODE == "shadow":
+                await swap_in_shadow(ctx.prisma, f"{schema}.aggregated")
+            if stage.preview_query is not None:
+                async with scoped_tx(ctx.prisma, schema) as tx:
+                    rows = await tx.query_raw(
+                        _limited(stage.preview_query, preview_limit)
+                    )
+            previews[stage.name] = rows
+            metrics.rows = len(rows)
+        await ctx.progress(len(previews) / len(STAGES), f"finished `{stage.name}`")
+
+    try:
+        await run_stage_graph(STAGES, run_stage)
+    finally:
+        # The job returns the previews of the intermediate tables: they aren't needed afterwards
+        await ctx.prisma.execute_raw(
+            "DROP TABLE IF EXISTS "
+            + ", ".join(f"{schema}.{table}" for table in INTERMEDIATE_TABLES)
+            + ";"
+        )
+    return {"previews": previews, "plans": plans}
+
+
+async def latest_aggregation(prisma: Prisma, schema: str):
+    """
+    The last aggregation job of the run's `schema`, whatever its data version, or None. Its `job_key` is
+    `<schema>:<data version>`, so the tables of the schema hold the result of that version if it succeeded.
+    """
+    return await prisma.jobs.find_first(
+        where={"kind": "aggregate", "job_key": {"startswith": f"{schema}:"}},
+        order={"created_at": "desc"},
+    )
+
+
+async def read_previews(prisma: Prisma, schema: str, preview_limit: int | None = None):
+    """
+    The rows of every stage, like `aggregate_job()` returns them, read back from the tables the last
+    aggregation left in the run's `schema`, in a read-only transaction (none for the stages reading the
+    intermediate tables, which are dropped at the end of the job). Used when the result of the job
+    isn't in memory anymore (e.g. after a restart of the app).
+    """
+    previews = {}
+    async with scoped_tx(prisma, schema) as tx:
+        await tx.execute_raw("SET TRANSACTION READ ONLY;")
+        for stage in STAGES:
+            query = stage.preview_query or stage.query
+            # The intermediate tables were dropped at the end of the job
+            if any(table in query for table in INTERMEDIATE_TABLES):
+                previews[stage.name] = []
+                continue
+            previews[stage.name] = await tx.query_raw(_limited(query, preview_limit))
+    return previews
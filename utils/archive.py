@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import datetime
+import os
+from dataclasses import dataclass, field
+
+import pandas as pd
+import psycopg
+import streamlit as st
+
+from utils.engine import aggregate_frames
+from utils.fetch import _to_frame, conninfo, fetch_frame
+from utils.instrumentation import track_stage
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+# Raw rows of days more than this many days before the newest day of their table are archived
+ARCHIVE_HORIZON_DAYS = int(os.environ.get("ARCHIVE_HORIZON_DAYS", "90"))
+
+
+@dataclass
+class ArchivedTable:
+    """
+    A raw table that only grows: the columns archived (as a select list) and its primary key,
+    which deduplicates a day archived twice (e.g. rows loaded for an archived day later on), and the
+    tables derived from its rows hour by hour, whose rows of an archived day are deleted with it.
+
+    `aggregated`, its rollups and `user_sketches` are not derived tables here: they keep the archived days,
+    so the metrics of the whole history are still served from PostgreSQL (see `recompute_aggregated()`).
+    """
+
+    name: str
+    columns: str
+    key: list[str]
+    derived: list[str] = field(default_factory=list)
+
+
+ARCHIVED_TABLES = {
+    table.name: table
+    for table in [
+        ArchivedTable(
+            "spins_hourly",
+            "date, user_id, country, total_spins",
+            ["date", "user_id", "country"],
+        ),
+        ArchivedTable(
+            "purchases",
+            "transaction_id::text AS transaction_id, date, user_id, currency, revenue, revenue_usd",
+            ["transaction_id"],
+            ["purchases_hourly"],
+        ),
+    ]
+}
+
+
+def partition_path(table: str, day: datetime.date) -> str:
+    """
+    The Parquet file of a day of `table`: ARCHIVE_DIR/<table>/day=<YYYY-MM-DD>/part-0.parquet.
+    """
+    return os.path.join(ARCHIVE_DIR, table, f"day={day:%Y-%m-%d}", "part-0.parquet")
+
+
+def archived_days(table: str) -> list[datetime.date]:
+    path = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(path):
+        return []
+    return sorted(
+        datetime.date.fromisoformat(name.removeprefix("day="))
+        for name in os.listdir(path)
+        if name.startswith("day=")
+    )
+
+
+##############################
+# Archive
+##############################
+def _write_partition(table: ArchivedTable, day: datetime.date, df: pd.DataFrame):
+    """
+    Write the rows of a day to its Parquet file, merged with the rows already archived for that day, if any.
+    The file is only replaced once complete.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = partition_path(table.name, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        df = pd.concat([pq.read_table(path).to_pandas(), df]).drop_duplicates(
+            table.key, keep="last"
+        )
+    partial = f"{path}.part"
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False), partial, compression="zstd"
+    )
+    os.replace(partial, path)
+
+
+async def archive_day(
+    connection: psycopg.AsyncConnection,
+    table: ArchivedTable,
+    day: datetime.date,
+    schema: str = "public",
+) -> int:
+    """
+    Move the rows of a day of `table` from PostgreSQL to its Parquet file: the rows (and those of the day in
+    the derived tables) are deleted in a transaction that is only committed once the file is written, so a
+    failure leaves them in PostgreSQL (and a file written twice is merged by primary key). Returns the number
+    of rows archived.
+    """
+    start = datetime.datetime.combine(day, datetime.time())
+    async with connection.transaction():
+        async with connection.cursor(binary=True) as cursor:
+            await cursor.execute(
+                f"""
+                DELETE FROM {schema}.{table.name} WHERE date >= %s AND date < %s
+                RETURNING {table.columns};
+                """,
+                (start, start + datetime.timedelta(days=1)),
+            )
+            df = _to_frame(await cursor.fetchall(), cursor.description, ())
+            # Refreshed from the rows left in the day, i.e. none
+            for derived in table.derived:
+                await cursor.execute(
+                    f"DELETE FROM {schema}.{derived} WHERE date >= %s AND date < %s;",
+                    (start, start + datetime.timedelta(days=1)),
+                )
+        if not df.empty:
+            _write_partition(table, day, df)
+    return df.shape[0]
+
+
+async def archive_table(
+    table: str,
+    horizon_days: int = ARCHIVE_HORIZON_DAYS,
+    schema: str = "public",
+    on_day=None,
+) -> int:
+    """
+    Archive the rows of `table` older than `horizon_days` before its newest day, day by day, then ANALYZE it.
+    `on_day(day, rows)` is called after every day. Returns the number of rows archived.
+    """
+    archived = ARCHIVED_TABLES[table]
+    rows = 0
+    with track_stage(f"archive.{table}") as stage:
+        async with await psycopg.AsyncConnection.connect(
+            conninfo(), autocommit=True
+        ) as connection:
+            cursor = await connection.execute(
+                f"""
+                SELECT DISTINCT DATE_TRUNC('day', date)::date FROM {schema}.{table}
+                WHERE date < (SELECT DATE_TRUNC('day', MAX(date)) FROM {schema}.{table}) - make_interval(days => %s)
+                ORDER BY 1;
+                """,
+                (horizon_days,),
+            )
+            for (day,) in await cursor.fetchall():
+                day_rows = await archive_day(connection, archived, day, schema)
+                rows += day_rows
+                if on_day is not None:
+                    on_day(day, day_rows)
+            if rows:
+                # The planner's statistics still count the archived rows
+                for analyzed in [table, *archived.derived]:
+                    await connection.execute(f"ANALYZE {schema}.{analyzed};")
+        stage.rows = rows
+    return rows
+
+
+##############################
+# Read
+##############################
+def read_archive(table: str, start=None, end=None) -> pd.DataFrame:
+    """
+    The archived rows of `table` in the [start, end) date range. Only the files of the days in the range are read.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = os.path.join(ARCHIVE_DIR, table)
+    if not archived_days(table):
+        return pd.DataFrame()
+    dataset = ds.dataset(
+        path,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive"),
+    )
+    filters = []
+    if start is not None:
+        filters += [
+            ds.field("day") >= f"{start:%Y-%m-%d}",
+            ds.field("date") >= pa.scalar(pd.Timestamp(start), pa.timestamp("us")),
+        ]
+    if end is not None:
+        filters += [
+            ds.field("day") <= f"{end:%Y-%m-%d}",
+            ds.field("date") < pa.scalar(pd.Timestamp(end), pa.timestamp("us")),
+        ]
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return dataset.to_table(filter=expression).drop_columns(["day"]).to_pandas()
+
+
+async def read_raw(table: str, start=None, end=None) -> pd.DataFrame:
+    """
+    The rows of the shared `table` in the [start, end) date range, from the archive and from PostgreSQL.
+    """
+    archived = ARCHIVED_TABLES[table]
+    filters, params = [], []
+    if start is not None:
+        filters.append("date >= %s")
+        params.append(start)
+    if end is not None:
+        filters.append("date < %s")
+        params.append(end)
+    hot = await fetch_frame(
+        f"SELECT {archived.columns} FROM public.{table}"
+        + (f" WHERE {' AND '.join(filters)}" if filters else "")
+        + ";",
+        *params,
+    )
+    cold = read_archive(table, start, end)
+    if cold.empty:
+        return hot
+    return pd.concat([cold, hot], ignore_index=True).drop_duplicates(
+        archived.key, keep="last"
+    )
+
+
+async def recompute_aggregated(start=None, end=None) -> pd.DataFrame:
+    """
+    The rows of `aggregated` in the [start, end) date range, recomputed in-process (see utils/engine.py) from
+    the archived and the hot raw rows. `start` and `end` should be midnights, so whole days are aggregated
+    (`total_daily_revenue` is per day).
+    """
+    with track_stage("archive.recompute") as stage:
+        spins_hourly, purchases = await asyncio.gather(
+            read_raw("spins_hourly", start, end), read_raw("purchases", start, end)
+        )
+        if spins_hourly.empty and purchases.empty:
+            return pd.DataFrame()
+        aggregated = aggregate_frames(spins_hourly, purchases)
+        stage.rows = aggregated.shape[0]
+    return aggregated
+
+
+##############################
+# Archive form
+##############################
+async def render_archive(key: str, start=None, end=None):
+    """
+    The archived days of the raw tables, a button archiving the old rows, and one recomputing `aggregated`
+    over the [start, end) date range from the archive.
+    """
+    st.write(
+        pd.DataFrame(
+            [
+                {
+                    "table": table,
+                    "archived days": len(days),
+                    "from": days[0] if days else None,
+                    "to": days[-1] if days else None,
+                }
+                for table, days in (
+                    (table, archived_days(table)) for table in ARCHIVED_TABLES
+                )
+            ]
+        )
+    )
+    if st.button(
+        f"Archive the rows older than {ARCHIVE_HORIZON_DAYS} days", key=f"{key}_archive"
+    ):
+        progress_text = st.empty()
+        for table in ARCHIVED_TABLES:
+            rows = await archive_table(
+                table,
+                on_day=lambda day, rows: progress_text.caption(
+                    f"Archived {rows} rows of `{table}` of {day}"
+                ),
+            )
+            st.success(f"Archived {rows} rows of `{table}` to `{ARCHIVE_DIR}`.")
+    if st.button("Recompute `aggregated` from the archive", key=f"{key}_recompute"):
+        with st.spinner("Recomputing `aggregated`..."):
+            st.write(await recompute_aggregated(start, end))
+
+
+##############################
+# CLI
+##############################
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move the old rows of the raw tables to day-partitioned Parquet files."
+    )
+    parser.add_argument(
+        "--table",
+        choices=list(ARCHIVED_TABLES),
+        action="append",
+        dest="tables",
+        help="Default: all the raw tables",
+    )
+    parser.add_argument("--horizon-days", type=int, default=ARCHIVE_HORIZON_DAYS)
+    args = parser.parse_args()
+
+    for table in args.tables or list(ARCHIVED_TABLES):
+        rows = asyncio.run(
+            archive_table(
+                table,
+                args.horizon_days,
+                on_day=lambda day, rows: print(f"{table} {day}: {rows} rows"),
+            )
+        )
+        print(f"Archived {rows} rows of {table} to {ARCHIVE_DIR}")
+
+
+if __name__ == "__main__":
+    main()
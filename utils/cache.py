@@ -0,0 +1,144 @@
+import functools
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+
+from utils.fingerprint import fingerprint_arrow
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def sizeof(value) -> int:
+    """
+    The approximate size of `value` in memory, in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    A thread-safe, in-process cache holding at most `max_entries` entries (and, if `max_bytes` is set, at
+    most `max_bytes` bytes of values, see `sizeof()`), each for at most `ttl_seconds`. When full, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(
+        self, max_entries: int, ttl_seconds: float, max_bytes: int | None = None
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.stats = CacheStats()
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        The cached value of `key`, or None if it's missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                self.bytes -= entry[2]
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        nbytes = sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            # Would evict everything else, and still not fit
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = (time.monotonic(), value, nbytes)
+            self.bytes += nbytes
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+                self.bytes -= evicted_bytes
+                self.stats.evictions += 1
+
+    async def get_or_load(self, key, load):
+        """
+        The cached value of `key`, or the value of `await load()`, cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = await load()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def memoize(get_cache):
+    """
+    Cache the results of a function of DataFrames, Series and scalars in the LRUCache returned by
+    `get_cache()`, keyed by the function and the Arrow fingerprint of its arguments (see `fingerprint_arrow()`).
+    Callers which already know what the arguments are derived from (e.g. the content hash of an upload) can
+    pass it as `key=` instead, and skip fingerprinting them.
+
+    DataFrames and Series are cached and returned as copies, so neither the function's result nor the
+    caller's copy of it are shared with the cache.
+    """
+
+    def _copy(value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value.copy()
+        return value
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, key=None):
+            cache = get_cache()
+            key = (
+                fn.__module__,
+                fn.__qualname__,
+                fingerprint_arrow(*args) if key is None else key,
+            )
+            value = cache.get(key)
+            if value is None:
+                value = fn(*args)
+                cache.put(key, _copy(value))
+                return value
+            return _copy(value)
+
+        return wrapper
+
+    return decorator
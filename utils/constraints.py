@@ -0,0 +1,163 @@
+import glob
+import operator
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+import pandas as pd
+import streamlit as st
+
+SCHEMA_PATH = "prisma/schema.prisma"
+MIGRATIONS_DIR = "prisma/migrations"
+
+# PostgreSQL's accepted UUID spellings: with or without hyphens and braces, in any case
+UUID_PATTERN = r"\{?[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}\}?"
+INT4_RANGE = (-(2**31), 2**31 - 1)
+INT8_RANGE = (-(2**63), 2**63 - 1)
+PRIMARY_KEY = "PRIMARY KEY"
+
+_MODEL = re.compile(r"^model (\w+) \{(.*?)^\}", re.MULTILINE | re.DOTALL)
+_FIELD = re.compile(r"^\s*(\w+)\s+(\w+)(\?)?(.*)$")
+_ID = re.compile(r"@@id\(\[([\w,\s]+)\]\)")
+_VARCHAR = re.compile(r"@db\.VarChar\((\d+)\)")
+# The simple CHECK constraints of the migrations, e.g. `ALTER TABLE "t" ADD CONSTRAINT "c" CHECK ("col" >= 0);`
+_CHECK = re.compile(
+    r'ALTER TABLE "(\w+)" ADD CONSTRAINT "(\w+)" CHECK \("(\w+)" (>=|<=|<>|>|<|=) (-?[\d.]+)\)'
+)
+_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+    "=": operator.eq,
+    "<>": operator.ne,
+}
+
+
+@dataclass
+class Constraint:
+    """
+    A constraint of a table, checked on a whole column (or key) at once.
+
+    `violations(df)` is the boolean mask of the rows of `df` violating it. As in PostgreSQL, NULLs only
+    violate NOT NULL constraints.
+    """
+
+    name: str
+    columns: list[str]
+    violations: Callable[[pd.DataFrame], pd.Series]
+
+
+def _not_null(column: str) -> Constraint:
+    return Constraint(f"{column} NOT NULL", [column], lambda df: df[column].isna())
+
+
+def _max_length(column: str, length: int) -> Constraint:
+    return Constraint(
+        f"{column} VARCHAR({length})",
+        [column],
+        lambda df: df[column].astype("string").str.len().gt(length).fillna(False),
+    )
+
+
+def _uuid(column: str) -> Constraint:
+    return Constraint(
+        f"{column} UUID",
+        [column],
+        lambda df: ~df[column]
+        .astype("string")
+        .str.fullmatch(UUID_PATTERN)
+        .fillna(True)
+        .astype(bool),
+    )
+
+
+def _in_range(column: str, name: str, bounds: tuple[int, int]) -> Constraint:
+    return Constraint(
+        f"{column} {name}",
+        [column],
+        lambda df: ~df[column].between(*bounds) & df[column].notna(),
+    )
+
+
+def _check(column: str, op: str, value: float) -> Constraint:
+    return Constraint(
+        f"CHECK ({column} {op} {value:g})",
+        [column],
+        lambda df: ~_OPERATORS[op](df[column], value) & df[column].notna(),
+    )
+
+
+def _primary_key(columns: list[str]) -> Constraint:
+    # The first row of a key is kept, only the later rows with the same key violate it
+    return Constraint(
+        f"{PRIMARY_KEY} ({', '.join(columns)})",
+        columns,
+        lambda df: df.duplicated(columns, keep="first"),
+    )
+
+
+def compile_constraints(schema: str, migrations: list[str]) -> dict:
+    """
+    The constraints of every table ({table: [Constraint]}), compiled from the Prisma `schema` (required
+    fields, VarChar lengths, UUIDs, Int and BigInt ranges, primary keys) and the simple CHECK constraints
+    of the `migrations` SQL.
+    """
+    tables = {}
+    for table, body in _MODEL.findall(schema):
+        constraints = []
+        for line in body.splitlines():
+            if line.strip().startswith("@@"):
+                if match := _ID.search(line):
+                    constraints.append(
+                        _primary_key([c.strip() for c in match.group(1).split(",")])
+                    )
+                continue
+            match = _FIELD.match(line)
+            if match is None:
+                continue
+            column, field_type, optional, attributes = match.groups()
+            if not optional:
+                constraints.append(_not_null(column))
+            if "@id" in attributes.split():
+                constraints.append(_primary_key([column]))
+            if length := _VARCHAR.search(attributes):
+                constraints.append(_max_length(column, int(length.group(1))))
+            if "@db.Uuid" in attributes:
+                constraints.append(_uuid(column))
+            if field_type == "Int":
+                constraints.append(_in_range(column, "INTEGER", INT4_RANGE))
+            elif field_type == "BigInt":
+                constraints.append(_in_range(column, "BIGINT", INT8_RANGE))
+        tables[table] = constraints
+    for migration in migrations:
+        for table, _, column, op, value in _CHECK.findall(migration):
+            tables.setdefault(table, []).append(_check(column, op, float(value)))
+    return tables
+
+
+@st.cache_resource
+def get_constraints() -> dict:
+    """
+    The constraints of every table, compiled once per process from SCHEMA_PATH and MIGRATIONS_DIR.
+    """
+    with open(SCHEMA_PATH) as f:
+        schema = f.read()
+    migrations = []
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, "*", "migration.sql"))):
+        with open(path) as f:
+            migrations.append(f.read())
+    return compile_constraints(schema, migrations)
+
+
+def violation_masks(df: pd.DataFrame, table: str, primary_key: bool = True):
+    """
+    Yield (constraint, mask of the violating rows) for every constraint of `table` on the columns of `df`,
+    except its primary key if not `primary_key`.
+    """
+    for constraint in get_constraints()[table]:
+        if not primary_key and constraint.name.startswith(PRIMARY_KEY):
+            continue
+        if set(constraint.columns) <= set(df.columns):
+            yield constraint, constraint.violations(df)
@@ -0,0 +1,20 @@
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+from prisma import Prisma
+
+# Interactive transactions time out after 5 seconds by default, too short for a big stage or batch
+TX_TIMEOUT = timedelta(minutes=10)
+
+
+@asynccontextmanager
+async def scoped_tx(prisma: Prisma, schema: str):
+    """
+    A transaction whose unqualified table names resolve to `schema` first, then `public`.
+
+    The search_path is set with SET LOCAL, so it only applies to this transaction and doesn't leak into the
+    other queries sharing the pooled connection.
+    """
+    async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+        await tx.execute_raw(f"SET LOCAL search_path TO {schema}, public;")
+        yield tx
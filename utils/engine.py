@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+AGGREGATED_KEYS = ["date", "user_id"]
+AGGREGATED_COLUMNS = [
+    "date",
+    "user_id",
+    "country",
+    "total_spins",
+    "total_revenue",
+    "total_purchases",
+    "avg_revenue_per_purchase",
+    "total_daily_revenue",
+]
+
+
+def aggregate_frames(spins_hourly: pd.DataFrame, purchases: pd.DataFrame):
+    """
+    The rows of `aggregated`, computed in-process from `spins_hourly` and `purchases` frames (validated
+    in Step 2, or pulled from PSQL), with the same semantics as the Step 4 SQL (see utils/aggregation.py):
+
+    - every (hour, user) with spins or purchases gets a row,
+    - the purchases are pre-aggregated per (hour, user) like `purchases_hourly`, so they join the hour's spins
+      one-to-one,
+    - `total_daily_revenue` is the user's revenue over the whole day, and is 0 without purchases that day.
+
+    Every step is a vectorized merge or groupby: no database round trip and no per-row Python. The frames
+    pulled from PSQL have categorical text columns: the groupbys only keep the observed groups, like SQL.
+    """
+    # purchases_hourly, then cte_purchases. Like SUM(), the revenue is NaN (NULL) if no purchase has one;
+    # like COUNT(*), every purchase is counted, with or without `revenue_usd`.
+    hourly = purchases.assign(date=purchases["date"].dt.floor("h")).groupby(
+        AGGREGATED_KEYS, observed=True
+    )["revenue_usd"]
+    purchases = pd.DataFrame(
+        {"revenue": hourly.sum(min_count=1), "purchases": hourly.size()}
+    ).reset_index()
+    purchases["day"] = purchases["date"].dt.floor("D")
+    # cte_union_spins_purchases, then cte_joined
+    joined = (
+        pd.concat([spins_hourly[AGGREGATED_KEYS], purchases[AGGREGATED_KEYS]])
+        .drop_duplicates()
+        .merge(
+            spins_hourly[AGGREGATED_KEYS + ["country", "total_spins"]],
+            on=AGGREGATED_KEYS,
+            how="left",
+        )
+        .merge(
+            purchases[AGGREGATED_KEYS + ["revenue", "purchases"]],
+            on=AGGREGATED_KEYS,
+            how="left",
+        )
+    )
+    # cte_total_daily_revenue
+    total_daily_revenue = (
+        purchases.groupby(["day", "user_id"], observed=True)["revenue"]
+        .sum(min_count=1)
+        .rename("total_daily_revenue")
+        .reset_index()
+    )
+
+    # cte_aggregated. SUM() over no values is 0, like COALESCE(SUM(...), 0)
+    aggregated = joined.groupby(
+        AGGREGATED_KEYS + ["country"],
+        dropna=False,
+        sort=False,
+        as_index=False,
+        observed=True,
+    ).agg(
+        total_spins=("total_spins", "sum"),
+        total_revenue=("revenue", "sum"),
+        total_purchases=("purchases", "sum"),
+    )
+    aggregated["total_spins"] = aggregated["total_spins"].astype("int64")
+    aggregated["total_purchases"] = aggregated["total_purchases"].astype("int64")
+    aggregated["avg_revenue_per_purchase"] = np.where(
+        aggregated["total_purchases"] > 0,
+        aggregated["total_revenue"] / aggregated["total_purchases"].clip(lower=1),
+        0.0,
+    )
+    aggregated["day"] = aggregated["date"].dt.floor("D")
+    aggregated = aggregated.merge(
+        total_daily_revenue, on=["day", "user_id"], how="left"
+    )
+    # COALESCE(total_daily_revenue, 0)
+    aggregated["total_daily_revenue"] = aggregated["total_daily_revenue"].fillna(0.0)
+    return (
+        aggregated[AGGREGATED_COLUMNS]
+        .sort_values(AGGREGATED_KEYS)
+        .reset_index(drop=True)
+    )
+
+
+def diff_aggregated(expected: pd.DataFrame, actual: pd.DataFrame, rtol=1e-9):
+    """
+    The rows of two `aggregated` frames that differ: rows only on one side (`_merge` is "left_only" or
+    "right_only"), and rows whose values differ (floats are compared with the relative tolerance `rtol`).
+    An empty frame means both are equivalent.
+    """
+
+    def normalize(df: pd.DataFrame):
+        df = df[AGGREGATED_COLUMNS].copy()
+        # PostgreSQL returns ISO 8601 strings, the engine naive timestamps
+        df["date"] = pd.to_datetime(df["date"], format="ISO8601", utc=True)
+        df["date"] = df["date"].dt.tz_localize(None)
+        return df
+
+    merged = normalize(expected).merge(
+        normalize(actual),
+        on=AGGREGATED_KEYS,
+        how="outer",
+        suffixes=("_expected", "_actual"),
+        indicator=True,
+    )
+    differs = merged["_merge"] != "both"
+    for column in AGGREGATED_COLUMNS:
+        if column in AGGREGATED_KEYS:
+            continue
+        left, right = merged[f"{column}_expected"], merged[f"{column}_actual"]
+        if column == "country":
+            differs |= (left != right) & ~(left.isna() & right.isna())
+        else:
+            differs |= ~np.isclose(
+                left.astype(float), right.astype(float), rtol=rtol, equal_nan=True
+            )
+    return merged[differs].reset_index(drop=True)
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import uuid
+
+import streamlit as st
+from prisma import Json, Prisma
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+# A node is "hot" if its own (exclusive) time is at least this share of the execution time
+HOT_NODE_SHARE = 0.2
+# Flag a runtime change if it is this many times faster/slower than the previous run...
+RUNTIME_CHANGE_RATIO = 1.5
+# ...and the absolute difference is large enough not to be noise
+RUNTIME_CHANGE_MIN_MS = 5.0
+
+
+##############################
+# Plan helpers
+##############################
+def plan_shape(node: dict) -> list:
+    """
+    The shape of a plan tree: node types, join types and relations, without any costs, rows or timings.
+    """
+    return [
+        node.get("Node Type"),
+        node.get("Join Type"),
+        node.get("Relation Name"),
+        [plan_shape(child) for child in node.get("Plans", [])],
+    ]
+
+
+def plan_hash(node: dict) -> str:
+    return hashlib.sha1(json.dumps(plan_shape(node)).encode()).hexdigest()
+
+
+def exclusive_time_ms(node: dict) -> float:
+    """
+    Time spent in the node itself, i.e. its total time (over all loops) minus the time of its children.
+    """
+    total = node.get("Actual Total Time", 0.0) * node.get("Actual Loops", 1)
+    children = sum(
+        child.get("Actual Total Time", 0.0) * child.get("Actual Loops", 1)
+        for child in node.get("Plans", [])
+    )
+    return max(total - children, 0.0)
+
+
+def render_plan_tree(plan: dict) -> str:
+    """
+    Render the plan tree as a nested markdown list, with the hot nodes highlighted in red.
+    """
+    execution_ms = plan.get("Execution Time", 0.0)
+    lines = []
+
+    def walk(node: dict, depth: int):
+        self_ms = exclusive_time_ms(node)
+        label = node["Node Type"]
+        if "Join Type" in node:
+            label = f"{node['Join Type']} {label}"
+        if "Relation Name" in node:
+            label += f" on `{node['Relation Name']}`"
+        buffers = node.get("Shared Hit Blocks", 0) + node.get("Shared Read Blocks", 0)
+        details = (
+            f"rows={node.get('Actual Rows')} loops={node.get('Actual Loops')} "
+            f"self={self_ms:.2f}ms buffers={buffers}"
+        )
+        if execution_ms and self_ms >= HOT_NODE_SHARE * execution_ms:
+            line = f":red[**🔥 {label}**] ({details})"
+        else:
+            line = f"{label} ({details})"
+        lines.append("    " * depth + "- " + line)
+        for child in node.get("Plans", []):
+            walk(child, depth + 1)
+
+    walk(plan["Plan"], 0)
+    return "\n".join(lines)
+
+
+##############################
+# Capture and regression tracking
+##############################
+class PlanCapture:
+    """
+    Runs the Step 4 queries, optionally under `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)`, stores the plans
+    of this run in the `query_plans` table, and flags queries whose plan shape or runtime changed
+    significantly compared to their previous run.
+
+    A query is only compared with its previous run on the same `schema` (i.e. by the same run, see
+    utils/runs.py) with the same query text, so another session's data sizes or an edited query don't
+    flag regressions (or hide them).
+
+    Note that EXPLAIN ANALYZE actually executes the statement, so `SELECT ... INTO` and `INSERT` statements
+    still have their side effects when captured.
+
+    Capturing doesn't touch the page, so it can run in a background job. The page renders the captured
+    plans afterwards with render() and render_summary().
+    """
+
+    def __init__(self, prisma: Prisma, enabled: bool, schema: str = "public"):
+        self.prisma = prisma
+        self.enabled = enabled
+        self.schema = schema
+        self.run_id = str(uuid.uuid4())
+        self.plans: dict[str, dict] = {}
+        self.regressions: dict[str, list[str]] = {}
+
+    async def run(
+        self,
+        query_name: str,
+        query: str,
+        returns_rows: bool = False,
+        client: Prisma | None = None,
+    ):
+        """
+        Execute `query` and return its rows. If capturing is enabled, also capture and store its plan.
+
+        For read-only queries whose rows are needed (`returns_rows=True`), the query is executed once more
+        after EXPLAIN ANALYZE, since the latter doesn't return the rows.
+
+        Pass a transaction as `client` to run the query in it (e.g. a transaction scoped to a run's schema).
+        """
+        client = client or self.prisma
+        if not self.enabled:
+            return await client.query_raw(query)
+
+        result = (await client.query_raw(EXPLAIN_PREFIX + query))[0]["QUERY PLAN"]
+        plan = (json.loads(result) if isinstance(result, str) else result)[0]
+        query_hash = hashlib.sha1(query.encode()).hexdigest()
+        previous = await client.query_plans.find_first(
+            where={
+                "schema_name": self.schema,
+                "query_name": query_name,
+                "query_hash": query_hash,
+            },
+            order={"created_at": "desc"},
+        )
+        await client.query_plans.create(
+            data={
+                "run_id": self.run_id,
+                "schema_name": self.schema,
+                "query_name": query_name,
+                "query_hash": query_hash,
+                "plan_hash": plan_hash(plan["Plan"]),
+                "execution_ms": plan["Execution Time"],
+                "plan": Json(plan),
+            }
+        )
+        self.plans[query_name] = plan
+        self.regressions[query_name] = self._compare(plan, previous)
+        return await client.query_raw(query) if returns_rows else []
+
+    def _compare(self, plan: dict, previous) -> list[str]:
+        if previous is None:
+            return []
+        flags = []
+        if previous.plan_hash != plan_hash(plan["Plan"]):
+            flags.append("plan shape changed since the previous run")
+        current_ms, previous_ms = plan["Execution Time"], previous.execution_ms
+        ratio = max(current_ms, previous_ms) / max(min(current_ms, previous_ms), 1e-3)
+        if (
+            ratio >= RUNTIME_CHANGE_RATIO
+            and abs(current_ms - previous_ms) >= RUNTIME_CHANGE_MIN_MS
+        ):
+            flags.append(
+                f"runtime changed from {previous_ms:.2f}ms to {current_ms:.2f}ms"
+            )
+        return flags
+
+    def render(self, query_name: str):
+        """
+        Show the regression flags and the plan tree captured for `query_name`, if any.
+        """
+        if query_name not in self.plans:
+            return
+        plan = self.plans[query_name]
+        for flag in self.regressions[query_name]:
+            st.warning(f"`{query_name}`: {flag}.")
+        with st.expander(
+            f"See query plan ({plan['Execution Time']:.2f}ms execution, "
+            f"{plan['Planning Time']:.2f}ms planning)"
+        ):
+            st.markdown(render_plan_tree(plan))
+            st.json(plan, expanded=False)
+
+    def render_summary(self):
+        """
+        Summarize the plan regressions of this run compared to the previous one.
+        """
+        if not self.enabled:
+            return
+        flagged = {name: flags for name, flags in self.regressions.items() if flags}
+        if not flagged:
+            st.success(
+                "No query changed its plan shape or runtime significantly since the previous run."
+            )
+            return
+        for query_name, flags in flagged.items():
+            st.warning(f"`{query_name}`: {'; '.join(flags)}.")
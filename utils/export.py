@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import datetime
+import gzip
+import os
+import uuid
+
+import psycopg
+import streamlit as st
+from psycopg import sql
+
+from utils.fetch import conninfo
+from utils.instrumentation import track_stage
+
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+# Rows buffered per Parquet row group: the memory bound of a Parquet export
+EXPORT_ROW_GROUP_ROWS = int(os.environ.get("EXPORT_ROW_GROUP_ROWS", "100000"))
+EXPORT_FORMATS = {"parquet": ".parquet", "csv.gz": ".csv.gz"}
+
+# Columns of `aggregated` with their PostgreSQL types (to decode binary COPY) and Arrow types
+AGGREGATED_COLUMNS = [
+    ("date", "timestamp", "timestamp[us]"),
+    ("user_id", "varchar", "string"),
+    ("country", "varchar", "string"),
+    ("total_spins", "int4", "int32"),
+    ("total_revenue", "float8", "float64"),
+    ("total_purchases", "int4", "int32"),
+    ("avg_revenue_per_purchase", "float8", "float64"),
+    ("total_daily_revenue", "float8", "float64"),
+]
+
+
+def export_query(table: str, start=None, end=None, countries=None) -> sql.Composed:
+    """
+    The SELECT of the rows of `table` (an `aggregated` table, possibly schema-qualified) in the [start, end)
+    date range and `countries`. COPY doesn't take bind parameters, so the values are quoted as literals.
+    """
+    filters = []
+    if start is not None:
+        filters.append(sql.SQL("date >= {}").format(sql.Literal(start)))
+    if end is not None:
+        filters.append(sql.SQL("date < {}").format(sql.Literal(end)))
+    if countries:
+        filters.append(
+            sql.SQL("country = ANY({})").format(sql.Literal(list(countries)))
+        )
+    return sql.SQL("SELECT {} FROM {}{} ORDER BY date, user_id").format(
+        sql.SQL(", ").join(sql.Identifier(c) for c, _, _ in AGGREGATED_COLUMNS),
+        sql.Identifier(*table.split(".")),
+        sql.SQL(" WHERE ") + sql.SQL(" AND ").join(filters) if filters else sql.SQL(""),
+    )
+
+
+async def _export_csv_gz(cursor, query: sql.Composed, file):
+    """
+    Stream the CSV output of COPY as is into the gzip file: nothing is decoded.
+    """
+    copy_query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)").format(query)
+    with gzip.open(file, "wb") as gz:
+        async with cursor.copy(copy_query) as copy:
+            async for data in copy:
+                gz.write(data)
+
+
+async def _export_parquet(cursor, query: sql.Composed, file):
+    """
+    Decode the binary output of COPY row by row, and write it row group by row group.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [(column, pa.type_for_alias(arrow)) for column, _, arrow in AGGREGATED_COLUMNS]
+    )
+    copy_query = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT binary)").format(query)
+    with pq.ParquetWriter(file, schema, compression="zstd") as writer:
+
+        def write(rows: list[tuple]):
+            columns = list(zip(*rows))
+            writer.write_table(
+                pa.Table.from_arrays(
+                    [pa.array(c, type=t) for c, t in zip(columns, schema.types)],
+                    schema=schema,
+                )
+            )
+
+        async with cursor.copy(copy_query) as copy:
+            copy.set_types([pg for _, pg, _ in AGGREGATED_COLUMNS])
+            rows = []
+            async for row in copy.rows():
+                rows.append(row)
+                if len(rows) == EXPORT_ROW_GROUP_ROWS:
+                    write(rows)
+                    rows = []
+            if rows:
+                write(rows)
+
+
+async def export_aggregated(
+    table: str, fmt: str, path: str, start=None, end=None, countries=None
+) -> int:
+    """
+    Export the rows of `table` (an `aggregated` table, possibly schema-qualified) in the [start, end) date
+    range and `countries` to a "parquet" or "csv.gz" file at `path`, streamed with `COPY ... TO STDOUT`,
+    so memory is bounded whatever the number of rows. The file only appears at `path` once complete.
+
+    Returns the number of rows exported.
+    """
+    query = export_query(table, start, end, countries)
+    # Concurrent exports to the same `path` don't write into each other's partial file
+    partial = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    with track_stage(f"export.{fmt}") as stage:
+        async with await psycopg.AsyncConnection.connect(conninfo()) as connection:
+            async with connection.cursor() as cursor:
+                if fmt == "parquet":
+                    await _export_parquet(cursor, query, partial)
+                else:
+                    await _export_csv_gz(cursor, query, partial)
+                stage.rows = cursor.rowcount
+        os.replace(partial, path)
+    return stage.rows
+
+
+def export_path(fmt: str) -> str:
+    """
+    A new file under EXPORT_DIR. The timestamp only has a one-second resolution, so a random suffix keeps
+    two exports started in the same second from overwriting each other.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    suffix = uuid.uuid4().hex[:8]
+    return os.path.join(EXPORT_DIR, f"aggregated_{stamp}_{suffix}{EXPORT_FORMATS[fmt]}")
+
+
+##############################
+# Export form
+##############################
+async def render_export(table: str, key: str):
+    """
+    A form exporting `table` (an `aggregated` table) to a file on the server's disk.
+    """
+    with st.form(key):
+        fmt = st.selectbox("Format", list(EXPORT_FORMATS))
+        dates = st.date_input("Date range (optional)", ())
+        countries = st.text_input("Countries (comma-separated, optional)")
+        if not st.form_submit_button("Export"):
+            return
+    start = end = None
+    if len(dates) == 2:
+        start = datetime.datetime.combine(dates[0], datetime.time())
+        end = datetime.datetime.combine(
+            dates[1] + datetime.timedelta(days=1), datetime.time()
+        )
+    path = export_path(fmt)
+    with st.spinner(f"Exporting `{table}`..."):
+        rows = await export_aggregated(
+            table,
+            fmt,
+            path,
+            start,
+            end,
+            [c.strip() for c in countries.split(",") if c.strip()],
+        )
+    st.success(
+        f"Exported {rows} rows of `{table}` to `{path}` ({os.path.getsize(path) / 1024:.0f} KiB)."
+    )
+
+
+##############################
+# CLI
+##############################
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export `aggregated` to a Parquet or gzipped CSV file."
+    )
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="parquet")
+    parser.add_argument("--out", help="Output file (default: a new file in EXPORT_DIR)")
+    parser.add_argument(
+        "--table",
+        default="public.aggregated",
+        help="e.g. run_<run_id>.aggregated for a run that wasn't promoted yet",
+    )
+    parser.add_argument("--start", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.datetime.fromisoformat, help="Exclusive")
+    parser.add_argument("--country", action="append", dest="countries")
+    args = parser.parse_args()
+
+    path = args.out or export_path(args.format)
+    rows = asyncio.run(
+        export_aggregated(
+            args.table, args.format, path, args.start, args.end, args.countries
+        )
+    )
+    print(f"Exported {rows} rows to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import uuid
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+import pandas as pd
+import psycopg
+from dotenv import load_dotenv
+
+# Rows fetched from the server-side cursor at a time
+FETCH_BATCH_ROWS = int(os.environ.get("FETCH_BATCH_ROWS", "10000"))
+# Read by Prisma when DATABASE_URL isn't in the environment, in this order
+ENV_FILES = [".env", "prisma/.env"]
+# Parameters of DATABASE_URL only understood by Prisma
+_PRISMA_PARAMS = {
+    "schema",
+    "connection_limit",
+    "pool_timeout",
+    "pgbouncer",
+    "socket_timeout",
+}
+# Column types (pg_type OIDs) decoded into typed arrays. The other columns are kept as Python objects.
+_DTYPES = {
+    16: "bool",
+    20: "int64",
+    21: "int64",
+    23: "int64",
+    700: "float64",
+    701: "float64",
+    1082: "datetime64[D]",
+    1114: "datetime64[us]",
+    1700: "float64",
+}
+_TIMESTAMPTZ = 1184
+
+
+def conninfo() -> str:
+    """
+    DATABASE_URL, without the parameters libpq doesn't understand. Like Prisma, it is read from ENV_FILES
+    if it isn't in the environment, e.g. for the CLIs (loadtest.py, `python -m utils.export`, ...).
+    """
+    for path in ENV_FILES:
+        load_dotenv(path)
+    if not os.environ.get("DATABASE_URL"):
+        raise RuntimeError(
+            f"DATABASE_URL isn't set, neither in the environment nor in {' or '.join(ENV_FILES)}"
+        )
+    url = urlsplit(os.environ["DATABASE_URL"])
+    query = [(k, v) for k, v in parse_qsl(url.query) if k not in _PRISMA_PARAMS]
+    return urlunsplit(url._replace(query=urlencode(query)))
+
+
+def _to_array(values: tuple, type_code: int, categorical: bool):
+    if categorical:
+        return pd.Categorical(values)
+    if type_code == _TIMESTAMPTZ:
+        return pd.DatetimeIndex(values)
+    dtype = _DTYPES.get(type_code)
+    if dtype is None:
+        return np.array(values, dtype=object)
+    # NULLs become NaN/NaT, except for integers and booleans, which need a nullable extension type
+    if dtype == "int64" and None in values:
+        return pd.array(values, dtype="Int64")
+    if dtype == "bool" and None in values:
+        return pd.array(values, dtype="boolean")
+    return np.array(values, dtype=dtype)
+
+
+def _to_frame(rows: list[tuple], columns: list, categorical) -> pd.DataFrame:
+    values = list(zip(*rows)) if rows else [() for _ in columns]
+    return pd.DataFrame(
+        {
+            column.name: _to_array(
+                column_values, column.type_code, column.name in categorical
+            )
+            for column, column_values in zip(columns, values)
+        }
+    )
+
+
+async def iter_frames(query: str, *params, batch_rows=FETCH_BATCH_ROWS, categorical=()):
+    """
+    Yield the result of `query` as DataFrames of at most `batch_rows` rows, read from a server-side cursor
+    in PostgreSQL's binary format and decoded straight into typed columns: datetime64 for dates and timestamps,
+    int64 (Int64 with NULLs) for integers, float64 for floats and numerics, categoricals for the text columns
+    named in `categorical`, and Python objects for the others.
+
+    Only one batch is in memory at a time. `query` uses `%s` placeholders for `params`.
+    """
+    async with await psycopg.AsyncConnection.connect(conninfo()) as connection:
+        cursor = connection.cursor(name=f"fetch_{uuid.uuid4().hex}", binary=True)
+        async with cursor:
+            await cursor.execute(query.strip().rstrip(";"), params)
+            yielded = False
+            while rows := await cursor.fetchmany(batch_rows):
+                yield _to_frame(rows, cursor.description, categorical)
+                yielded = True
+            # An empty result still has columns
+            if not yielded and cursor.description is not None:
+                yield _to_frame([], cursor.description, categorical)
+
+
+async def fetch_frame(query: str, *params, batch_rows=FETCH_BATCH_ROWS, categorical=()):
+    """
+    The result of `query` as a single typed DataFrame (see `iter_frames()`), without materializing
+    any intermediate list of rows or dicts.
+    """
+    frames = [
+        frame
+        async for frame in iter_frames(
+            query, *params, batch_rows=batch_rows, categorical=categorical
+        )
+    ]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    # Batches have different categories, which pd.concat() turns back into objects
+    for column in categorical:
+        if column in df.columns:
+            df[column] = pd.api.types.union_categoricals(
+                [frame[column] for frame in frames]
+            )
+    return df
@@ -0,0 +1,72 @@
+import hashlib
+
+import pandas as pd
+import pyarrow as pa
+
+
+def fingerprint_frames(*dfs: pd.DataFrame) -> str:
+    """
+    A content hash of one or more DataFrames (values, index and column names), used to key jobs and loads
+    by the data they work on.
+    """
+    h = hashlib.sha1()
+    for df in dfs:
+        h.update(",".join(map(str, df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def fingerprint_file(file, block_bytes: int = 1024 * 1024) -> str:
+    """
+    The SHA-256 of the bytes of an uploaded file (or of the file at a path), read block by block,
+    used to recognize a workbook that was already ingested (see utils/ingest.py).
+    """
+    h = hashlib.sha256()
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(block_bytes), b""):
+                h.update(block)
+        return h.hexdigest()
+    file.seek(0)
+    for block in iter(lambda: file.read(block_bytes), b""):
+        h.update(block)
+    file.seek(0)
+    return h.hexdigest()
+
+
+def _hash_array(h, array: pa.Array):
+    h.update(f"{array.offset}:{len(array)}".encode())
+    for buffer in array.buffers():
+        if buffer is not None:
+            h.update(buffer)
+    if pa.types.is_dictionary(array.type):
+        _hash_array(h, array.dictionary)
+
+
+def fingerprint_arrow(*values) -> str:
+    """
+    A content hash of DataFrames, Series and scalars, used to key cached results by their arguments.
+
+    DataFrames and Series are hashed through the raw buffers of their Arrow representation: numeric, datetime
+    and Arrow-backed string columns are hashed without converting or hashing their values one by one, which is
+    much cheaper than `fingerprint_frames()` (or `@st.cache_data`'s hashing) on large inputs.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for value in values:
+        if isinstance(value, pd.Series):
+            value = value.to_frame()
+        if not isinstance(value, pd.DataFrame):
+            h.update(repr((type(value), value)).encode())
+            continue
+        try:
+            table = pa.Table.from_pandas(value, preserve_index=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Columns of mixed Python objects have no Arrow type
+            h.update(fingerprint_frames(value).encode())
+            continue
+        # The schema includes the column names, types and index
+        h.update(table.schema.serialize())
+        for column in table.columns:
+            for chunk in column.chunks:
+                _hash_array(h, chunk)
+    return h.hexdigest()
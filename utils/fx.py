@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+import streamlit as st
+from prisma import Prisma
+
+from utils.cache import LRUCache
+
+# Revenue in this currency is already normalized
+BASE_CURRENCY = "USD"
+FX_CACHE_ENTRIES = int(os.environ.get("FX_CACHE_ENTRIES", "4096"))
+FX_CACHE_TTL_SECONDS = float(os.environ.get("FX_CACHE_TTL_SECONDS", "3600"))
+
+##############################
+# FX queries
+##############################
+# The rates of `currencies` (comma-separated) up to `day`, to resolve the as-of rates of a batch in one query
+FX_HISTORY_QUERY = """
+    SELECT currency, day, rate_to_usd
+    FROM public.fx_rates
+    WHERE currency = ANY(string_to_array($1, ',')) AND day <= $2::date
+    ORDER BY day;
+"""
+
+# As-of join in SQL: every purchase without `revenue_usd` is converted at the latest rate of its currency on
+# or before its date (an index-only backward scan of the primary key of `fx_rates`)
+FILL_REVENUE_USD_QUERY = """
+    UPDATE {table} p
+    SET revenue_usd = p.revenue * (
+        SELECT r.rate_to_usd
+        FROM public.fx_rates r
+        WHERE r.currency = p.currency AND r.day <= p.date::date
+        ORDER BY r.day DESC
+        LIMIT 1
+    )
+    WHERE p.revenue_usd IS NULL;
+"""
+
+
+@st.cache_resource
+def get_fx_cache() -> LRUCache:
+    """
+    The process-wide cache of as-of rates, by (currency, day).
+    """
+    return LRUCache(FX_CACHE_ENTRIES, FX_CACHE_TTL_SECONDS)
+
+
+def as_of_rates(pairs: pd.DataFrame, history: pd.DataFrame) -> pd.DataFrame:
+    """
+    As-of join in pandas: the rate of every (currency, day) of `pairs`, from the latest rate of
+    `history` (currency, day, rate_to_usd) on or before that day. NaN if there is none.
+    """
+    history = history.assign(day=pd.to_datetime(history["day"])).rename(
+        columns={"day": "rate_day"}
+    )
+    return pd.merge_asof(
+        pairs.sort_values("day"),
+        history.sort_values("rate_day"),
+        left_on="day",
+        right_on="rate_day",
+        by="currency",
+        direction="backward",
+    )[["currency", "day", "rate_to_usd"]]
+
+
+async def lookup_rates(prisma: Prisma, pairs: pd.DataFrame) -> pd.DataFrame:
+    """
+    The as-of rates (currency, day, rate_to_usd) of the distinct (currency, day) `pairs`. Cached pairs are
+    served from memory, the others are resolved with a single query on the caller's `prisma` client and an
+    as-of join, then cached.
+    """
+    cache = get_fx_cache()
+    rates, missing = [], []
+    for currency, day in pairs.itertuples(index=False):
+        rate = 1.0 if currency == BASE_CURRENCY else cache.get((currency, day))
+        if rate is None:
+            missing.append((currency, day))
+        else:
+            rates.append((currency, day, rate))
+    rates = pd.DataFrame(rates, columns=["currency", "day", "rate_to_usd"])
+    if not missing:
+        return rates.assign(day=pd.to_datetime(rates["day"]))
+
+    missing = pd.DataFrame(missing, columns=["currency", "day"])
+    history = pd.DataFrame(
+        await prisma.query_raw(
+            FX_HISTORY_QUERY,
+            ",".join(missing["currency"].unique()),
+            missing["day"].max().strftime("%Y-%m-%d"),
+        ),
+        columns=["currency", "day", "rate_to_usd"],
+    )
+    resolved = as_of_rates(missing, history)
+    for currency, day, rate in resolved.dropna().itertuples(index=False):
+        cache.put((currency, day), rate)
+    rates = pd.concat([rates, resolved], ignore_index=True)
+    return rates.assign(day=pd.to_datetime(rates["day"]))
+
+
+def add_revenue_usd(purchases: pd.DataFrame, rates: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the `revenue_usd` column to `purchases` (with parsed `date`, `currency` and `revenue` columns),
+    with a single merge on (currency, day) against `rates` (see `lookup_rates()`). NaN if there's no rate.
+    """
+    merged = purchases.assign(day=purchases["date"].dt.floor("D")).merge(
+        rates, on=["currency", "day"], how="left"
+    )
+    return purchases.assign(
+        revenue_usd=merged["revenue"].to_numpy() * merged["rate_to_usd"].to_numpy()
+    )
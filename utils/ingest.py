@@ -0,0 +1,234 @@
+import json
+import time
+
+import pandas as pd
+from prisma import Prisma
+
+from utils.instrumentation import track_stage
+from utils.jobs import JobContext
+from utils.loading import (
+    LOAD_MAX_BATCH_BYTES,
+    byte_bounded_batches,
+    load_job,
+    refresh_purchases_hourly,
+)
+from utils.quarantine import load_with_quarantine_job, quarantine
+from utils.streaming import (
+    STREAM_CHUNK_ROWS,
+    SpillStore,
+    quarantine_missing_rates,
+    stream_load_job,
+)
+
+INGEST_TABLES = {"spins_hourly": "spins", "purchases": "purchases"}
+
+
+##############################
+# Ingest log
+##############################
+async def find_ingest(prisma: Prisma, schema: str, content_hash: str):
+    """
+    The ingest of the workbook with this `content_hash` into the run's `schema`, or None: a single
+    primary key lookup, whatever the size of the workbook or of the tables.
+    """
+    return await prisma.ingest_log.find_unique(
+        where={
+            "schema_name_content_hash": {
+                "schema_name": schema,
+                "content_hash": content_hash,
+            }
+        }
+    )
+
+
+async def covered_ranges(prisma: Prisma, schema: str) -> dict[str, list[tuple]]:
+    """
+    The [start, end] time ranges of every table already loaded into the run's `schema` by finished ingests.
+    """
+    ingests = await prisma.ingest_log.find_many(
+        where={"schema_name": schema, "status": "done"}
+    )
+    return {
+        table: [
+            (getattr(ingest, f"{prefix}_start"), getattr(ingest, f"{prefix}_end"))
+            for ingest in ingests
+            if getattr(ingest, f"{prefix}_start") is not None
+        ]
+        for table, prefix in INGEST_TABLES.items()
+    }
+
+
+def outside_ranges(df: pd.DataFrame, ranges: list[tuple]) -> pd.DataFrame:
+    """
+    The rows of `df` whose `date` isn't in any of the [start, end] `ranges`.
+    """
+    dates = pd.to_datetime(df["date"])
+    covered = pd.Series(False, index=df.index)
+    for start, end in ranges:
+        covered |= dates.between(
+            pd.Timestamp(start).tz_localize(None), pd.Timestamp(end).tz_localize(None)
+        )
+    return df[~covered]
+
+
+##############################
+# Ingest job
+##############################
+async def _append_batch(prisma: Prisma, table: str, batch: list[dict]) -> int:
+    """
+    Like `_insert_batch()` in utils/loading.py, but rows already in `table` (e.g. a purchase in two
+    workbooks) are left as they are, so an interrupted append can be run again. Returns the rows inserted.
+    """
+    return await prisma.execute_raw(
+        f"""
+        INSERT INTO {table} SELECT * FROM json_populate_recordset(NULL::{table}, $1::json)
+        ON CONFLICT DO NOTHING;
+        """,
+        json.dumps(batch, default=str),
+    )
+
+
+async def append_new_ranges(
+    ctx: JobContext,
+    schema: str,
+    chunks: dict,
+    ranges: dict[str, list[tuple]],
+    rows_total: int,
+):
+    """
+    Append the rows of `chunks` ({table: iterable of DataFrames}, `rows_total` rows in all) outside the
+    time ranges already loaded into the run's `schema`. Returns the number of rows appended to each table.
+    """
+    appended, rows_read = {}, 0
+    for table, table_chunks in chunks.items():
+        appended[table] = 0
+        with track_stage(f"step3.append.{table}") as stage:
+            for chunk in table_chunks:
+                rows_read += chunk.shape[0]
+                chunk = outside_ranges(chunk, ranges[table])
+                for batch in byte_bounded_batches(chunk, LOAD_MAX_BATCH_BYTES):
+                    appended[table] += await _append_batch(
+                        ctx.prisma, f"{schema}.{table}", batch
+                    )
+                await ctx.progress(
+                    rows_read / max(rows_total, 1),
+                    f"appending `{table}` ({appended[table]} new rows)",
+                )
+            stage.rows = appended[table]
+    return appended
+
+
+def _summary(df: pd.DataFrame) -> tuple:
+    dates = pd.to_datetime(df["date"])
+    return df.shape[0], dates.min(), dates.max()
+
+
+async def ingest_job(
+    ctx: JobContext,
+    schema: str,
+    content_hash: str,
+    file_name: str | None,
+    spins_hourly_df: pd.DataFrame,
+    purchases_df: pd.DataFrame,
+    rejected: pd.DataFrame | None = None,
+    spill_path: str | None = None,
+):
+    """
+    Ingest a workbook into the run's `schema` in a background job, and record it in the `ingest_log`:
+    its content hash, the rows and time range of every sheet, and the load duration.
+
+    The first workbook of a run is loaded with `load_job()` (or `load_with_quarantine_job()` if rows were
+    `rejected` in Step 2, or `stream_load_job()` from the spill at `spill_path` in streaming mode, with the
+    rows rejected while spilling and the purchases without an FX rate). The next ones are appended, without
+    the rows in the time ranges already loaded. Returns the number of rows inserted into each table.
+    """
+    started = time.perf_counter()
+    if spill_path is not None:
+        # In streaming mode, the frames are only previews: summarize the spill instead
+        store = SpillStore(spill_path)
+        summaries = {
+            table: (store.count(table), *map(pd.Timestamp, store.date_range(table)))
+            for table in INGEST_TABLES
+        }
+        rejected = store.rejected()
+        store.close()
+    else:
+        summaries = {
+            "spins_hourly": _summary(spins_hourly_df),
+            "purchases": _summary(purchases_df),
+        }
+    rows_total = sum(rows for rows, _, _ in summaries.values())
+    ranges = await covered_ranges(ctx.prisma, schema)
+    summary = {}
+    for table, prefix in INGEST_TABLES.items():
+        rows, start, end = summaries[table]
+        summary[f"{prefix}_rows"] = rows
+        summary[f"{prefix}_start"] = None if pd.isna(start) else start.to_pydatetime()
+        summary[f"{prefix}_end"] = None if pd.isna(end) else end.to_pydatetime()
+    key = {"schema_name": schema, "content_hash": content_hash}
+    await ctx.prisma.ingest_log.upsert(
+        where={"schema_name_content_hash": key},
+        data={
+            "create": {**key, "file_name": file_name, **summary},
+            "update": {"status": "loading", **summary},
+        },
+    )
+
+    if not any(ranges.values()):
+        if spill_path is not None:
+            inserted, missing_rates = await stream_load_job(ctx, schema, spill_path)
+            rejected = pd.concat([rejected, missing_rates], ignore_index=True)
+            with track_stage("step3.quarantine") as stage:
+                await quarantine(ctx.prisma, schema, rejected)
+                stage.rows = rejected.shape[0]
+        elif rejected is not None:
+            inserted = await load_with_quarantine_job(
+                ctx, schema, spins_hourly_df, purchases_df, rejected
+            )
+        else:
+            inserted = await load_job(ctx, schema, spins_hourly_df, purchases_df)
+    else:
+        if spill_path is not None:
+            store = SpillStore(spill_path)
+            try:
+                inserted = await append_new_ranges(
+                    ctx,
+                    schema,
+                    {
+                        table: store.iter_chunks(table, STREAM_CHUNK_ROWS)
+                        for table in INGEST_TABLES
+                    },
+                    ranges,
+                    rows_total,
+                )
+                missing_rates = await quarantine_missing_rates(
+                    ctx.prisma, schema, store
+                )
+            finally:
+                store.close()
+            inserted["purchases"] -= missing_rates.shape[0]
+            rejected = pd.concat([rejected, missing_rates], ignore_index=True)
+        else:
+            inserted = await append_new_ranges(
+                ctx,
+                schema,
+                {"spins_hourly": [spins_hourly_df], "purchases": [purchases_df]},
+                ranges,
+                rows_total,
+            )
+        if rejected is not None:
+            with track_stage("step3.quarantine") as stage:
+                await quarantine(ctx.prisma, schema, rejected, replace=False)
+                stage.rows = rejected.shape[0]
+        await refresh_purchases_hourly(ctx.prisma, schema)
+
+    await ctx.prisma.ingest_log.update(
+        where={"schema_name_content_hash": key},
+        data={
+            "status": "done",
+            "spins_loaded": inserted["spins_hourly"],
+            "purchases_loaded": inserted["purchases"],
+            "load_seconds": time.perf_counter() - started,
+        },
+    )
+    return inserted
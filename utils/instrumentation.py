@@ -0,0 +1,206 @@
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Prometheus textfile (node_exporter `--collector.textfile.directory` format)
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE", "metrics/pipeline.prom")
+# Trace the Python allocations of every stage with tracemalloc. Off by default: tracing slows allocation-heavy
+# (e.g. pandas) code down severalfold, which would distort the wall times and rows/sec recorded
+TRACE_MEMORY = os.environ.get("TRACE_MEMORY", "0") == "1"
+
+_lock = threading.Lock()
+# Latest metrics of every stage across all sessions of this process, for the textfile
+_registry: dict[str, "StageMetrics"] = {}
+_run_counts: dict[str, int] = {}
+# Stages currently open (across sessions), so nested stages can share the tracemalloc peak
+_open_stages: list["StageMetrics"] = []
+# Stages finished in a thread without a Streamlit session (e.g. a background job), see collect_stages()
+_local = threading.local()
+
+
+@dataclass
+class StageMetrics:
+    """
+    Timing, throughput and memory of a single run of a pipeline stage: the peak RSS of the process when
+    the stage finished, and the peak of its Python allocations if TRACE_MEMORY (0 otherwise).
+
+    Set `rows` inside the `track_stage` block to the number of rows the stage processed.
+    """
+
+    stage: str
+    rows: int = 0
+    wall_seconds: float = 0.0
+    peak_memory_bytes: int = 0
+    max_rss_bytes: int = 0
+    finished_at: float = 0.0
+    # Traced memory when the stage started, so the peak only counts the stage's own allocations
+    _baseline: int = field(default=0, repr=False)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+
+def _fold_peak():
+    """
+    Fold the tracemalloc peak since the last reset into every open stage, then reset it.
+    Must be called with `_lock` held.
+    """
+    if not tracemalloc.is_tracing():
+        return
+    _, peak = tracemalloc.get_traced_memory()
+    for open_stage in _open_stages:
+        open_stage.peak_memory_bytes = max(
+            open_stage.peak_memory_bytes, peak - open_stage._baseline
+        )
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def track_stage(stage: str):
+    """
+    Record wall time, rows processed, rows/sec and memory of a stage.
+
+    If TRACE_MEMORY, memory is traced with `tracemalloc` while at least one stage is open. Since tracemalloc
+    is process-wide, the peak of a stage may include allocations of concurrent sessions. The peak RSS is
+    the process' high-water mark (`getrusage()`), which costs nothing to read.
+
+    Usage:
+    ```
+    with track_stage("step2.dedup") as stage:
+        df = df.drop_duplicates()
+        stage.rows = df.shape[0]
+    ```
+    """
+    metrics = StageMetrics(stage)
+    with _lock:
+        if TRACE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _fold_peak()
+        metrics._baseline = tracemalloc.get_traced_memory()[0]
+        _open_stages.append(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.wall_seconds = time.perf_counter() - started
+        metrics.finished_at = time.time()
+        # In KiB on Linux
+        metrics.max_rss_bytes = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        )
+        with _lock:
+            _fold_peak()
+            _open_stages.remove(metrics)
+            if not _open_stages and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            _registry[stage] = metrics
+            _run_counts[stage] = _run_counts.get(stage, 0) + 1
+        _write_textfile()
+        _session_metrics()[stage] = metrics
+
+
+def _session_metrics() -> dict[str, StageMetrics]:
+    if get_script_run_ctx() is None:
+        # Outside of a Streamlit session (e.g. a background job), only the textfile is updated,
+        # unless the stages are being collected
+        return getattr(_local, "collected", {})
+    if "stage_metrics" not in st.session_state:
+        st.session_state.stage_metrics = {}
+    return st.session_state.stage_metrics
+
+
+@contextmanager
+def collect_stages():
+    """
+    Collect the metrics of the stages finished in this thread outside of a Streamlit session,
+    so they can be handed over to the session later with add_session_metrics().
+    """
+    _local.collected = {}
+    try:
+        yield _local.collected
+    finally:
+        del _local.collected
+
+
+def add_session_metrics(metrics: dict[str, StageMetrics]):
+    _session_metrics().update(metrics)
+
+
+def metrics_to_df(metrics: dict[str, StageMetrics]) -> pd.DataFrame:
+    return pd.DataFrame(
+        [
+            {
+                "stage": m.stage,
+                "rows": m.rows,
+                "wall_ms": round(m.wall_seconds * 1000, 2),
+                "rows_per_sec": round(m.rows_per_second, 1),
+                "peak_mem_mb": round(m.peak_memory_bytes / 2**20, 2),
+                "max_rss_mb": round(m.max_rss_bytes / 2**20, 2),
+            }
+            for m in metrics.values()
+        ]
+    )
+
+
+def render_prometheus() -> str:
+    """
+    Render the latest metrics of every stage in the Prometheus text exposition format.
+    """
+    with _lock:
+        metrics = list(_registry.values())
+        run_counts = dict(_run_counts)
+    gauges = {
+        "pipeline_stage_wall_seconds": lambda m: m.wall_seconds,
+        "pipeline_stage_rows": lambda m: m.rows,
+        "pipeline_stage_rows_per_second": lambda m: m.rows_per_second,
+        "pipeline_stage_peak_memory_bytes": lambda m: m.peak_memory_bytes,
+        "pipeline_stage_max_rss_bytes": lambda m: m.max_rss_bytes,
+        "pipeline_stage_last_run_timestamp_seconds": lambda m: m.finished_at,
+    }
+    lines = []
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for m in metrics:
+            lines.append(f'{name}{{stage="{m.stage}"}} {value(m)}')
+    lines.append("# TYPE pipeline_stage_runs_total counter")
+    for stage, count in run_counts.items():
+        lines.append(f'pipeline_stage_runs_total{{stage="{stage}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def _write_textfile():
+    """
+    Atomically rewrite the textfile, so the collector never reads a half-written file.
+    """
+    if not METRICS_TEXTFILE:
+        return
+    content = render_prometheus()
+    directory = os.path.dirname(METRICS_TEXTFILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{METRICS_TEXTFILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, METRICS_TEXTFILE)
+
+
+def render_metrics_sidebar():
+    """
+    Show the stage metrics recorded in this session in the sidebar.
+    """
+    metrics = _session_metrics()
+    with st.sidebar.expander("Performance", expanded=False):
+        if not metrics:
+            st.caption("No stages recorded yet.")
+            return
+        st.dataframe(metrics_to_df(metrics), hide_index=True)
+        st.caption(f"Prometheus textfile: `{METRICS_TEXTFILE}`")
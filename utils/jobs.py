@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+import os
+import threading
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Coroutine
+
+import streamlit as st
+from prisma import Prisma
+from utils.instrumentation import add_session_metrics, collect_stages
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# How often the pages poll the `jobs` table for progress
+JOB_POLL_SECONDS = 0.5
+# Results of finished jobs kept in memory, oldest dropped first
+JOB_RESULTS_KEPT = 16
+
+ACTIVE_STATUSES = ["queued", "running"]
+
+# Creates the job unless one of the same kind and key is already active (see the `jobs_active_key` index)
+CREATE_JOB_QUERY = """
+    INSERT INTO jobs (id, kind, job_key, status, created_at, updated_at)
+    VALUES ($1::uuid, $2, $3, 'queued', now() AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC')
+    ON CONFLICT (kind, job_key) WHERE status IN ('queued', 'running') DO NOTHING
+    RETURNING id;
+"""
+
+
+class JobContext:
+    """
+    Handed to a job function running in a worker thread: its own Prisma client, and a way to report progress.
+    """
+
+    def __init__(self, job_id: str, prisma: Prisma):
+        self.job_id = job_id
+        self.prisma = prisma
+
+    async def progress(self, fraction: float, message: str = ""):
+        await self.prisma.jobs.update(
+            where={"id": self.job_id},
+            data={"progress": min(max(fraction, 0.0), 1.0), "message": message},
+        )
+
+
+class JobRunner:
+    """
+    Executes long-running load and aggregation jobs in a pool of worker threads, independently of the
+    Streamlit script run that started them. Job state and progress are persisted in the `jobs` table,
+    and results are kept in memory of this process, keyed by job id.
+
+    A job is identified by its `kind` and `job_key` (e.g. a fingerprint of the data it works on), so a
+    rerun of a page attaches to the job already running for the same data instead of starting a new one.
+    """
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self.futures: dict[str, Future] = {}
+        self.results: dict[str, Any] = {}
+        self.stage_metrics: dict[str, dict] = {}
+        # Only guards the in-memory state above, and is never held across an await
+        self.lock = threading.Lock()
+        self.started_at = datetime.datetime.utcnow()
+
+    async def submit(
+        self,
+        prisma: Prisma,
+        kind: str,
+        job_key: str,
+        fn: Callable[..., Coroutine],
+        *args,
+        force: bool = False,
+    ):
+        """
+        Start `fn(ctx, *args)` as a background job, or attach to the job of the same kind and key that is
+        still running (or has finished, with its result still in memory) in this process.
+        """
+        for job in await prisma.jobs.find_many(
+            where={"kind": kind, "job_key": job_key},
+            order={"created_at": "desc"},
+            take=1,
+        ):
+            if job.status in ACTIVE_STATUSES and await self._abandon(prisma, job):
+                continue
+            if job.status in ACTIVE_STATUSES or (
+                job.status == "succeeded" and job.id in self.results and not force
+            ):
+                return job
+
+        # Sessions submitting the same job at the same time race on the unique index of the active jobs:
+        # only one of them creates it, the others attach to it
+        job_id = str(uuid.uuid4())
+        if not await prisma.query_raw(CREATE_JOB_QUERY, job_id, kind, job_key):
+            return await prisma.jobs.find_first(
+                where={"kind": kind, "job_key": job_key},
+                order={"created_at": "desc"},
+            )
+        with self.lock:
+            self.futures[job_id] = self.executor.submit(
+                asyncio.run, self._run(job_id, fn, args)
+            )
+        return await prisma.jobs.find_unique(where={"id": job_id})
+
+    async def _abandon(self, prisma: Prisma, job) -> bool:
+        """
+        Mark the active job failed if a previous process of the app left it behind, i.e. it was created
+        before this runner. Returns whether it was.
+        """
+        abandoned = await prisma.jobs.update_many(
+            where={
+                "id": job.id,
+                "status": {"in": ACTIVE_STATUSES},
+                "created_at": {"lt": self.started_at},
+            },
+            data={"status": "failed", "error": "Abandoned: app restarted"},
+        )
+        return abandoned > 0
+
+    async def _run(self, job_id: str, fn: Callable[..., Coroutine], args: tuple):
+        prisma = Prisma()
+        try:
+            await prisma.connect()
+            await prisma.jobs.update(where={"id": job_id}, data={"status": "running"})
+            with collect_stages() as stages:
+                result = await fn(JobContext(job_id, prisma), *args)
+            with self.lock:
+                self.results[job_id] = result
+                self.stage_metrics[job_id] = stages
+                while len(self.results) > JOB_RESULTS_KEPT:
+                    oldest = next(iter(self.results))
+                    del self.results[oldest], self.stage_metrics[oldest]
+            await prisma.jobs.update(
+                where={"id": job_id}, data={"status": "succeeded", "progress": 1.0}
+            )
+        except Exception:
+            # If we couldn't even connect, the job stays queued and is marked abandoned on the next submit
+            if prisma.is_connected():
+                await prisma.jobs.update(
+                    where={"id": job_id},
+                    data={"status": "failed", "error": traceback.format_exc()},
+                )
+        finally:
+            # Under the lock, so this can't run before submit() registered the future
+            with self.lock:
+                self.futures.pop(job_id, None)
+            if prisma.is_connected():
+                await prisma.disconnect()
+
+    def result(self, job_id: str):
+        return self.results.get(job_id)
+
+    def is_running(self, job_id: str) -> bool:
+        """
+        Whether the job is queued or running in this process (a job left active by a previous process isn't).
+        """
+        with self.lock:
+            return job_id in self.futures
+
+
+@st.cache_resource
+def get_job_runner() -> JobRunner:
+    """
+    One runner per process, shared by all sessions, so any session can attach to a running job.
+    """
+    return JobRunner(JOB_WORKERS)
+
+
+async def wait_for_job(prisma: Prisma, job, label: str):
+    """
+    Poll the job's progress into a progress bar until it finishes. Stops the page if the job failed.
+
+    Navigating away only stops this polling: the job keeps running, and the page attaches to it again
+    on the next visit.
+    """
+    progress_bar = st.progress(job.progress, text=label)
+    while job.status in ACTIVE_STATUSES:
+        await asyncio.sleep(JOB_POLL_SECONDS)
+        job = await prisma.jobs.find_unique(where={"id": job.id})
+        progress_bar.progress(
+            job.progress, text=f"{label}: {job.message}" if job.message else label
+        )
+    progress_bar.empty()
+    if job.status == "failed":
+        st.error(f"Job `{job.kind}` failed:")
+        st.code(job.error)
+        st.stop()
+    # Show the stages of the job in this session's performance panel
+    add_session_metrics(get_job_runner().stage_metrics.get(job.id, {}))
+    return job
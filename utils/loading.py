@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+
+import pandas as pd
+from prisma import Prisma
+
+from utils.db import TX_TIMEOUT
+from utils.fingerprint import fingerprint_frames
+from utils.instrumentation import track_stage
+from utils.jobs import JobContext
+from utils.shadow import LOAD_MODE, create_shadow, shadow_name, swap_in_shadow
+
+# Upper bound of the JSON payload of a single batch
+LOAD_MAX_BATCH_BYTES = int(os.environ.get("LOAD_MAX_BATCH_BYTES", 1024 * 1024))
+# Attempts per batch before the load fails (and can be resumed later)
+LOAD_BATCH_ATTEMPTS = 3
+# Rows converted to records at a time while cutting batches
+_SLICE_ROWS = 1024
+
+
+# One row per user and hour with purchases, joined one-to-one to `spins_hourly` in Step 4
+REFRESH_PURCHASES_HOURLY_QUERY = """
+    INSERT INTO {schema}.purchases_hourly (date, user_id, revenue, purchases)
+    SELECT DATE_TRUNC('hour', date), user_id, SUM(revenue_usd), COUNT(*)
+    FROM {schema}.purchases
+    GROUP BY 1, 2;
+"""
+
+
+def byte_bounded_batches(df: pd.DataFrame, max_batch_bytes: int):
+    """
+    Yield the rows of `df` as lists of records, each list at most `max_batch_bytes` when serialized
+    (or a single row, if that row alone is larger).
+
+    Records are only materialized slice by slice, so memory is bounded by the batch size, not the size of `df`.
+    The batch boundaries only depend on the data and `max_batch_bytes`, so a resumed load cuts the same batches.
+    Missing values are None, i.e. JSON `null`: `json.dumps()` would write NaN as `NaN`, which isn't JSON.
+    """
+    batch, batch_bytes = [], 0
+    for start in range(0, df.shape[0], _SLICE_ROWS):
+        rows = df.iloc[start : start + _SLICE_ROWS]
+        rows = rows.astype(object).where(rows.notna(), None)
+        for record in rows.to_dict("records"):
+            # +2 for the separator between records
+            record_bytes = len(json.dumps(record, default=str)) + 2
+            if batch and batch_bytes + record_bytes > max_batch_bytes:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += record_bytes
+    if batch:
+        yield batch
+
+
+async def _insert_batch(tx: Prisma, table: str, batch: list[dict]):
+    """
+    Insert the batch as a single JSON parameter. Unlike create_many(), this works for tables without
+    a Prisma model, i.e. the shadow tables and the tables of a run's schema.
+    """
+    await tx.execute_raw(
+        f"INSERT INTO {table} SELECT * FROM json_populate_recordset(NULL::{table}, $1::json);",
+        json.dumps(batch, default=str),
+    )
+
+
+async def _shadow_rows(prisma: Prisma, shadow: str):
+    """
+    Rows in the shadow table, or None if it doesn't exist.
+    """
+    exists = await prisma.query_raw("SELECT to_regclass($1) IS NOT NULL AS e;", shadow)
+    if not exists[0]["e"]:
+        return None
+    return (await prisma.query_raw(f"SELECT COUNT(*) AS n FROM {shadow};"))[0]["n"]
+
+
+async def load_table_resumable(prisma: Prisma, table: str, df: pd.DataFrame, on_batch):
+    """
+    Replace the contents of `table` with `df`, in byte-bounded batches. Each batch is committed in the same
+    transaction as its checkpoint in the `load_progress` table.
+
+    In the default "shadow" LOAD_MODE, the batches go to a shadow table which is swapped in place of `table`
+    once complete (see utils/shadow.py). In the "in_place" mode, `table` is emptied and loaded directly.
+
+    `table` may be schema-qualified (e.g. the tables of a run, see utils/runs.py).
+
+    If a previous load of the same data into the same table didn't finish (e.g. a dropped connection), it is
+    resumed after its last committed batch instead of starting over. `on_batch(rows_done)` is awaited after
+    every committed batch. Returns the number of rows in the table after the load.
+    """
+    load_id = fingerprint_frames(df)
+    progress = await prisma.load_progress.find_unique(
+        where={"load_id_table_name": {"load_id": load_id, "table_name": table}}
+    )
+    target = table
+    if LOAD_MODE == "shadow":
+        target = shadow_name(table)
+        # An UNLOGGED shadow table is emptied if PostgreSQL crashed, so only resume if it's intact
+        if (
+            progress is not None
+            and progress.status == "running"
+            and await _shadow_rows(prisma, target) != progress.rows_done
+        ):
+            progress = None
+
+    if progress is None or progress.status != "running":
+        # Start over: the other unfinished loads of this table can't be resumed anymore
+        await prisma.load_progress.update_many(
+            where={"table_name": table, "status": "running"},
+            data={"status": "abandoned"},
+        )
+        if LOAD_MODE == "shadow":
+            await create_shadow(prisma, table)
+        else:
+            await prisma.execute_raw(f"DELETE FROM {table};")
+        progress = await prisma.load_progress.upsert(
+            where={"load_id_table_name": {"load_id": load_id, "table_name": table}},
+            data={
+                "create": {
+                    "load_id": load_id,
+                    "table_name": table,
+                    "rows_total": df.shape[0],
+                    "max_batch_bytes": LOAD_MAX_BATCH_BYTES,
+                },
+                "update": {
+                    "status": "running",
+                    "batches_done": 0,
+                    "rows_done": 0,
+                    "max_batch_bytes": LOAD_MAX_BATCH_BYTES,
+                },
+            },
+        )
+
+    batches_done, rows_done = progress.batches_done, progress.rows_done
+    # Cut the batches exactly like the interrupted load did, and skip the committed ones
+    for i, batch in enumerate(byte_bounded_batches(df, progress.max_batch_bytes)):
+        if i < batches_done:
+            continue
+        for attempt in range(1, LOAD_BATCH_ATTEMPTS + 1):
+            try:
+                async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+                    await _insert_batch(tx, target, batch)
+                    await tx.load_progress.update(
+                        where={
+                            "load_id_table_name": {
+                                "load_id": load_id,
+                                "table_name": table,
+                            }
+                        },
+                        data={
+                            "batches_done": i + 1,
+                            "rows_done": rows_done + len(batch),
+                        },
+                    )
+                break
+            except Exception:
+                if attempt == LOAD_BATCH_ATTEMPTS:
+                    raise
+                await asyncio.sleep(2**attempt)
+        batches_done, rows_done = i + 1, rows_done + len(batch)
+        await on_batch(rows_done)
+
+    if LOAD_MODE == "shadow":
+        await swap_in_shadow(prisma, table)
+    await prisma.load_progress.update(
+        where={"load_id_table_name": {"load_id": load_id, "table_name": table}},
+        data={"status": "done"},
+    )
+    return rows_done
+
+
+async def refresh_purchases_hourly(prisma: Prisma, schema: str):
+    """
+    Rebuild the `purchases_hourly` table of the run's `schema` from its `purchases`, in one transaction.
+    """
+    with track_stage("step3.purchases_hourly") as stage:
+        async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+            await tx.execute_raw(f"TRUNCATE {schema}.purchases_hourly;")
+            stage.rows = await tx.execute_raw(
+                REFRESH_PURCHASES_HOURLY_QUERY.format(schema=schema)
+            )
+
+
+async def load_job(
+    ctx: JobContext,
+    schema: str,
+    spins_hourly_df: pd.DataFrame,
+    purchases_df: pd.DataFrame,
+):
+    """
+    Replace the contents of the `spins_hourly` and `purchases` tables of the run's `schema` with the
+    validated data of Step 2, in a background job. Returns the number of rows inserted into each table.
+
+    The two tables are independent, so they are loaded concurrently on separate pooled connections.
+    """
+    tables = {"spins_hourly": spins_hourly_df, "purchases": purchases_df}
+    rows_total = sum(df.shape[0] for df in tables.values())
+    rows_done = {table: 0 for table in tables}
+    inserted = {}
+
+    async def load_table(table: str, df: pd.DataFrame):
+        async def on_batch(table_rows_done: int):
+            rows_done[table] = table_rows_done
+            await ctx.progress(
+                sum(rows_done.values()) / max(rows_total, 1),
+                f"loading `{table}` ({table_rows_done}/{df.shape[0]} rows)",
+            )
+
+        with track_stage(f"step3.create_many.{table}") as stage:
+            inserted[table] = await load_table_resumable(
+                ctx.prisma, f"{schema}.{table}", df, on_batch
+            )
+            stage.rows = inserted[table]
+
+    await asyncio.gather(*(load_table(table, df) for table, df in tables.items()))
+    await refresh_purchases_hourly(ctx.prisma, schema)
+    return inserted
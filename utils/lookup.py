@@ -0,0 +1,61 @@
+import os
+
+import streamlit as st
+from prisma import Prisma
+
+from utils.cache import LRUCache
+from utils.rollups import UNKNOWN_COUNTRY
+
+LOOKUP_CACHE_ENTRIES = int(os.environ.get("LOOKUP_CACHE_ENTRIES", "1024"))
+LOOKUP_CACHE_TTL_SECONDS = float(os.environ.get("LOOKUP_CACHE_TTL_SECONDS", "60"))
+
+##############################
+# Lookup queries
+##############################
+# Both are range scans of the `aggregated_user_id_date_idx` index: only the user's rows in [start, end) are read.
+# Hours without spins are reported under UNKNOWN_COUNTRY, like in the rollups.
+HOURLY_METRICS_QUERY = f"""
+    SELECT
+        date,
+        COALESCE(country, '{UNKNOWN_COUNTRY}') AS country,
+        total_spins,
+        total_revenue,
+        total_purchases,
+        avg_revenue_per_purchase
+    FROM aggregated
+    WHERE user_id = $1 AND date >= $2::timestamp AND date < $3::timestamp
+    ORDER BY date;
+"""
+
+DAILY_METRICS_QUERY = """
+    SELECT
+        DATE_TRUNC('day', date) AS date,
+        SUM(total_spins) AS total_spins,
+        SUM(total_revenue) AS total_revenue,
+        SUM(total_purchases) AS total_purchases,
+        MAX(total_daily_revenue) AS total_daily_revenue
+    FROM aggregated
+    WHERE user_id = $1 AND date >= $2::timestamp AND date < $3::timestamp
+    GROUP BY 1
+    ORDER BY 1;
+"""
+
+
+@st.cache_resource
+def get_lookup_cache() -> LRUCache:
+    """
+    The process-wide cache of lookup results, shared by all sessions.
+    """
+    return LRUCache(LOOKUP_CACHE_ENTRIES, LOOKUP_CACHE_TTL_SECONDS)
+
+
+async def user_metrics(prisma: Prisma, user_id: str, grain: str, start, end):
+    """
+    The "hourly" or "daily" metrics of `user_id` in the [start, end) date range, from the shared `aggregated`
+    table. Results are cached for LOOKUP_CACHE_TTL_SECONDS.
+    """
+    query = {"hourly": HOURLY_METRICS_QUERY, "daily": DAILY_METRICS_QUERY}[grain]
+    return await get_lookup_cache().get_or_load(
+        (user_id, grain, start, end),
+        lambda: prisma.query_raw(query, user_id, start, end),
+    )
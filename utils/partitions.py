@@ -0,0 +1,87 @@
+import hashlib
+import inspect
+
+import pandas as pd
+from prisma import Prisma
+
+
+def partition_days(df: pd.DataFrame) -> pd.Series:
+    """
+    The day partition of every row of an `aggregated` frame.
+    """
+    return pd.to_datetime(df["date"]).dt.floor("D")
+
+
+def partition_checksums(df: pd.DataFrame) -> pd.Series:
+    """
+    The content checksum of every day partition of an `aggregated` frame, by day.
+
+    Rows are hashed with `pd.util.hash_pandas_object` and summed (modulo 2^64) per day, so the checksum
+    doesn't depend on the order of the rows, and is computed in a single vectorized pass.
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    grouped = row_hashes.groupby(partition_days(df).to_numpy())
+    return grouped.sum().combine(
+        grouped.size(), lambda total, rows: f"{int(total):016x}{rows:08x}"
+    )
+
+
+def test_hash(test_method) -> str:
+    """
+    The hash of a test's source: verdicts of a test are only reused while its code is unchanged.
+    """
+    return hashlib.sha1(inspect.getsource(test_method).encode()).hexdigest()
+
+
+async def validate_partitions(
+    prisma: Prisma, df: pd.DataFrame, tests: dict, run_test, force: bool = False
+) -> pd.DataFrame:
+    """
+    Run every test of `tests` ({test_name: test_hash}) on every day partition of `df`, except the partitions
+    whose content (checksum) was already validated by the same test code: their verdicts are read from the
+    `validation_results` table, unless `force`. `run_test(test_name, partition_df)` returns (successful, details).
+
+    Returns a frame of (test_name, day, successful, details, cached), one row per test and partition.
+    """
+    checksums = partition_checksums(df)
+    days = partition_days(df)
+    cached = (
+        []
+        if force
+        else await prisma.validation_results.find_many(
+            where={
+                "test_name": {"in": list(tests)},
+                "checksum": {"in": list(checksums)},
+            }
+        )
+    )
+    verdicts = {(r.test_name, r.test_hash, r.day.date(), r.checksum): r for r in cached}
+
+    results, new_verdicts = [], []
+    for test_name, source_hash in tests.items():
+        for day, checksum in checksums.items():
+            verdict = verdicts.get((test_name, source_hash, day.date(), checksum))
+            if verdict is not None:
+                results.append(
+                    (test_name, day, verdict.successful, verdict.details, True)
+                )
+                continue
+            successful, details = run_test(test_name, df[days == day])
+            results.append((test_name, day, successful, details, False))
+            new_verdicts.append(
+                {
+                    "test_name": test_name,
+                    "test_hash": source_hash,
+                    "day": day.to_pydatetime(),
+                    "checksum": checksum,
+                    "successful": successful,
+                    "details": details,
+                }
+            )
+    if new_verdicts:
+        await prisma.validation_results.create_many(
+            data=new_verdicts, skip_duplicates=True
+        )
+    return pd.DataFrame(
+        results, columns=["test_name", "day", "successful", "details", "cached"]
+    )
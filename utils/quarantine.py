@@ -0,0 +1,219 @@
+import json
+
+import pandas as pd
+from prisma import Json, Prisma
+
+from utils.constraints import violation_masks
+from utils.db import TX_TIMEOUT
+from utils.fx import BASE_CURRENCY, add_revenue_usd, lookup_rates
+from utils.instrumentation import track_stage
+from utils.jobs import JobContext
+from utils.loading import load_job, refresh_purchases_hourly
+from utils.streaming import clean_purchases_chunk, clean_spins_chunk
+
+# Reason codes of the rows failing to parse. Rows violating a constraint get the constraint's name instead,
+# e.g. `user_id VARCHAR(7)` (see utils/constraints.py).
+UNPARSEABLE_DATE = "unparseable_date"
+UNPARSEABLE_TOTAL_SPINS = "unparseable_total_spins"
+UNPARSEABLE_REVENUE = "unparseable_revenue"
+MISSING_FX_RATE = "missing_fx_rate"
+
+# Columns of the rows of each sheet, as uploaded in Step 1
+RAW_COLUMNS = {
+    "spins_hourly": ["date", "userId", "country", "total_spins"],
+    "purchases": ["transaction_id", "date", "userId", "revenue"],
+}
+
+# Replayed rows colliding with a loaded row are merged like duplicates in Step 2: spins are summed,
+# purchases are dropped
+REPLAY_QUERIES = {
+    "spins_hourly": """
+        INSERT INTO {table} AS t SELECT * FROM json_populate_recordset(NULL::{table}, $1::json)
+        ON CONFLICT (date, user_id, country) DO UPDATE SET total_spins = t.total_spins + EXCLUDED.total_spins;
+    """,
+    "purchases": """
+        INSERT INTO {table} SELECT * FROM json_populate_recordset(NULL::{table}, $1::json)
+        ON CONFLICT (transaction_id) DO NOTHING;
+    """,
+}
+
+
+def parse_failures(raw: pd.Series, parsed: pd.Series) -> pd.Series:
+    """
+    The rows whose `raw` value is present, but couldn't be parsed (NaN/NaT in `parsed`).
+    """
+    return raw.notna() & parsed.isna()
+
+
+def split_rejected(
+    df: pd.DataFrame, table: str, failures: dict, primary_key: bool = True
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Split the cleaned rows of `table` (with a `source_row` column) into the rows to load and the rows
+    to quarantine: those flagged in `failures` ({reason code: mask}) or violating a constraint of `table`
+    (but its primary key if not `primary_key`).
+
+    Returns (accepted, rejected): `accepted` without the `source_row` column, `rejected` as
+    (table_name, source_row, reason), where `reason` lists every reason code of the row.
+    """
+    masks = pd.DataFrame(failures, index=df.index)
+    for constraint, mask in violation_masks(df, table, primary_key):
+        masks[constraint.name] = mask
+    is_rejected = masks.any(axis=1) if not masks.empty else pd.Series(False, df.index)
+    reasons = masks[is_rejected].apply(
+        lambda row: ", ".join(row.index[row.astype(bool)]), axis=1
+    )
+    rejected = pd.DataFrame(
+        {
+            "table_name": table,
+            "source_row": df.loc[is_rejected, "source_row"].astype(int),
+            "reason": reasons.astype(str),
+        }
+    )
+    return df[~is_rejected].drop(columns="source_row"), rejected
+
+
+def _record(values: dict) -> dict:
+    return {k: None if pd.isna(v) else str(v) for k, v in values.items()}
+
+
+def with_records(
+    rejected: pd.DataFrame, raw: pd.DataFrame, overrides: pd.DataFrame | None = None
+) -> pd.DataFrame:
+    """
+    Add the `record` of every rejected row: its values in `raw` (the sheet as uploaded in Step 1, with
+    a `source_row` column), to be fixed and replayed. The non-null values of `overrides` (indexed like
+    `rejected`) replace the raw ones, e.g. the total of merged duplicated spins.
+    """
+    columns = RAW_COLUMNS[rejected["table_name"].iloc[0]] if not rejected.empty else []
+    records = raw.set_index("source_row").loc[rejected["source_row"], columns]
+    records.index = rejected.index
+    if overrides is not None:
+        records = records.astype(object)
+        records.update(overrides.astype(object))
+    return rejected.assign(
+        record=[_record(record) for record in records.to_dict("records")]
+    )
+
+
+async def quarantine(
+    prisma: Prisma, schema: str, rejected: pd.DataFrame, replace: bool = True
+):
+    """
+    Replace the quarantined rows of the run's `schema` with `rejected` (see `split_rejected()` and
+    `with_records()`), e.g. when the run's tables are loaded again. If not `replace`, `rejected` is added
+    to them instead (e.g. when another workbook is appended to the run, see utils/ingest.py).
+    """
+    async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+        if replace:
+            await tx.rejected_rows.delete_many(where={"schema_name": schema})
+        if not rejected.empty:
+            await tx.rejected_rows.create_many(
+                data=[
+                    {
+                        "schema_name": schema,
+                        "table_name": row.table_name,
+                        "source_row": int(row.source_row),
+                        "reason": row.reason,
+                        "record": Json(row.record),
+                    }
+                    for row in rejected.itertuples(index=False)
+                ]
+            )
+
+
+async def load_with_quarantine_job(
+    ctx: JobContext,
+    schema: str,
+    spins_hourly_df: pd.DataFrame,
+    purchases_df: pd.DataFrame,
+    rejected: pd.DataFrame,
+):
+    """
+    `load_job()`, then replace the run's quarantined rows with the rows `rejected` in Step 2, in the same
+    background job: reruns attaching to the job don't reset the rows replayed since.
+    """
+    inserted = await load_job(ctx, schema, spins_hourly_df, purchases_df)
+    with track_stage("step3.quarantine") as stage:
+        await quarantine(ctx.prisma, schema, rejected)
+        stage.rows = rejected.shape[0]
+    return inserted
+
+
+async def clean_records(prisma: Prisma, table: str, records: pd.DataFrame):
+    """
+    Clean `records` (raw rows of `table`, with a `source_row` column) with the rules of Step 2, converting
+    the revenue at the rates looked up with `prisma`. Returns (accepted, rejected), see `split_rejected()`.
+    """
+    if table == "spins_hourly":
+        total_spins = pd.to_numeric(records["total_spins"], errors="coerce")
+        df = clean_spins_chunk(records.assign(total_spins=total_spins))
+        df["total_spins"] = df["total_spins"].round(0)
+        failures = {
+            UNPARSEABLE_DATE: parse_failures(records["date"], df["date"]),
+            UNPARSEABLE_TOTAL_SPINS: total_spins.isna(),
+        }
+        accepted, rejected = split_rejected(
+            df.assign(source_row=records["source_row"]), table, failures
+        )
+        return accepted.astype({"total_spins": int}), rejected
+    else:
+        df = clean_purchases_chunk(records)
+        failures = {
+            UNPARSEABLE_DATE: parse_failures(records["date"], df["date"]),
+            UNPARSEABLE_REVENUE: parse_failures(records["revenue"], df["revenue"])
+            | parse_failures(records["revenue"], df["currency"]),
+        }
+        # Convert the other currencies like Step 2 does, at the as-of rate of `fx_rates`
+        dates = pd.to_datetime(df["date"])
+        convert = df["currency"].notna() & dates.notna()
+        convert &= df["currency"] != BASE_CURRENCY
+        if convert.any():
+            pairs = pd.DataFrame(
+                {"currency": df["currency"], "day": dates.dt.floor("D")}
+            )[convert].drop_duplicates()
+            converted = add_revenue_usd(
+                df[convert].assign(date=dates[convert]),
+                await lookup_rates(prisma, pairs),
+            )
+            df.loc[convert, "revenue_usd"] = converted["revenue_usd"]
+        failures[MISSING_FX_RATE] = convert & df["revenue_usd"].isna()
+    return split_rejected(df.assign(source_row=records["source_row"]), table, failures)
+
+
+async def replay(prisma: Prisma, schema: str, table: str, fixed: pd.DataFrame):
+    """
+    Replay the quarantined rows of `table` in the run's `schema` with their `fixed` records (raw rows,
+    with the `id` and `source_row` of their quarantined row). The rows passing Step 2's rules are inserted
+    into the run's table and marked as replayed, the others stay quarantined with their new reasons.
+
+    Returns the number of rows replayed and still rejected.
+    """
+    accepted, rejected = await clean_records(prisma, table, fixed.drop(columns="id"))
+    async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+        if not accepted.empty:
+            await tx.execute_raw(
+                REPLAY_QUERIES[table].format(table=f"{schema}.{table}"),
+                json.dumps(
+                    accepted.astype(object)
+                    .where(accepted.notna(), None)
+                    .to_dict("records"),
+                    default=str,
+                ),
+            )
+            await tx.rejected_rows.update_many(
+                where={"id": {"in": fixed.loc[accepted.index, "id"].tolist()}},
+                data={"status": "replayed"},
+            )
+        columns = RAW_COLUMNS[table]
+        for index, reason in rejected["reason"].items():
+            await tx.rejected_rows.update(
+                where={"id": int(fixed.loc[index, "id"])},
+                data={
+                    "reason": reason,
+                    "record": Json(_record(fixed.loc[index, columns].to_dict())),
+                },
+            )
+    if table == "purchases" and not accepted.empty:
+        await refresh_purchases_hourly(prisma, schema)
+    return accepted.shape[0], rejected.shape[0]
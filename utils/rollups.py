@@ -0,0 +1,179 @@
+from dataclasses import dataclass
+
+from prisma import Prisma
+
+# Rows of `aggregated` without a country (purchases without spins in that hour) are rolled up under this code
+UNKNOWN_COUNTRY = "--"
+MEASURES = ["total_spins", "total_revenue", "total_purchases"]
+# A request at grain (key) can be answered from a table at any of these grains (values)
+ANSWERABLE_FROM = {
+    "hour": ["hour"],
+    "day": ["day", "hour"],
+    "week": ["week", "day", "hour"],
+    "month": ["day", "hour"],
+}
+
+
+def _refresh_query(
+    table: str, time_column: str, grain: str, dimensions: list[str], where: str = ""
+) -> str:
+    """
+    The query filling a rollup from the rows of `aggregated` matching `where` (all of them if empty).
+    """
+    keys = [f"DATE_TRUNC('{grain}', date) AS {time_column}"] + [
+        (
+            f"COALESCE(country, '{UNKNOWN_COUNTRY}') AS country"
+            if dimension == "country"
+            else dimension
+        )
+        for dimension in dimensions
+    ]
+    select_list = ",\n            ".join(keys + [f"SUM({m})" for m in MEASURES])
+    return f"""
+        INSERT INTO {table} ({", ".join([time_column, *dimensions, *MEASURES])})
+        SELECT
+            {select_list}
+        FROM aggregated{f" WHERE {where}" if where else ""}
+        GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))};
+        """
+
+
+@dataclass
+class Rollup:
+    """
+    A pre-aggregated table over `aggregated`: its time column and grain, the dimensions it keeps,
+    and whether it is (re)filled from `aggregated`.
+    """
+
+    table: str
+    time_column: str
+    grain: str
+    dimensions: list[str]
+    refreshed: bool = True
+
+    @property
+    def refresh_query(self) -> str | None:
+        """
+        The query filling the whole rollup from `aggregated`, after a TRUNCATE.
+        """
+        if not self.refreshed:
+            return None
+        return _refresh_query(self.table, self.time_column, self.grain, self.dimensions)
+
+    def refresh_periods_queries(self, periods: str) -> list[str]:
+        """
+        The queries refreshing only the periods of the rollup listed by `periods`, a query returning
+        timestamps truncated to its grain.
+        """
+        return [
+            f"DELETE FROM {self.table} WHERE {self.time_column} IN ({periods});",
+            _refresh_query(
+                self.table,
+                self.time_column,
+                self.grain,
+                self.dimensions,
+                f"DATE_TRUNC('{self.grain}', date) IN ({periods})",
+            ),
+        ]
+
+
+##############################
+# Rollups, coarsest first
+##############################
+ROLLUPS = [
+    Rollup("aggregated_weekly_country", "week", "week", ["country"]),
+    Rollup("aggregated_daily_country", "day", "day", ["country"]),
+    Rollup("aggregated_daily_user", "day", "day", ["user_id", "country"]),
+    # The hourly table itself, as the last resort
+    Rollup("aggregated", "date", "hour", ["user_id", "country"], refreshed=False),
+]
+
+
+def aligned(timestamp, grain: str) -> bool:
+    """
+    Whether `timestamp` (None for an open bound) starts a period of `grain`: an hour, a midnight, or a
+    Monday midnight (the start of a week for DATE_TRUNC).
+    """
+    if timestamp is None:
+        return True
+    if timestamp.minute or timestamp.second or timestamp.microsecond:
+        return False
+    if grain == "hour":
+        return True
+    return timestamp.hour == 0 and (grain != "week" or timestamp.weekday() == 0)
+
+
+def route(grain: str, dimensions: list[str], start=None, end=None) -> Rollup:
+    """
+    The coarsest table that can answer a request at `grain`, grouped or filtered by `dimensions`, over the
+    [start, end) date range. A rollup only answers ranges whose bounds are aligned to its own grain: its
+    rows cover whole periods, which can't be split at an unaligned bound.
+    """
+    for rollup in ROLLUPS:
+        if (
+            rollup.grain in ANSWERABLE_FROM[grain]
+            and set(dimensions) <= set(rollup.dimensions)
+            and aligned(start, rollup.grain)
+            and aligned(end, rollup.grain)
+        ):
+            return rollup
+    raise ValueError(f"No table can answer grain={grain}, dimensions={dimensions}")
+
+
+async def query_metrics(
+    prisma: Prisma,
+    grain: str,
+    group_by: list[str],
+    start=None,
+    end=None,
+    countries: list[str] | None = None,
+    user_ids: list[str] | None = None,
+):
+    """
+        Totals of `total_spins`, `total_revenue` and `total_purchases` per `grain` ("hour", "day", "week" or
+        "month") and `group_by` dimensions ("country", "user_id"), optionally filtered on a [start, end) date
+        range, countries and users. The request is routed to the coarsest rollup that can answer it. Hours
+    without spins are reported under the UNKNOWN_COUNTRY country, whichever table answers.
+
+        Returns the table that answered, and the rows.
+    """
+    dimensions = list(group_by)
+    if countries:
+        dimensions.append("country")
+    if user_ids:
+        dimensions.append("user_id")
+    rollup = route(grain, dimensions, start, end)
+    # `aggregated` keeps the hours without a country as NULL, the rollups as UNKNOWN_COUNTRY: answer with the latter
+    country = (
+        "country" if rollup.refreshed else f"COALESCE(country, '{UNKNOWN_COUNTRY}')"
+    )
+
+    filters, args = [], []
+    if countries:
+        args.append(",".join(countries))
+        filters.append(f"{country} = ANY(string_to_array(${len(args)}, ','))")
+    if user_ids:
+        args.append(",".join(user_ids))
+        filters.append(f"user_id = ANY(string_to_array(${len(args)}, ','))")
+    period = f"DATE_TRUNC('{grain}', {rollup.time_column})"
+    if start is not None:
+        args.append(start)
+        filters.append(f"{rollup.time_column} >= ${len(args)}::timestamp")
+    if end is not None:
+        args.append(end)
+        filters.append(f"{rollup.time_column} < ${len(args)}::timestamp")
+
+    columns = [f"{period} AS period"] + [
+        f"{country} AS country" if dimension == "country" else dimension
+        for dimension in group_by
+    ]
+    query = f"""
+        SELECT
+            {", ".join(columns)},
+            {", ".join(f"SUM({m}) AS {m}" for m in MEASURES)}
+        FROM {rollup.table}
+        {"WHERE " + " AND ".join(filters) if filters else ""}
+        GROUP BY {", ".join(str(i + 1) for i in range(len(columns)))}
+        ORDER BY {", ".join(str(i + 1) for i in range(len(columns)))};
+    """
+    return rollup.table, await prisma.query_raw(query, *args)
@@ -0,0 +1,144 @@
+import datetime
+import os
+import uuid
+
+import streamlit as st
+from prisma import Prisma
+
+from utils.db import scoped_tx
+from utils.rollups import ROLLUPS
+from utils.sketches import user_sketches_query
+
+# Tables every run gets its own copy of
+RUN_TABLES = [
+    "spins_hourly",
+    "purchases",
+    "purchases_hourly",
+    "aggregated",
+    "aggregated_weekly_country",
+    "aggregated_daily_country",
+    "aggregated_daily_user",
+    "user_sketches",
+]
+# Tables whose rows are merged into `public` by (day, user) when a run is promoted; the rollups and sketches
+# are recomputed from them over the days touched
+MERGED_TABLES = ["spins_hourly", "purchases", "purchases_hourly", "aggregated"]
+# How long promoting a run waits for the locks of the shared tables before giving up
+PROMOTE_LOCK_TIMEOUT_SECONDS = int(os.environ.get("PROMOTE_LOCK_TIMEOUT_SECONDS", "5"))
+# Runs that were never promoted are dropped after this many hours
+RUN_RETENTION_HOURS = int(os.environ.get("RUN_RETENTION_HOURS", "24"))
+
+
+def get_run_id() -> str:
+    """
+    The run of this session. Every session loads, aggregates and validates its data in its own
+    `run_<run_id>` schema, so concurrent sessions don't overwrite each other's tables.
+    """
+    if "run_id" not in st.session_state:
+        st.session_state.run_id = uuid.uuid4().hex[:12]
+    return st.session_state.run_id
+
+
+def run_schema(run_id: str) -> str:
+    return f"run_{run_id}"
+
+
+async def ensure_run(prisma: Prisma, run_id: str) -> str:
+    """
+    Create the schema of the run, with empty copies of the RUN_TABLES (columns, constraints and indexes),
+    if it doesn't exist yet. Returns the schema name.
+    """
+    schema = run_schema(run_id)
+    await prisma.execute_raw(f"CREATE SCHEMA IF NOT EXISTS {schema};")
+    for table in RUN_TABLES:
+        await prisma.execute_raw(
+            f"CREATE TABLE IF NOT EXISTS {schema}.{table} (LIKE public.{table} INCLUDING ALL);"
+        )
+    await prisma.runs.upsert(
+        where={"id": run_id},
+        data={
+            "create": {"id": run_id, "schema_name": schema},
+            "update": {},
+        },
+    )
+    return schema
+
+
+async def promote_run(prisma: Prisma, run_id: str):
+    """
+    Merge the tables of the run into the shared tables in `public`, in a single transaction: the rows of the
+    (day, user) pairs of the run are replaced by the run's rows, and the rollups and sketches of the days
+    touched are recomputed. The rows other runs promoted for other days or users are kept, and so are the
+    shared tables themselves (with their grants and indexes). The run's schema is dropped afterwards.
+
+    A new run is started for the session afterwards.
+    """
+    schema = run_schema(run_id)
+    async with scoped_tx(prisma, "public") as tx:
+        await tx.execute_raw(
+            f"SET LOCAL lock_timeout = '{PROMOTE_LOCK_TIMEOUT_SECONDS}s';"
+        )
+        await tx.execute_raw(
+            f"""
+            CREATE TEMP TABLE promoted_keys ON COMMIT DROP AS
+            SELECT DISTINCT DATE_TRUNC('day', date) AS day, user_id
+            FROM (
+                SELECT date, user_id FROM {schema}.spins_hourly
+                UNION ALL
+                SELECT date, user_id FROM {schema}.purchases
+            ) raw;
+            """
+        )
+        # Purchases reloaded under another date or user are replaced too
+        await tx.execute_raw(
+            f"""
+            DELETE FROM public.purchases p USING {schema}.purchases r
+            WHERE p.transaction_id = r.transaction_id;
+            """
+        )
+        for table in MERGED_TABLES:
+            await tx.execute_raw(
+                f"""
+                DELETE FROM public.{table} t USING promoted_keys k
+                WHERE t.date >= k.day AND t.date < k.day + INTERVAL '1 day' AND t.user_id = k.user_id;
+                """
+            )
+            await tx.execute_raw(
+                f"INSERT INTO public.{table} SELECT * FROM {schema}.{table};"
+            )
+        for rollup in ROLLUPS:
+            if rollup.refresh_query is None:
+                continue
+            for query in rollup.refresh_periods_queries(
+                f"SELECT DISTINCT DATE_TRUNC('{rollup.grain}', day) FROM promoted_keys"
+            ):
+                await tx.execute_raw(query)
+        promoted_days = "SELECT DISTINCT day FROM promoted_keys"
+        await tx.execute_raw(
+            f"DELETE FROM user_sketches WHERE day IN ({promoted_days});"
+        )
+        await tx.execute_raw(user_sketches_query(promoted_days))
+        await tx.execute_raw(f"DROP SCHEMA {schema} CASCADE;")
+        await tx.runs.update(
+            where={"id": run_id},
+            data={"status": "promoted", "promoted_at": datetime.datetime.utcnow()},
+        )
+    del st.session_state.run_id
+
+
+async def drop_stale_runs(prisma: Prisma):
+    """
+    Drop the schemas of the runs that were never promoted and are older than RUN_RETENTION_HOURS.
+    """
+    stale_runs = await prisma.runs.find_many(
+        where={
+            "status": "active",
+            "created_at": {
+                "lt": datetime.datetime.utcnow()
+                - datetime.timedelta(hours=RUN_RETENTION_HOURS)
+            },
+        }
+    )
+    for run in stale_runs:
+        await prisma.execute_raw(f"DROP SCHEMA IF EXISTS {run.schema_name} CASCADE;")
+        await prisma.runs.update(where={"id": run.id}, data={"status": "dropped"})
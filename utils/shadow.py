@@ -0,0 +1,97 @@
+import os
+import re
+
+from prisma import Prisma
+
+# "shadow": load into a fresh shadow table and swap it in atomically (default)
+# "in_place": DELETE the live table and insert into it
+LOAD_MODE = os.environ.get("LOAD_MODE", "shadow")
+SHADOW_SUFFIX = "_shadow"
+# Don't queue behind long-running readers of the live table for longer than this while swapping
+SWAP_LOCK_TIMEOUT = "5s"
+
+
+def shadow_name(table: str) -> str:
+    return f"{table}{SHADOW_SUFFIX}"
+
+
+def split_table(table: str) -> tuple[str, str]:
+    """
+    Split a (possibly schema-qualified) table name into its schema and name.
+    """
+    schema, _, name = table.rpartition(".")
+    return schema or "public", name
+
+
+async def create_shadow(prisma: Prisma, table: str) -> str:
+    """
+    (Re)create an empty shadow of `table`, with its columns, defaults and CHECK constraints, but without
+    its indexes, so rows are loaded without index maintenance. It is a regular (logged) table: an UNLOGGED
+    one would have to be made durable with SET LOGGED before the swap, which rewrites and WAL-logs the whole
+    table again under an exclusive lock.
+    """
+    shadow = shadow_name(table)
+    await prisma.execute_raw(f"DROP TABLE IF EXISTS {shadow};")
+    await prisma.execute_raw(
+        f"CREATE TABLE {shadow} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+    )
+    return shadow
+
+
+async def swap_in_shadow(prisma: Prisma, table: str):
+    """
+    Build the indexes (and primary key) of `table` on the loaded shadow, in one pass each, then swap it in
+    place of `table` with renames inside a short transaction, and drop the old table.
+
+    Readers see either the old or the new contents, never a half-loaded table, and since the old table is
+    dropped instead of deleted from, there are no dead tuples for autovacuum to clean up.
+
+    `table` may be schema-qualified (e.g. the tables of a run, see utils/runs.py).
+    """
+    schema, name = split_table(table)
+    table = f"{schema}.{name}"
+    shadow = shadow_name(table)
+
+    # Constraint-backed indexes (e.g. the primary key) are added as constraints, the others as indexes
+    indexes = await prisma.query_raw(
+        """
+        SELECT
+            i.relname AS index_name,
+            c.conname IS NOT NULL AS is_constraint,
+            COALESCE(pg_get_constraintdef(c.oid), pg_get_indexdef(x.indexrelid)) AS definition
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+        WHERE x.indrelid = $1::regclass;
+        """,
+        table,
+    )
+    for index in indexes:
+        index_name = index["index_name"]
+        if index["is_constraint"]:
+            await prisma.execute_raw(
+                f"ALTER TABLE {shadow} ADD CONSTRAINT {index_name}{SHADOW_SUFFIX} {index['definition']};"
+            )
+        else:
+            definition = index["definition"].replace(
+                f"INDEX {index_name} ", f"INDEX {index_name}{SHADOW_SUFFIX} ", 1
+            )
+            # pg_get_indexdef() only schema-qualifies the table if it's not on the search_path
+            definition = re.sub(
+                rf" ON (ONLY )?({schema}\.)?{name} USING ",
+                f" ON {shadow} USING ",
+                definition,
+                count=1,
+            )
+            await prisma.execute_raw(definition + ";")
+
+    async with prisma.tx() as tx:
+        await tx.execute_raw(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}';")
+        await tx.execute_raw(f"ALTER TABLE {table} RENAME TO {name}_old;")
+        await tx.execute_raw(f"ALTER TABLE {shadow} RENAME TO {name};")
+        await tx.execute_raw(f"DROP TABLE {table}_old;")
+        # Take the index names back, now that the old indexes are gone
+        for index in indexes:
+            await tx.execute_raw(
+                f"ALTER INDEX {schema}.{index['index_name']}{SHADOW_SUFFIX} RENAME TO {index['index_name']};"
+            )
@@ -0,0 +1,132 @@
+import math
+
+import pandas as pd
+from prisma import Prisma
+
+from utils.rollups import UNKNOWN_COUNTRY
+
+# HyperLogLog with 2^HLL_PRECISION registers per sketch. The relative standard error of a distinct count is
+# 1.04 / sqrt(registers), i.e. about 1.6%, whatever the number of users and however many sketches are merged:
+# ~95% of estimates are within 2 standard errors (3.3%) of the true count.
+HLL_PRECISION = 12
+HLL_REGISTERS = 2**HLL_PRECISION
+HLL_STANDARD_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+_HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+# Kinds of sketches: users who spun, and users who purchased
+SKETCH_KINDS = ["spinners", "payers"]
+
+
+##############################
+# Sketch queries
+##############################
+# One sketch per (day, country, kind), stored sparsely as its non-empty registers: the lowest HLL_PRECISION bits
+# of the 64-bit hash of `user_id` pick the register (`bucket`), and `rank` is the position of the first 1 in the
+# other bits. A register keeps the highest rank of its users, so sketches are merged with MAX(rank) per bucket.
+#
+# Purchases have no country: payers are counted under the countries they spun from that day, or UNKNOWN_COUNTRY.
+def user_sketches_query(days: str | None = None) -> str:
+    """
+    The query filling `user_sketches` from the raw tables, for all the days, or only for the days listed by
+    `days`, a query returning midnights.
+    """
+    where = f" WHERE DATE_TRUNC('day', date) IN ({days})" if days else ""
+    return f"""
+    INSERT INTO user_sketches (day, country, kind, bucket, rank)
+    SELECT
+        day,
+        country,
+        kind,
+        (h & {HLL_REGISTERS - 1})::smallint AS bucket,
+        MAX(COALESCE(
+            NULLIF(position(B'1' IN substring(h::bit(64) FROM 1 FOR {64 - HLL_PRECISION})), 0),
+            {64 - HLL_PRECISION + 1}
+        ))::smallint AS rank
+    FROM (
+        SELECT DATE_TRUNC('day', date) AS day, country, 'spinners' AS kind, hashtextextended(user_id, 0) AS h
+        FROM spins_hourly{where}
+        UNION ALL
+        SELECT
+            DATE_TRUNC('day', p.date),
+            COALESCE(s.country, '{UNKNOWN_COUNTRY}'),
+            'payers',
+            hashtextextended(p.user_id, 0)
+        FROM (SELECT date, user_id FROM purchases{where}) p
+        LEFT JOIN (
+            SELECT DISTINCT user_id, DATE_TRUNC('day', date) AS day, country FROM spins_hourly{where}
+        ) s ON s.user_id = p.user_id AND s.day = DATE_TRUNC('day', p.date)
+    ) users
+    GROUP BY 1, 2, 3, 4;
+"""
+
+
+REFRESH_USER_SKETCHES_QUERY = user_sketches_query()
+
+
+def estimate(inverse_sum: float, registers_set: int) -> float:
+    """
+    The HyperLogLog estimate of a (merged) sketch, from the sum of 2^-rank over its non-empty registers
+    and their number. Small counts are estimated by linear counting over the empty registers.
+    """
+    empty = HLL_REGISTERS - registers_set
+    raw = _HLL_ALPHA * HLL_REGISTERS**2 / (inverse_sum + empty)
+    if raw <= 2.5 * HLL_REGISTERS and empty > 0:
+        return HLL_REGISTERS * math.log(HLL_REGISTERS / empty)
+    return raw
+
+
+async def distinct_users(
+    prisma: Prisma,
+    grain: str,
+    by_country: bool,
+    start=None,
+    end=None,
+    countries: list[str] | None = None,
+    kinds: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    The estimated number of distinct users per `grain` ("day", "week" or "month") and, if `by_country`,
+    per country, optionally filtered on a [start, end) date range, countries and kinds of users (all users
+    if None). The sketches of the days, countries and kinds of each group are merged register by register,
+    so the cost doesn't depend on the number of users.
+
+    Returns (period, [country,] users, margin), `margin` being 2 standard errors (~95% confidence).
+    """
+    filters, args = [], [grain]
+    if start is not None:
+        args.append(start)
+        filters.append(f"day >= ${len(args)}::timestamp")
+    if end is not None:
+        args.append(end)
+        filters.append(f"day < ${len(args)}::timestamp")
+    if countries:
+        args.append(",".join(countries))
+        filters.append(f"country = ANY(string_to_array(${len(args)}, ','))")
+    if kinds:
+        args.append(",".join(kinds))
+        filters.append(f"kind = ANY(string_to_array(${len(args)}, ','))")
+    groups = ["period", "country"] if by_country else ["period"]
+    query = f"""
+        SELECT {", ".join(groups)}, SUM(POWER(2, -rank)) AS inverse_sum, COUNT(*) AS registers_set
+        FROM (
+            SELECT DATE_TRUNC($1, day) AS period, {"country, " if by_country else ""}bucket, MAX(rank) AS rank
+            FROM user_sketches
+            {"WHERE " + " AND ".join(filters) if filters else ""}
+            GROUP BY {", ".join(groups)}, bucket
+        ) registers
+        GROUP BY {", ".join(groups)}
+        ORDER BY {", ".join(groups)};
+    """
+    rows = pd.DataFrame(
+        await prisma.query_raw(query, *args),
+        columns=[*groups, "inverse_sum", "registers_set"],
+    )
+    users = [
+        estimate(float(inverse_sum), int(registers_set))
+        for inverse_sum, registers_set in zip(
+            rows["inverse_sum"], rows["registers_set"]
+        )
+    ]
+    return rows[groups].assign(
+        users=[round(u) for u in users],
+        margin=[round(2 * HLL_STANDARD_ERROR * u) for u in users],
+    )
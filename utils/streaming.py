@@ -0,0 +1,453 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+
+import pandas as pd
+from prisma import Prisma
+
+from utils.db import TX_TIMEOUT
+from utils.fx import BASE_CURRENCY, FILL_REVENUE_USD_QUERY
+from utils.instrumentation import track_stage
+from utils.jobs import JobContext
+from utils.loading import (
+    LOAD_MAX_BATCH_BYTES,
+    _insert_batch,
+    byte_bounded_batches,
+    refresh_purchases_hourly,
+)
+from utils.shadow import LOAD_MODE, create_shadow, shadow_name, swap_in_shadow
+
+# Rows read, cleaned, spilled and loaded at a time in streaming mode
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", "50000"))
+# The only directory Step 1 reads workbooks from on the server, instead of uploads
+STREAM_INPUT_DIR = os.environ.get("STREAM_INPUT_DIR", "input")
+# Where the deduplicated rows are spilled between Step 1 and Step 3
+STREAM_SPILL_DIR = os.environ.get("STREAM_SPILL_DIR", tempfile.gettempdir())
+# Rows of each table shown (and kept in the session) in streaming mode
+STREAM_PREVIEW_ROWS = 100
+
+SPILL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS spins_hourly (
+        date TEXT,
+        user_id TEXT,
+        country TEXT,
+        total_spins REAL,
+        PRIMARY KEY (date, user_id, country)
+    );
+    CREATE TABLE IF NOT EXISTS purchases (
+        transaction_id TEXT PRIMARY KEY,
+        date TEXT,
+        user_id TEXT,
+        currency TEXT,
+        revenue REAL,
+        revenue_usd REAL,
+        source_row INTEGER,
+        record TEXT
+    );
+    CREATE TABLE IF NOT EXISTS rejected (
+        table_name TEXT,
+        source_row INTEGER,
+        reason TEXT,
+        record TEXT
+    );
+"""
+
+# Duplicated spins of the same hour, user and country are summed, like in Step 2
+INSERT_SPINS_QUERY = """
+    INSERT INTO spins_hourly VALUES (?, ?, ?, ?)
+    ON CONFLICT (date, user_id, country) DO UPDATE SET total_spins = total_spins + excluded.total_spins;
+"""
+
+# Duplicated purchases are dropped, keeping the first one, like in Step 2
+INSERT_PURCHASES_QUERY = (
+    "INSERT OR IGNORE INTO purchases VALUES (?, ?, ?, ?, ?, ?, ?, ?);"
+)
+
+# The purchases left without `revenue_usd` after FILL_REVENUE_USD_QUERY have no FX rate
+DELETE_MISSING_RATES_QUERY = """
+    DELETE FROM {table} WHERE revenue_usd IS NULL RETURNING transaction_id::text AS transaction_id;
+"""
+
+SPILLED_QUERIES = {
+    "spins_hourly": """
+        SELECT date, user_id, country, CAST(ROUND(total_spins) AS INTEGER) AS total_spins
+        FROM spins_hourly ORDER BY rowid
+    """,
+    "purchases": """
+        SELECT transaction_id, date, user_id, currency, revenue, revenue_usd
+        FROM purchases ORDER BY rowid
+    """,
+}
+
+
+##############################
+# Step 1-2: read, clean and spill
+##############################
+def input_path(name: str) -> str | None:
+    """
+    The path of the file `name` in STREAM_INPUT_DIR, or None if there's no such file, or if `name` points
+    outside of STREAM_INPUT_DIR (e.g. `../.env` or an absolute path).
+    """
+    directory = os.path.realpath(STREAM_INPUT_DIR)
+    path = os.path.realpath(os.path.join(directory, name))
+    if os.path.commonpath([directory, path]) != directory or not os.path.isfile(path):
+        return None
+    return path
+
+
+def iter_sheet_chunks(file, sheet_name: str, chunk_rows: int, max_columns=None):
+    """
+    Yield the rows of a sheet as DataFrames of at most `chunk_rows` rows of strings (like
+    `read_excel(..., dtype=str)`), reading the workbook in openpyxl's read-only mode, so only
+    one chunk is in memory at a time. `file` is a path or a file-like object.
+    """
+    # Imported here, so pages only importing the settings of this module don't pay for it
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True, max_col=max_columns)
+        columns = [str(c) for c in next(rows)]
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                yield _to_frame(chunk, columns)
+                chunk = []
+        if chunk:
+            yield _to_frame(chunk, columns)
+    finally:
+        workbook.close()
+
+
+def _to_frame(rows: list[tuple], columns: list[str]) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=columns, dtype=object)
+    return df.where(df.isna(), df.astype(str))
+
+
+def _parse_datetime(column: pd.Series) -> pd.Series:
+    """
+    Same formats as `parse_datetime()` in Step 2, as `YYYY-MM-DD HH:MM:SS` strings.
+    """
+    column = pd.to_datetime(column, format="%Y-%m-%d %H:%M:%S", errors="coerce").fillna(
+        pd.to_datetime(column, format="%Y/%m/%d %H:%M:%S", errors="coerce")
+    )
+    return column.dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def clean_spins_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The validation of Step 2 for a chunk of `Spins Hourly` rows (except the deduplication, see `SpillStore`).
+    Values that can't be parsed are NaN/NaT (see `split_chunk()`).
+    """
+    return pd.DataFrame(
+        {
+            "date": _parse_datetime(df["date"]),
+            "user_id": df["userId"].str.strip(),
+            "country": df["country"].str.strip(),
+            "total_spins": pd.to_numeric(df["total_spins"], errors="coerce"),
+        }
+    )
+
+
+def clean_purchases_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The validation of Step 2 for a chunk of `Purchases` rows (except the deduplication, see `SpillStore`).
+    Each distinct revenue string is only parsed once.
+
+    Only USD revenue is normalized here, the other currencies are converted once loaded (see `quarantine_missing_rates()`).
+    """
+    from price_parser.parser import Price
+
+    prices = {s: Price.fromstring(s) for s in df["revenue"].dropna().unique()}
+    chunk = pd.DataFrame(
+        {
+            "transaction_id": df["transaction_id"].str.strip(),
+            "date": _parse_datetime(df["date"]),
+            "user_id": df["userId"].str.strip(),
+            "currency": df["revenue"].map(
+                lambda s: prices[s].currency, na_action="ignore"
+            ),
+            "revenue": df["revenue"].map(
+                lambda s: prices[s].amount_float, na_action="ignore"
+            ),
+        }
+    )
+    chunk["revenue_usd"] = chunk["revenue"].where(chunk["currency"] == BASE_CURRENCY)
+    return chunk
+
+
+def split_chunk(
+    table: str, raw: pd.DataFrame, cleaned: pd.DataFrame
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Split a cleaned chunk of `table` into the rows to spill and the rows to quarantine, like Step 2 does:
+    those whose date, `total_spins` or revenue couldn't be parsed, or violating a constraint of `table`
+    (see utils/constraints.py). `raw` is the chunk as read, with a `source_row` column.
+    Returns (accepted, rejected), `rejected` like `with_records()` in utils/quarantine.py.
+    """
+    # Imported here: utils.quarantine imports this module
+    from utils.quarantine import (
+        UNPARSEABLE_DATE,
+        UNPARSEABLE_REVENUE,
+        UNPARSEABLE_TOTAL_SPINS,
+        parse_failures,
+        split_rejected,
+        with_records,
+    )
+
+    failures = {UNPARSEABLE_DATE: parse_failures(raw["date"], cleaned["date"])}
+    if table == "spins_hourly":
+        failures[UNPARSEABLE_TOTAL_SPINS] = cleaned["total_spins"].isna()
+    else:
+        failures[UNPARSEABLE_REVENUE] = parse_failures(
+            raw["revenue"], cleaned["revenue"]
+        ) | parse_failures(raw["revenue"], cleaned["currency"])
+    # Duplicated keys aren't violations here: they are merged into the spill (see SpillStore)
+    accepted, rejected = split_rejected(
+        cleaned.assign(source_row=raw["source_row"]), table, failures, primary_key=False
+    )
+    return accepted, with_records(rejected, raw)
+
+
+class SpillStore:
+    """
+    The deduplicated rows of a streamed workbook, spilled to a SQLite file on disk: each chunk is merged
+    into the rows spilled so far by primary key, so the deduplication state never has to fit in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SPILL_SCHEMA)
+
+    def add_spins(self, df: pd.DataFrame):
+        with self.connection:
+            self.connection.executemany(
+                INSERT_SPINS_QUERY, df.itertuples(index=False, name=None)
+            )
+
+    def add_purchases(self, df: pd.DataFrame, raw: pd.DataFrame):
+        """
+        Spill cleaned purchases with their `source_row` and values in `raw` (the chunk as read), to quarantine
+        those without an FX rate once loaded (see `quarantine_missing_rates()`).
+        """
+        from utils.quarantine import RAW_COLUMNS, _record
+
+        raw = raw.loc[df.index]
+        records = [
+            json.dumps(_record(record))
+            for record in raw[RAW_COLUMNS["purchases"]].to_dict("records")
+        ]
+        with self.connection:
+            self.connection.executemany(
+                INSERT_PURCHASES_QUERY,
+                df.assign(source_row=raw["source_row"], record=records).itertuples(
+                    index=False, name=None
+                ),
+            )
+
+    def add_rejected(self, df: pd.DataFrame):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO rejected VALUES (?, ?, ?, ?);",
+                (
+                    (row.table_name, row.source_row, row.reason, json.dumps(row.record))
+                    for row in df.itertuples(index=False)
+                ),
+            )
+
+    def rejected(self) -> pd.DataFrame:
+        """
+        The quarantined rows, like `with_records()` in utils/quarantine.py returns them.
+        """
+        df = pd.read_sql_query(
+            "SELECT table_name, source_row, reason, record FROM rejected ORDER BY rowid;",
+            self.connection,
+        )
+        return df.assign(record=df["record"].map(json.loads))
+
+    def purchase_records(self, transaction_ids: list[str]) -> pd.DataFrame:
+        """
+        The `source_row` and `record` of the spilled purchases of `transaction_ids`, matched whatever the
+        spelling of the UUIDs (see UUID_PATTERN in utils/constraints.py).
+        """
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS selected (transaction_id TEXT PRIMARY KEY);"
+            )
+            self.connection.execute("DELETE FROM selected;")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO selected VALUES (?);",
+                ((t.replace("-", "").lower(),) for t in transaction_ids),
+            )
+        df = pd.read_sql_query(
+            """
+            SELECT p.source_row, p.record FROM purchases p
+            JOIN selected s
+                ON s.transaction_id = lower(replace(replace(replace(p.transaction_id, '-', ''), '{', ''), '}', ''))
+            ORDER BY p.rowid;
+            """,
+            self.connection,
+        )
+        return df.assign(record=df["record"].map(json.loads))
+
+    def count(self, table: str) -> int:
+        return self.connection.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+    def date_range(self, table: str) -> tuple[str | None, str | None]:
+        return self.connection.execute(
+            f"SELECT MIN(date), MAX(date) FROM {table};"
+        ).fetchone()
+
+    def preview(self, table: str, rows: int = STREAM_PREVIEW_ROWS) -> pd.DataFrame:
+        return pd.read_sql_query(
+            f"{SPILLED_QUERIES[table]} LIMIT {rows};", self.connection
+        )
+
+    def iter_chunks(self, table: str, chunk_rows: int):
+        """
+        Yield the spilled rows of `table` as DataFrames of at most `chunk_rows` rows, in insertion order.
+        """
+        yield from pd.read_sql_query(
+            SPILLED_QUERIES[table], self.connection, chunksize=chunk_rows
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def spill_path(run_id: str) -> str:
+    return os.path.join(STREAM_SPILL_DIR, f"spill_{run_id}.sqlite")
+
+
+def spill_workbook(file, path: str, on_chunk=None) -> SpillStore:
+    """
+    Stream both sheets of the workbook through the Step 2 validation into a fresh SpillStore at `path`,
+    chunk by chunk. The rows failing it are spilled to the store's rejected rows. `on_chunk(sheet_name, rows_read)` is called after every chunk.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    store = SpillStore(path)
+    sheets = [
+        ("Spins Hourly", "spins_hourly", 4, clean_spins_chunk),
+        ("Purchases", "purchases", None, clean_purchases_chunk),
+    ]
+    for sheet_name, table, max_columns, clean in sheets:
+        rows_read = 0
+        with track_stage(
+            f"step1.stream.{sheet_name.lower().replace(' ', '_')}"
+        ) as stage:
+            for chunk in iter_sheet_chunks(
+                file, sheet_name, STREAM_CHUNK_ROWS, max_columns
+            ):
+                # `source_row` is the row in the sheet (the header is row 1), like in Step 1
+                chunk.index = pd.RangeIndex(rows_read, rows_read + chunk.shape[0])
+                raw = chunk.assign(source_row=chunk.index + 2)
+                accepted, rejected = split_chunk(table, raw, clean(chunk))
+                if table == "spins_hourly":
+                    store.add_spins(accepted)
+                else:
+                    store.add_purchases(accepted, raw)
+                store.add_rejected(rejected)
+                rows_read += chunk.shape[0]
+                if on_chunk is not None:
+                    on_chunk(sheet_name, rows_read)
+            stage.rows = rows_read
+        if hasattr(file, "seek"):
+            file.seek(0)
+    return store
+
+
+##############################
+# Step 3: load
+##############################
+async def load_table_streaming(prisma: Prisma, table: str, chunks, on_batch):
+    """
+    Replace the contents of `table` with the rows of `chunks` (an iterable of DataFrames), in byte-bounded
+    batches, through a shadow table in the "shadow" LOAD_MODE (see utils/shadow.py). Only one chunk is in
+    memory at a time. `on_batch(rows_done)` is awaited after every batch. Returns the number of rows loaded.
+
+    Unlike `load_table_resumable()`, a failed streaming load starts over: its input isn't in memory to be
+    fingerprinted and cut into the same batches again.
+    """
+    target = table
+    if LOAD_MODE == "shadow":
+        target = shadow_name(table)
+        await create_shadow(prisma, table)
+    else:
+        await prisma.execute_raw(f"DELETE FROM {table};")
+
+    rows_done = 0
+    for chunk in chunks:
+        for batch in byte_bounded_batches(chunk, LOAD_MAX_BATCH_BYTES):
+            await _insert_batch(prisma, target, batch)
+            rows_done += len(batch)
+            await on_batch(rows_done)
+
+    if LOAD_MODE == "shadow":
+        await swap_in_shadow(prisma, table)
+    return rows_done
+
+
+async def quarantine_missing_rates(
+    prisma: Prisma, schema: str, store: SpillStore
+) -> pd.DataFrame:
+    """
+    Convert the revenue of the purchases loaded into the run's `schema` at the as-of rates of `fx_rates`,
+    and move those without a rate out of the table, like Step 2 does in memory. Returns them as rows to
+    quarantine (see `with_records()` in utils/quarantine.py), with their values spilled in `store`.
+    """
+    from utils.quarantine import MISSING_FX_RATE
+
+    table = f"{schema}.purchases"
+    with track_stage("step3.stream.fill_revenue_usd") as stage:
+        async with prisma.tx(timeout=TX_TIMEOUT) as tx:
+            await tx.execute_raw(FILL_REVENUE_USD_QUERY.format(table=table))
+            missing = await tx.query_raw(DELETE_MISSING_RATES_QUERY.format(table=table))
+        records = store.purchase_records([row["transaction_id"] for row in missing])
+        stage.rows = records.shape[0]
+    return records.assign(table_name="purchases", reason=MISSING_FX_RATE)[
+        ["table_name", "source_row", "reason", "record"]
+    ]
+
+
+async def stream_load_job(ctx: JobContext, schema: str, path: str):
+    """
+    Load the spilled `spins_hourly` and `purchases` rows at `path` into the tables of the run's `schema`,
+    in a background job, streaming them chunk by chunk. Returns the number of rows inserted into each table,
+    and the purchases moved out for lack of an FX rate (see `quarantine_missing_rates()`).
+    """
+    # The SpillStore of Step 1 can't be used here: a SQLite connection only works in the thread that opened it
+    store = SpillStore(path)
+    totals = {table: store.count(table) for table in ["spins_hourly", "purchases"]}
+    rows_done = {table: 0 for table in totals}
+    inserted = {}
+
+    async def load_table(table: str):
+        async def on_batch(table_rows_done: int):
+            rows_done[table] = table_rows_done
+            await ctx.progress(
+                sum(rows_done.values()) / max(sum(totals.values()), 1),
+                f"loading `{table}` ({table_rows_done}/{totals[table]} rows)",
+            )
+
+        with track_stage(f"step3.stream.{table}") as stage:
+            inserted[table] = await load_table_streaming(
+                ctx.prisma,
+                f"{schema}.{table}",
+                store.iter_chunks(table, STREAM_CHUNK_ROWS),
+                on_batch,
+            )
+            stage.rows = inserted[table]
+
+    try:
+        await asyncio.gather(*(load_table(table) for table in totals))
+        missing_rates = await quarantine_missing_rates(ctx.prisma, schema, store)
+    finally:
+        store.close()
+    inserted["purchases"] -= missing_rates.shape[0]
+    await refresh_purchases_hourly(ctx.prisma, schema)
+    return inserted, missing_rates
@@ -0,0 +1,121 @@
+import random
+import string
+import uuid
+
+import numpy as np
+import pandas as pd
+
+# Prices of the purchases, like in ORIGINAL_DATASET.xlsx
+PRICES = [0.99, 1.99, 4.99, 9.99, 19.99, 99.99]
+COUNTRIES = ["US", "CA", "GB", "DE", "FR", "AU"]
+# Distinct ids of the shape below: 2 letters and 2 digits
+MAX_USERS = 26 * 26 * 100
+
+
+def _user_ids(users: int, rng: random.Random) -> list[str]:
+    """
+    Distinct ids shaped like the ones of ORIGINAL_DATASET.xlsx (e.g. `WW42LKF`).
+    """
+    if users > MAX_USERS:
+        raise ValueError(f"At most {MAX_USERS} distinct user ids, got users={users}")
+    ids = set()
+    while len(ids) < users:
+        letters = "".join(rng.choices(string.ascii_uppercase, k=2))
+        ids.add(f"{letters}{rng.randrange(100):02d}LKF")
+    return sorted(ids)
+
+
+def generate_frames(
+    users: int = 50,
+    days: int = 3,
+    seed: int = 0,
+    start: str = "2022-04-01",
+    spin_rate: float = 0.3,
+    purchase_rate: float = 0.1,
+    duplicate_rate: float = 0.02,
+):
+    """
+    The `Spins Hourly` and `Purchases` sheets of a synthetic workbook, as DataFrames of strings, with the
+    quirks of ORIGINAL_DATASET.xlsx that Step 2 cleans up: float `total_spins`, spins of the same hour, user
+    and country split over several rows, `YYYY/MM/DD` purchase dates, and purchases listed twice.
+
+    Every user spins in about `spin_rate` of the hours of `days` days from `start`, mostly from one country,
+    and purchases in about `purchase_rate` of the hours they spin. The same `seed` gives the same workbook.
+    """
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    user_ids = np.array(_user_ids(users, rng))
+    countries = np.array(COUNTRIES)[np_rng.integers(len(COUNTRIES), size=users)]
+    hours = pd.date_range(start, periods=days * 24, freq="h")
+
+    # Spins Hourly: the active (hour, user) pairs
+    hour_index, user_index = np.nonzero(np_rng.random((len(hours), users)) < spin_rate)
+    spins = pd.DataFrame(
+        {
+            "date": hours[hour_index],
+            "userId": user_ids[user_index],
+            # Some users travel
+            "country": np.where(
+                np_rng.random(len(user_index)) < 0.05,
+                np.array(COUNTRIES)[
+                    np_rng.integers(len(COUNTRIES), size=len(user_index))
+                ],
+                countries[user_index],
+            ),
+            "total_spins": np_rng.uniform(1, 100, len(user_index)),
+        }
+    )
+    split = spins.sample(frac=duplicate_rate, random_state=seed)
+    spins = pd.concat([spins, split.assign(total_spins=split["total_spins"] / 2)])
+
+    # Purchases: 1 to 3 purchases in some of the active hours
+    paying = spins.drop_duplicates(["date", "userId"]).sample(
+        frac=purchase_rate, random_state=seed
+    )
+    paying = paying.loc[
+        paying.index.repeat(np_rng.integers(1, 4, size=paying.shape[0]))
+    ]
+    purchases = pd.DataFrame(
+        {
+            "date": paying["date"].to_numpy()
+            + pd.to_timedelta(np_rng.integers(3600, size=paying.shape[0]), unit="s"),
+            "userId": paying["userId"].to_numpy(),
+            "revenue": [
+                f"PriceInUSD={price}"
+                for price in np.array(PRICES)[
+                    np_rng.integers(len(PRICES), size=paying.shape[0])
+                ]
+            ],
+            "transaction_id": [
+                str(uuid.UUID(int=rng.getrandbits(128), version=4))
+                for _ in range(paying.shape[0])
+            ],
+        }
+    )
+    purchases = pd.concat(
+        [purchases, purchases.sample(frac=duplicate_rate, random_state=seed)]
+    )
+
+    spins["date"] = spins["date"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    spins["total_spins"] = spins["total_spins"].astype(str)
+    purchases["date"] = np.where(
+        np_rng.random(purchases.shape[0]) < 0.5,
+        purchases["date"].dt.strftime("%Y/%m/%d %H:%M:%S"),
+        purchases["date"].dt.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    return (
+        spins.sample(frac=1, random_state=seed).reset_index(drop=True),
+        purchases.sample(frac=1, random_state=seed).reset_index(drop=True),
+    )
+
+
+def generate_workbook(file, **kwargs):
+    """
+    Write a synthetic workbook (see `generate_frames()`) to `file`, a path or a binary file-like object,
+    in the layout Step 1 expects.
+    """
+    spins, purchases = generate_frames(**kwargs)
+    with pd.ExcelWriter(file, engine="openpyxl") as writer:
+        spins.to_excel(writer, sheet_name="Spins Hourly", index=False)
+        purchases.to_excel(writer, sheet_name="Purchases", index=False)
+    return spins.shape[0], purchases.shape[0]